@@ -24,16 +24,35 @@ setuptools.setup(
         'openslide-python>=1.1.2',
         'Pillow>=8.2.0',
         'ipython>=7.28.0',
-        'pyvips>=2.1.14'
+        'pyvips>=2.1.14',
+        'numpy>=1.20.0',
+        'pandas>=1.5.0',
+        'scipy>=1.6.0'
      ],
      extras_require={
         'pyqt5':[
             'PyQt5>=5.15.4',
             'PyQtWebEngine>=5.15.4'
         ],
+        'h5ad':[
+            'h5py>=3.0.0'
+        ],
+        'parquet':[
+            'pyarrow>=7.0.0'
+        ],
+        'zstd':[
+            'zstandard>=0.15.0'
+        ],
+        'zarr':[
+            'zarr>=2.11.0'
+        ],
         'full':[
             'PyQt5>=5.15.4',
-            'PyQtWebEngine>=5.15.4'
+            'PyQtWebEngine>=5.15.4',
+            'h5py>=3.0.0',
+            'pyarrow>=7.0.0',
+            'zstandard>=0.15.0',
+            'zarr>=2.11.0'
         ]
      },
      classifiers=[
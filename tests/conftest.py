@@ -0,0 +1,98 @@
+#
+# Shared fixtures of the TissUUmaps server tests
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import tissuumaps.plugins
+from tissuumaps import app, views
+
+MARKER_COUNT = 3000
+IMAGE_WIDTH, IMAGE_HEIGHT = 1000, 700
+
+
+def markers_frame(count=MARKER_COUNT, seed=0):
+    """Markers with coordinates in the test image, a text and a numeric key."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame(
+        {
+            "x": rng.uniform(0, IMAGE_WIDTH, count),
+            "y": rng.uniform(0, IMAGE_HEIGHT, count),
+            "gene": rng.choice(["A", "B", "C", "D"], count),
+            "cl": rng.integers(0, 5, count),
+            "value": rng.normal(10, 2, count),
+        }
+    )
+
+
+def image_array(width=IMAGE_WIDTH, height=IMAGE_HEIGHT):
+    """RGB gradient with a bright square, so that shifts and filters show."""
+    yy, xx = np.mgrid[0:height, 0:width]
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    image[:, :, 0] = xx * 255 // width
+    image[:, :, 1] = yy * 255 // height
+    image[200:300, 300:400] = 255
+    return image
+
+
+def save_pyramid(array, path, **options):
+    """Save a NumPy image as a tiled pyramidal TIFF with pyvips."""
+    import pyvips
+
+    if array.ndim == 2:
+        array = array[:, :, None]
+    image = pyvips.Image.new_from_memory(
+        np.ascontiguousarray(array).data,
+        array.shape[1],
+        array.shape[0],
+        array.shape[2],
+        {
+            "uint8": "uchar",
+            "uint16": "ushort",
+            "uint32": "uint",
+            "float32": "float",
+        }[array.dtype.name],
+    )
+    image.tiffsave(
+        str(path), tile=True, pyramid=True, tile_width=256, tile_height=256, **options
+    )
+
+
+@pytest.fixture(scope="session")
+def slideDir(tmp_path_factory):
+    """Slide folder with a marker file, an image and a label image."""
+    root = tmp_path_factory.mktemp("slides")
+    markers_frame().to_csv(root / "markers.csv", index=False)
+    save_pyramid(image_array(), root / "image.tif")
+    labels = np.zeros((IMAGE_HEIGHT, IMAGE_WIDTH), dtype=np.uint16)
+    # Cells 1 to 12, 100 pixels squares on a grid
+    for index in range(12):
+        row, col = divmod(index, 4)
+        labels[row * 200 + 50 : row * 200 + 150, col * 250 + 50 : col * 250 + 150] = index + 1
+    np.save(root / "labels.npy", labels)
+    save_pyramid(labels, root / "labels.tif")
+    return root
+
+
+@pytest.fixture(scope="session")
+def client(slideDir):
+    app.config["SLIDE_DIR"] = str(slideDir)
+    app.config["TESTING"] = True
+    views.setup(app)
+    return app.test_client()
+
+
+@pytest.fixture(scope="session")
+def pluginsAvailable():
+    """Plugins shipped with TissUUmaps, loadable as if installed."""
+    path = os.path.join(os.path.dirname(views.__file__), "plugins_available")
+    if path not in tissuumaps.plugins.__path__:
+        tissuumaps.plugins.__path__.append(path)
+    return path
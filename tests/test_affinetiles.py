@@ -0,0 +1,69 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from tissuumaps import affinetiles
+
+from conftest import IMAGE_HEIGHT, IMAGE_WIDTH, image_array
+
+
+def _tile(client, url):
+    resp = client.get(url)
+    assert resp.status_code == 200
+    return np.asarray(Image.open(io.BytesIO(resp.data)).convert("RGB")).astype(int)
+
+
+def test_identity_keeps_tiles(client):
+    for address in ["10/0_0", "10/1_1", "9/0_0"]:
+        plain = _tile(client, "/image.tif_files/%s.png" % address)
+        tile = _tile(client, "/image.tif/affine/1,0,0,1,0,0_files/%s.png" % address)
+        assert tile.shape == plain.shape
+        assert np.abs(tile - plain).max() <= 1, address
+
+
+def test_translation_shifts_tiles(client):
+    dzi = client.get("/image.tif/affine/1,0,0,1,30,20.dzi")
+    assert dzi.status_code == 200
+    assert b'Width="%d"' % (IMAGE_WIDTH + 30) in dzi.data
+    assert b'Height="%d"' % (IMAGE_HEIGHT + 20) in dzi.data
+    # 1030 pixels wide, the layer has one more level than its source
+    tile = _tile(client, "/image.tif/affine/1,0,0,1,30,20_files/11/0_0.png")
+    original = image_array().astype(int)
+    assert (tile[:20] == 0).all() and (tile[:, :30] == 0).all()
+    assert np.abs(tile[20:, 30:] - original[: 255 - 20, : 255 - 30]).max() <= 1
+
+
+def test_scaling(client):
+    dzi = client.get("/image.tif/affine/2,0,0,2,0,0.dzi")
+    assert b'Width="%d"' % (2 * IMAGE_WIDTH) in dzi.data
+    # The top level of the half-size image is level 9 of the original
+    tile = _tile(client, "/image.tif/affine/0.5,0,0,0.5,0,0_files/9/0_0.png")
+    plain = _tile(client, "/image.tif_files/9/0_0.png")
+    assert tile.shape == plain.shape
+    assert np.abs(tile - plain).max() <= 2
+
+
+def test_matrices():
+    assert affinetiles.parse_matrix("1,0,0,1,5,-2.5") == [1, 0, 0, 1, 5, -2.5]
+    for value in ["1,0,0,1,0", "1,0,0,1,0,nan", "1,2,2,4,0,0", [0, 0, 0, 0, 0, 0]]:
+        with pytest.raises(ValueError):
+            affinetiles.parse_matrix(value)
+    assert affinetiles.output_size(100, 50, [0, -1, 1, 0, 50, 0]) == (50, 100)
+    assert affinetiles.format_matrix([1, 0, 0, 1, 0.1, 2]) == "1,0,0,1,0.1,2"
+
+
+def test_layer_paths():
+    path = affinetiles.layer_path("a/b.tif", [1, 0, 0, 1, 3, 4])
+    assert path == "a/b.tif/affine/1,0,0,1,3,4"
+    assert affinetiles.split_layer_path(path) == ("a/b.tif", [1, 0, 0, 1, 3, 4])
+    assert affinetiles.split_layer_path("a/b.tif/affine/1,2,2,4,0,0") is None
+    # Transforms of transforms come from the same file
+    assert affinetiles.source_path(path + "/affine/2,0,0,2,0,0") == "a/b.tif"
+
+
+def test_invalid_layers(client):
+    assert client.get("/image.tif/affine/1,2,2,4,0,0.dzi").status_code == 404
+    assert client.get("/nothing.tif/affine/1,0,0,1,0,0.dzi").status_code == 404
+    assert client.get("/image.tif/affine/1,0,0,1,0,0_files/11/0_0.png").status_code == 404
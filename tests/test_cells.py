@@ -0,0 +1,95 @@
+import io
+
+import numpy as np
+import pandas as pd
+import scipy.io
+
+from conftest import markers_frame
+
+
+def _ground_truth(slideDir, scale=1.0):
+    """Label under every marker, read from the label array."""
+    labels = np.load(slideDir / "labels.npy")
+    frame = markers_frame()
+    px = np.floor(frame["x"] * scale).astype(int)
+    py = np.floor(frame["y"] * scale).astype(int)
+    inside = (px < labels.shape[1]) & (py < labels.shape[0])
+    frame["cell"] = 0
+    frame.loc[inside, "cell"] = labels[py[inside], px[inside]]
+    return frame
+
+
+def test_label_counts_match_the_label_image(client, slideDir):
+    resp = client.post(
+        "/markers.csv/cells", json={"labels": "/labels.tif.dzi", "gb_col": "gene"}
+    )
+    assert resp.status_code == 200
+    data = resp.get_json()
+    frame = _ground_truth(slideDir)
+    inCells = frame[frame["cell"] != 0]
+    assert data["cells"] == inCells["cell"].nunique() == 12
+    assert data["assigned"] == len(inCells)
+    assert data["unassigned"] == len(frame) - len(inCells)
+    assert sorted(data["keys"]) == ["A", "B", "C", "D"]
+
+    rows = pd.read_csv(io.BytesIO(client.get("/" + data["path"]).data))
+    expected = pd.crosstab(inCells["cell"], inCells["gene"])
+    rows = rows.set_index("cell").loc[expected.index]
+    assert (rows[expected.columns].to_numpy() == expected.to_numpy()).all()
+    assert (rows["total"] == expected.sum(axis=1)).all()
+    centroids = inCells.groupby("cell")["x"].mean()
+    assert np.allclose(rows["x"], centroids.loc[expected.index])
+
+    matrix = scipy.io.mmread(io.BytesIO(client.get(data["matrix"]).data))
+    assert matrix.sum() == len(inCells)
+    summary = client.get(data["summary"]).get_json()
+    assert sorted(summary["cells"]) == list(range(1, 13))
+
+
+def test_scaled_coordinates(client, slideDir):
+    data = client.post(
+        "/markers.csv/cells",
+        json={"labels": "labels.tif", "gb_col": "gene", "scale": 0.5},
+    ).get_json()
+    frame = _ground_truth(slideDir, 0.5)
+    assert data["assigned"] == int((frame["cell"] != 0).sum())
+
+
+def test_region_cells(client):
+    squares = [
+        {
+            "type": "Feature",
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [[[x, 0], [x + 100, 0], [x + 100, 700], [x, 700], [x, 0]]],
+            },
+            "properties": {"name": "band_%d" % x, "classification": {"name": "band"}},
+        }
+        for x in (0, 500)
+    ]
+    data = client.post(
+        "/markers.csv/cells", json={"regions": squares, "gb_col": "cl"}
+    ).get_json()
+    frame = markers_frame()
+    inBands = (frame["x"] < 100) | ((frame["x"] >= 500) & (frame["x"] < 600))
+    assert data["cells"] == 2
+    assert data["assigned"] == int(inBands.sum())
+    rows = pd.read_csv(io.BytesIO(client.get("/" + data["path"]).data))
+    assert list(rows["cell"]) == ["band_0", "band_500"]
+    assert list(rows["class"]) == ["band", "band"]
+
+
+def test_bad_requests(client):
+    for spec in [
+        {"labels": "labels.tif", "gb_col": "gene", "scale": "a"},
+        {"labels": "labels.tif", "gb_col": "gene", "scale": 0},
+        {"labels": "labels.tif", "gb_col": "gene", "scale": -2},
+        {"labels": "labels.tif", "gb_col": "gene", "scale": float("inf")},
+        {"labels": "labels.tif", "gb_col": "gene", "scale": [1]},
+        {"gb_col": "gene"},
+        ["labels.tif"],
+    ]:
+        assert client.post("/markers.csv/cells", json=spec).status_code == 400, spec
+    resp = client.post("/markers.csv/cells", json={"labels": "labels.tif", "gb_col": "nothing"})
+    assert resp.status_code == 404
+    assert client.get("/markers.csv/cells/nothing.csv").status_code == 404
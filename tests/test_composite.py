@@ -0,0 +1,95 @@
+import io
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from tissuumaps import composite
+
+from conftest import IMAGE_HEIGHT, IMAGE_WIDTH, image_array, save_pyramid
+
+
+@pytest.fixture(scope="module")
+def layers(slideDir):
+    grey = np.full((IMAGE_HEIGHT, IMAGE_WIDTH, 3), 100, dtype=np.uint8)
+    save_pyramid(grey, slideDir / "grey.tif")
+    save_pyramid(np.zeros((50, 50, 3), dtype=np.uint8), slideDir / "small.tif")
+    return ["/image.tif.dzi", "/grey.tif.dzi"]
+
+
+def _png(resp):
+    assert resp.status_code == 200
+    return np.asarray(Image.open(io.BytesIO(resp.data)).convert("RGB"))
+
+
+def _create(client, spec):
+    resp = client.post("/composite", json=spec)
+    assert resp.status_code == 200
+    return resp.get_json()["tileSource"]
+
+
+def test_colored_layers_are_added(client, layers):
+    tileSource = _create(
+        client,
+        {
+            "layers": [
+                {"tileSource": layers[0], "color": "#ff0000"},
+                {"tileSource": layers[1], "color": "100,50,0"},
+            ]
+        },
+    )
+    assert tileSource.startswith("/image.tif/composite/")
+    dzi = client.get(tileSource)
+    assert dzi.status_code == 200
+    assert b'Width="%d"' % IMAGE_WIDTH in dzi.data
+    tile = _png(client.get(tileSource.replace(".dzi", "_files/10/0_0.png")))
+    original = image_array()[: tile.shape[0], : tile.shape[1]]
+    assert (tile[:, :, 0] == np.minimum(original[:, :, 0].astype(int) + 100, 255)).all()
+    assert (tile[:, :, 1] == 50).all()
+    assert (tile[:, :, 2] == 0).all()
+
+
+def test_composite_matches_blended_tiles(client, layers):
+    spec = {
+        "layers": [
+            {"tileSource": layers[0], "min": 20, "max": 200, "gamma": 2},
+            {"tileSource": layers[1], "color": "#0000ff"},
+        ],
+        "compositeMode": "lighten",
+    }
+    tileSource = _create(client, spec)
+    tiles = [_png(client.get("/%s_files/9/1_1.png" % name)) for name in ["image.tif", "grey.tif"]]
+    expected = composite.blend(tiles, composite.normalize_spec(spec))
+    tile = _png(client.get(tileSource.replace(".dzi", "_files/9/1_1.png")))
+    assert (tile == expected).all()
+
+
+def test_intensity_lut():
+    lut = composite.intensity_lut(50, 150)
+    assert (lut[:51] == 0).all() and (lut[150:] == 255).all()
+    assert lut[100] == 128
+    assert composite.intensity_lut(0, 255, 2.0)[64] == round(255 * (64 / 255) ** 0.5)
+
+
+def test_parse_color():
+    assert composite.parse_color("#ff8000").tolist() == pytest.approx([1, 128 / 255, 0])
+    assert composite.parse_color("100,50,200").tolist() == [1, 0.5, 1]
+    assert composite.parse_color(None).tolist() == [1, 1, 1]
+
+
+def test_bad_requests(client, layers):
+    for spec in [
+        {},
+        {"layers": []},
+        {"layers": "image.tif"},
+        {"layers": [{"color": "#ff0000"}]},
+        {"layers": [{"tileSource": layers[0], "min": "a"}]},
+        {"layers": [{"tileSource": layers[0]}], "compositeMode": "multiply"},
+        {"layers": [{"tileSource": layers[0]}, {"tileSource": "/small.tif.dzi"}]},
+    ]:
+        assert client.post("/composite", json=spec).status_code == 400, spec
+    resp = client.post("/composite", json={"layers": [{"tileSource": "/nothing.tif.dzi"}]})
+    assert resp.status_code == 404
+    assert client.get("/image.tif/composite/0123456789abcdef.dzi").status_code == 404
+    tileSource = _create(client, {"layers": [{"tileSource": layers[0]}]})
+    assert client.get(tileSource.replace(".dzi", "_files/10/9_0.png")).status_code == 404
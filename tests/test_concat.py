@@ -0,0 +1,82 @@
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import markers_frame
+
+
+@pytest.fixture()
+def concatDir(slideDir):
+    root = slideDir / "concat"
+    root.mkdir(exist_ok=True)
+    markers_frame(500, seed=1).to_csv(root / "a.csv", index=False)
+    second = markers_frame(700, seed=2).drop(columns=["value"])
+    second["extra"] = "e"
+    second.to_csv(root / "b.csv", index=False)
+    with open(root / "all.markers", "w") as f:
+        json.dump({"files": ["a.csv", "b.csv"], "sourceColumn": "file"}, f)
+    return root
+
+
+def _frames():
+    return markers_frame(500, seed=1), markers_frame(700, seed=2)
+
+
+def _counts(client, url):
+    data = client.get(url).get_json()
+    return dict(zip(data["keys"], data["counts"]))
+
+
+def test_counts_are_the_sum_of_the_members(client, concatDir):
+    first, second = _frames()
+    expected = first["gene"].value_counts().add(
+        second["gene"].value_counts(), fill_value=0
+    )
+    assert _counts(client, "/concat/all.markers/counts?gb_col=gene") == dict(
+        (k, int(v)) for k, v in expected.items()
+    )
+    assert _counts(client, "/concat/all.markers/counts?gb_col=file") == {
+        "a.csv": 500,
+        "b.csv": 700,
+    }
+
+
+def test_columns_are_concatenated(client, concatDir):
+    resp = client.get("/concat/all.markers")
+    assert resp.status_code == 200
+    rows = pd.read_csv(io.BytesIO(resp.data))
+    assert list(rows.columns) == ["x", "y", "gene", "cl", "value", "extra", "file"]
+    first, second = _frames()
+    assert np.allclose(rows["x"], np.concatenate([first["x"], second["x"]]))
+    # Columns missing from a member are empty for its rows
+    assert rows["value"].iloc[500:].isna().all()
+    assert rows["extra"].iloc[:500].isna().all()
+    assert (rows["file"].iloc[500:] == "b.csv").all()
+
+
+def test_nearest_rows_span_members(client, concatDir):
+    first, second = _frames()
+    both = pd.concat([first, second], ignore_index=True)
+    distances = np.hypot(both["x"] - 300, both["y"] - 300)
+    data = client.get("/concat/all.markers/rows?x=300&y=300&k=10").get_json()
+    assert data["indices"] == list(np.argsort(distances, kind="stable")[:10])
+
+
+def test_changed_members_are_reloaded(client, concatDir):
+    assert _counts(client, "/concat/all.markers/counts?gb_col=file")["b.csv"] == 700
+    markers_frame(100, seed=3).to_csv(concatDir / "b.csv", index=False)
+    stat = os.stat(concatDir / "b.csv")
+    os.utime(concatDir / "b.csv", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert _counts(client, "/concat/all.markers/counts?gb_col=file")["b.csv"] == 100
+
+
+def test_invalid_manifests(client, slideDir, concatDir):
+    markers_frame(10).to_csv(slideDir.parent / "outside.csv", index=False)
+    for name, files in [("outside", ["../../outside.csv"]), ("nested", ["all.markers"])]:
+        with open(concatDir / (name + ".markers"), "w") as f:
+            json.dump(files, f)
+        assert client.get("/concat/%s.markers" % name).status_code == 404
@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.spatial import cKDTree
+
+from tissuumaps import enrichment
+
+from conftest import MARKER_COUNT, markers_frame
+
+
+def _codes(frame, keys):
+    return frame["gene"].map(dict((k, i) for i, k in enumerate(keys))).to_numpy()
+
+
+def _pair_counts(pairs, codes):
+    counts = np.zeros((4, 4), dtype=np.int64)
+    np.add.at(counts, (codes[pairs[:, 0]], codes[pairs[:, 1]]), 1)
+    return counts + counts.T
+
+
+@pytest.fixture(scope="module")
+def clustered(slideDir):
+    # A on the left half and B on the right one
+    rng = np.random.default_rng(1)
+    x = rng.uniform(0, 1000, 1000)
+    frame = pd.DataFrame(
+        {"x": x, "y": rng.uniform(0, 700, 1000), "gene": np.where(x < 500, "A", "B")}
+    )
+    frame.to_csv(slideDir / "clustered.csv", index=False)
+    return "/clustered.csv"
+
+
+def _post(client, path, **params):
+    resp = client.post(path + "/enrichment", json=dict(params, gb_col="gene"))
+    assert resp.status_code == 200
+    return resp.get_json()
+
+
+def test_enrichment_counts_match_the_knn_graph(client):
+    data = _post(client, "/markers.csv", permutations=20)
+    frame = markers_frame()
+    points = np.column_stack([frame["x"], frame["y"]])
+    _, neighbours = cKDTree(points).query(points, k=7)
+    pairs = np.column_stack(
+        [np.repeat(np.arange(len(points)), 6), neighbours[:, 1:].ravel()]
+    )
+    # Keys in their order of appearance in the file
+    assert data["keys"] == list(pd.unique(frame["gene"]))
+    assert data["markers"] == MARKER_COUNT
+    assert data["edges"] == MARKER_COUNT * 6
+    assert data["count"] == _pair_counts(pairs, _codes(frame, data["keys"])).tolist()
+    assert np.array(data["zscore"]).shape == (4, 4)
+
+
+def test_enrichment_is_reproducible(client):
+    first = _post(client, "/markers.csv", permutations=20, seed=3)
+    assert _post(client, "/markers.csv", permutations=20, seed=3) == first
+
+
+def test_permutations_do_not_depend_on_their_split():
+    rng = np.random.default_rng(0)
+    sources, targets = rng.integers(0, 50, 200), rng.integers(0, 50, 200)
+    labels = rng.integers(0, 3, 50)
+    whole = enrichment._permutation_counts(sources, targets, labels, 3, 7, 0, 10)
+    first = enrichment._permutation_counts(sources, targets, labels, 3, 7, 0, 4)
+    second = enrichment._permutation_counts(sources, targets, labels, 3, 7, 4, 10)
+    assert np.allclose(whole[0], first[0] + second[0])
+    assert np.allclose(whole[1], first[1] + second[1])
+
+
+def test_segregated_keys_are_enriched(client, clustered):
+    data = _post(client, clustered, permutations=50)
+    a, b = data["keys"].index("A"), data["keys"].index("B")
+    zscore = np.array(data["zscore"])
+    assert zscore[a, a] > 5 and zscore[b, b] > 5
+    assert zscore[a, b] < -5
+
+
+def test_cooccurrence_matches_brute_force(client):
+    data = _post(client, "/markers.csv", analysis="cooccurrence", distances=[50, 20])
+    assert data["distances"] == [20, 50]
+    frame = markers_frame()
+    codes = _codes(frame, data["keys"])
+    tree = cKDTree(np.column_stack([frame["x"], frame["y"]]))
+    frequency = np.bincount(codes) / len(codes)
+    for distance, ratio in zip([20, 50], data["ratio"]):
+        counts = _pair_counts(tree.query_pairs(distance, output_type="ndarray"), codes)
+        expected = counts / counts.sum(axis=1, keepdims=True) / frequency[None, :]
+        assert np.allclose(ratio, expected, rtol=1e-6)
+
+
+def test_per_region_results(client):
+    squares = [
+        {
+            "type": "Polygon",
+            "coordinates": [[[x, 0], [x + 500, 0], [x + 500, 700], [x, 700], [x, 0]]],
+        }
+        for x in (0, 500)
+    ]
+    data = _post(client, "/markers.csv", permutations=5, regions=squares)
+    assert [r["name"] for r in data["regions"]] == ["Region_1", "Region_2"]
+    frame = markers_frame()
+    assert sum(r["markers"] for r in data["regions"]) == MARKER_COUNT
+    assert data["regions"][0]["markers"] == int((frame["x"] < 500).sum())
+
+
+def test_bad_requests(client):
+    for params in [
+        {"graph": {"type": "grid"}},
+        {"graph": "knn"},
+        {"graph": {"type": "knn", "k": 0}},
+        {"permutations": 0},
+        {"permutations": "10"},
+        {"permutations": True},
+        {"seed": 1.5},
+        {"analysis": "cooccurrence", "distances": []},
+        {"analysis": "cooccurrence", "distances": "50"},
+        {"analysis": "cooccurrence", "distances": [-1]},
+        {"analysis": "cooccurrence", "distances": [1] * (enrichment.MAX_DISTANCES + 1)},
+        {"analysis": "something"},
+    ]:
+        resp = client.post("/markers.csv/enrichment", json=dict(params, gb_col="gene"))
+        assert resp.status_code == 400, params
+    resp = client.post("/markers.csv/enrichment", json={"gb_col": "nothing"})
+    assert resp.status_code == 404
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from scipy.spatial import Delaunay, cKDTree
+
+from tissuumaps import graph
+
+from conftest import MARKER_COUNT, markers_frame
+
+
+def _points():
+    frame = markers_frame()
+    return np.column_stack([frame["x"], frame["y"]])
+
+
+def _graph(client, query):
+    resp = client.get("/markers.csv/graph?distances=1&" + query)
+    assert resp.status_code == 200
+    count = int(resp.headers["X-Edge-Count"])
+    edges = np.frombuffer(resp.data[: count * 8], dtype="<u4").reshape(-1, 2)
+    distances = np.frombuffer(resp.data[count * 8 :], dtype="<f4")
+    assert len(distances) == count
+    return edges, distances
+
+
+def _pairs(edges):
+    return set(map(tuple, np.sort(edges, axis=1).tolist()))
+
+
+def test_knn_graph(client):
+    edges, distances = _graph(client, "type=knn&k=4")
+    assert len(edges) == MARKER_COUNT * 4
+    assert (np.bincount(edges[:, 0], minlength=MARKER_COUNT) == 4).all()
+    points = _points()
+    expected, _ = cKDTree(points).query(points, k=5)
+    assert np.allclose(np.sort(distances.reshape(-1, 4), axis=1), expected[:, 1:], rtol=1e-5)
+    lengths = np.hypot(*(points[edges[:, 0]] - points[edges[:, 1]]).T)
+    assert np.allclose(distances, lengths, rtol=1e-5)
+
+
+def test_radius_graph_matches_brute_force(client):
+    edges, distances = _graph(client, "type=radius&radius=30")
+    assert _pairs(edges) == cKDTree(_points()).query_pairs(30)
+    assert len(edges) == len(_pairs(edges))
+    assert distances.max() <= 30
+
+
+def test_delaunay_graph(client):
+    edges, distances = _graph(client, "type=delaunay")
+    triangles = Delaunay(_points()).simplices
+    expected = set()
+    for a, b in [(0, 1), (1, 2), (0, 2)]:
+        expected |= _pairs(triangles[:, [a, b]])
+    assert _pairs(edges) == expected
+    short, shortDistances = _graph(client, "type=delaunay&maxLength=40")
+    assert _pairs(short) == set(
+        pair for pair, d in zip(map(tuple, np.sort(edges, axis=1).tolist()), distances) if d <= 40
+    )
+    assert shortDistances.max() <= 40
+
+
+def test_parse_spec():
+    assert graph.parse_spec({}) == {"type": "knn", "k": 6}
+    assert graph.parse_spec({"type": "knn", "k": "3", "radius": 5}) == {"type": "knn", "k": 3}
+    assert graph.parse_spec({"type": "radius", "radius": "2.5", "maxLength": 4}) == {
+        "type": "radius",
+        "radius": 2.5,
+        "maxLength": 4.0,
+    }
+    for params in [
+        [],
+        {"type": "grid"},
+        {"type": ["knn"]},
+        {"k": 0},
+        {"k": graph.MAX_K + 1},
+        {"k": 2.5},
+        {"k": True},
+        {"k": [1]},
+        {"type": "radius"},
+        {"type": "radius", "radius": -1},
+        {"type": "radius", "radius": "nan"},
+        {"type": "radius", "radius": graph.MAX_LENGTH * 2},
+        {"maxLength": 0},
+    ]:
+        with pytest.raises(ValueError):
+            graph.parse_spec(params)
+
+
+def test_bad_requests(client):
+    for query in ["type=grid", "k=0", "k=a", "k=1000", "type=radius", "type=radius&radius=inf"]:
+        assert client.get("/markers.csv/graph?" + query).status_code == 400, query
+    assert client.get("/markers.csv/graph?X=nothing").status_code == 404
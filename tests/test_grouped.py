@@ -0,0 +1,57 @@
+import io
+
+import pandas as pd
+
+from tissuumaps import markers
+
+from conftest import markers_frame
+
+
+def test_counts_match_pandas(client):
+    resp = client.get("/markers.csv/counts?gb_col=gene")
+    assert resp.status_code == 200
+    data = resp.get_json()
+    expected = markers_frame()["gene"].value_counts()
+    assert dict(zip(data["keys"], data["counts"])) == expected.to_dict()
+    assert data["total"] == len(markers_frame())
+
+
+def test_numeric_keys_are_formatted_as_in_the_csv(client):
+    data = client.get("/markers.csv/counts?gb_col=cl").get_json()
+    expected = markers_frame()["cl"].value_counts()
+    assert dict(zip(data["keys"], data["counts"])) == dict(
+        (str(k), v) for k, v in expected.items()
+    )
+
+
+def test_group_rows_of_one_key(client):
+    resp = client.get("/markers.csv/group?gb_col=gene&key=B")
+    assert resp.status_code == 200
+    rows = pd.read_csv(io.BytesIO(resp.data))
+    frame = markers_frame()
+    expected = frame[frame["gene"] == "B"]
+    assert len(rows) == len(expected)
+    assert sorted(rows["x"].round(6)) == sorted(expected["x"].round(6))
+
+
+def test_group_post_with_columns(client):
+    resp = client.post(
+        "/markers.csv/group", json={"gb_col": "gene", "keys": ["A", "C"], "columns": ["x"]}
+    )
+    rows = pd.read_csv(io.BytesIO(resp.data))
+    assert list(rows.columns) == ["x"]
+    assert len(rows) == markers_frame()["gene"].isin(["A", "C"]).sum()
+
+
+def test_unknown_and_missing_columns(client):
+    assert client.get("/markers.csv/counts?gb_col=nothing").status_code == 404
+    assert client.get("/markers.csv/counts").status_code == 400
+
+
+def test_continuous_columns_are_refused(client, slideDir, monkeypatch):
+    monkeypatch.setattr(markers, "MAX_GROUP_KEYS", 100)
+    assert client.get("/markers.csv/counts?gb_col=value").status_code == 400
+    assert not any(
+        p.name.startswith("groupby.4")
+        for p in (slideDir / ".tissuumaps" / "markers.csv.columns").iterdir()
+    )
@@ -0,0 +1,85 @@
+import json
+
+import numpy as np
+import pytest
+
+from tissuumaps import labelregions
+
+from conftest import save_pyramid
+
+
+@pytest.fixture(scope="module")
+def shapes(slideDir):
+    """Label 1 is a square with a hole, label 2 two separate squares."""
+    labels = np.zeros((100, 150), dtype=np.uint16)
+    labels[10:90, 10:90] = 1
+    labels[30:70, 30:70] = 0
+    labels[10:30, 100:120] = 2
+    labels[60:80, 100:140] = 2
+    save_pyramid(labels, slideDir / "shapes.tif")
+    return str(slideDir / "shapes.tif")
+
+
+def _area(ring):
+    ring = np.asarray(ring, dtype=np.float64)
+    x, y = ring[:, 0], ring[:, 1]
+    return abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+
+
+def _bounds(feature):
+    points = np.concatenate(
+        [np.asarray(ring) for polygon in feature["geometry"]["coordinates"] for ring in polygon]
+    )
+    return tuple(points.min(axis=0).tolist() + points.max(axis=0).tolist())
+
+
+def test_label_image_regions(client):
+    resp = client.get("/labels.tif.dzi/regions.geojson")
+    assert resp.status_code == 200
+    features = json.loads(resp.data)["features"]
+    assert [f["properties"]["name"] for f in features] == [str(i) for i in range(1, 13)]
+    for index, feature in enumerate(features):
+        row, col = divmod(index, 4)
+        x0, y0 = col * 250 + 50, row * 200 + 50
+        assert _bounds(feature) == (x0, y0, x0 + 100, y0 + 100)
+        (polygon,) = feature["geometry"]["coordinates"]
+        assert len(polygon) == 1 and _area(polygon[0]) == 100 * 100
+
+
+def test_holes_and_separate_parts(shapes):
+    features = dict(
+        (f["properties"]["name"], f["geometry"]["coordinates"])
+        for f in labelregions.label_regions(shapes)
+    )
+    (donut,) = features["1"]
+    assert len(donut) == 2
+    assert sorted(_area(ring) for ring in donut) == [40 * 40, 80 * 80]
+    parts = features["2"]
+    assert len(parts) == 2
+    assert sorted(_area(polygon[0]) for polygon in parts) == [20 * 20, 20 * 40]
+
+
+def test_tiles_do_not_change_the_regions(shapes):
+    def summary(tileSize):
+        result = []
+        for feature in labelregions.label_regions(shapes, tileSize=tileSize):
+            rings = [r for polygon in feature["geometry"]["coordinates"] for r in polygon]
+            result.append(
+                (feature["properties"]["name"], _bounds(feature), sorted(map(_area, rings)))
+            )
+        return result
+
+    # Tiles of 32 pixels split every label
+    assert summary(32) == summary(labelregions.TILE_SIZE)
+
+
+def test_simplify_ring_keeps_corners():
+    ring = np.array([[0, 0], [5, 0], [10, 0], [10, 10], [0, 10], [0, 0]], dtype=float)
+    simplified = labelregions.simplify_ring(ring, 1.0)
+    assert [5, 0] not in np.asarray(simplified).tolist()
+    assert _area(simplified) == 100
+
+
+def test_bad_requests(client, shapes):
+    assert client.get("/shapes.tif.dzi/regions.geojson?tolerance=a").status_code == 400
+    assert client.get("/nothing.tif.dzi/regions.geojson").status_code == 404
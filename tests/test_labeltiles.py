@@ -0,0 +1,93 @@
+import io
+import json
+from urllib.parse import quote
+
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+
+from tissuumaps import labeltiles, markertiles
+
+
+@pytest.fixture(scope="module")
+def cellTable(slideDir):
+    # Cell 5 is not in the table
+    cells = [c for c in range(1, 13) if c != 5]
+    pd.DataFrame(
+        {"cell": cells, "type": ["T" if c % 2 else "B" for c in cells]}
+    ).to_csv(slideDir / "cells.csv", index=False)
+    return "cells.csv"
+
+
+def _tile(client, query="", level=10, col=0, row=0):
+    resp = client.get("/labels.tif_files/%d/%d_%d.png?mode=labels%s" % (level, col, row, query))
+    assert resp.status_code == 200
+    return np.asarray(Image.open(io.BytesIO(resp.data)))
+
+
+def test_random_colours_follow_the_labels(client, slideDir):
+    labels = np.load(slideDir / "labels.npy")
+    tile = _tile(client)
+    # The first tile has an overlap on its right and bottom sides
+    height, width = tile.shape[:2]
+    assert (height, width) == (255, 255)
+    assert (tile == labeltiles.random_colors(labels[:height, :width])).all()
+
+
+def test_colours_from_a_marker_file(client, slideDir, cellTable):
+    colors = quote(json.dumps({"T": "#ff0000"}))
+    tile = _tile(
+        client, "&markers=%s&cell=cell&category=type&colors=%s" % (cellTable, colors)
+    )
+    # Cell 1 at (50, 50) is a T cell, cell 2 at (300, 50) a B cell
+    assert tuple(tile[100, 100]) == (255, 0, 0, 255)
+    assert tuple(tile[0, 0]) == (0, 0, 0, 0)
+    tile = _tile(
+        client, "&markers=%s&cell=cell&category=type&colors=%s" % (cellTable, colors), col=1
+    )
+    assert tuple(tile[100, 300 - 253]) == tuple(markertiles.deterministic_color("B") + [255])
+    # Cell 5, at (50, 250), is not in the table
+    tile = _tile(
+        client, "&markers=%s&cell=cell&category=type" % cellTable, row=1
+    )
+    assert tuple(tile[300 - 253, 100]) == (0, 0, 0, 0)
+
+
+def test_labels_are_never_averaged(client, slideDir):
+    labels = np.unique(np.load(slideDir / "labels.npy"))
+    for downsample in labeltiles.DOWNSAMPLING:
+        tile = _tile(client, "&downsample=" + downsample, level=8)
+        colors = labeltiles.random_colors(labels)
+        assert set(map(tuple, tile.reshape(-1, 4))) <= set(map(tuple, colors))
+
+
+def test_block_mode():
+    # The bottom right block is a tie, won by the smallest label
+    labels = np.array([[1, 1, 2, 2], [1, 3, 2, 3], [0, 0, 5, 4], [0, 4, 6, 7]])
+    assert labeltiles._block_mode(labels, 2).tolist() == [[1, 2], [0, 4]]
+
+
+def test_sparse_cell_ids():
+    class Table(object):
+        def numeric(self, name):
+            return np.array([3.0, 10.0 ** 9, np.nan])
+
+    class MarkerFile(object):
+        table = Table()
+
+        def key_codes(self, name):
+            return ["#00ff00", "#0000ff", ""], np.array([0, 1, 2])
+
+    colors = labeltiles.LabelColors(MarkerFile(), "cell", "color")
+    assert colors.dense is None
+    rgba = colors(np.array([[3, 10 ** 9, 4]]))
+    assert rgba[0].tolist() == [[0, 255, 0, 255], [0, 0, 255, 255], [0, 0, 0, 0]]
+
+
+def test_bad_requests(client, cellTable):
+    url = "/labels.tif_files/10/0_0.png?mode=labels"
+    assert client.get(url + "&downsample=mean").status_code == 400
+    assert client.get(url + "&markers=%s&category=type&colors={" % cellTable).status_code == 400
+    assert client.get(url + "&markers=%s&category=nothing" % cellTable).status_code == 404
+    assert client.get("/labels.tif_files/10/9_0.png?mode=labels").status_code == 404
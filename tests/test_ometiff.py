@@ -0,0 +1,152 @@
+import io
+
+import numpy as np
+import pytest
+import pyvips
+from PIL import Image
+
+from tissuumaps import ometiff
+from tissuumaps.pyramid import percentile_window
+
+OME_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06">%s</OME>'
+)
+IMAGE_XML = (
+    '<Image ID="Image:%(index)d" Name="%(name)s">'
+    '<Pixels ID="Pixels:%(index)d" DimensionOrder="%(order)s" Type="uint16" '
+    'SizeX="%(width)d" SizeY="%(height)d" SizeC="%(channels)d" SizeZ="%(z)d" '
+    'SizeT="1" PhysicalSizeX="0.5">%(content)s</Pixels></Image>'
+)
+CHANNELS = ["DAPI", "CD3", "CD8"]
+WIDTH, HEIGHT = 400, 300
+
+
+def _image_xml(
+    index=0,
+    name="tissue",
+    order="XYCZT",
+    channels=CHANNELS,
+    z=1,
+    content=None,
+    width=WIDTH,
+    height=HEIGHT,
+):
+    if content is None:
+        content = "".join(
+            '<Channel ID="Channel:%d:%d" Name="%s"/>' % (index, c, n)
+            for c, n in enumerate(channels)
+        )
+    return IMAGE_XML % dict(
+        index=index,
+        name=name,
+        order=order,
+        width=width,
+        height=height,
+        channels=len(channels),
+        z=z,
+        content=content,
+    )
+
+
+def _planes():
+    yy, xx = np.mgrid[0:HEIGHT, 0:WIDTH]
+    return [
+        ((xx * 7 + yy * 3 + c * 1000) % 4000 * (c + 1)).astype(np.uint16) for c in range(3)
+    ]
+
+
+@pytest.fixture(scope="module")
+def omeFile(slideDir):
+    """Three uint16 channels, one page each, with SubIFD pyramid levels."""
+    planes = np.concatenate(_planes())
+    image = pyvips.Image.new_from_memory(
+        np.ascontiguousarray(planes).data, WIDTH, 3 * HEIGHT, 1, "ushort"
+    ).copy()
+    image.set_type(pyvips.GValue.gint_type, "page-height", HEIGHT)
+    image.set_type(pyvips.GValue.gstr_type, "image-description", OME_XML % _image_xml())
+    image.tiffsave(
+        str(slideDir / "multi.ome.tif"),
+        tile=True,
+        pyramid=True,
+        subifd=True,
+        tile_width=128,
+        tile_height=128,
+    )
+    return "multi.ome.tif"
+
+
+def _tile(client, url):
+    resp = client.get(url)
+    assert resp.status_code == 200
+    return np.asarray(Image.open(io.BytesIO(resp.data)).convert("L")).astype(int)
+
+
+def test_layers(client, omeFile):
+    layers = client.get("/%s.dzi/layers" % omeFile).get_json()["layers"]
+    assert [l["name"] for l in layers] == ["tissue - %s" % c for c in CHANNELS]
+    assert [l["tileSource"] for l in layers] == [
+        "/%s/s0/c%d.dzi" % (omeFile, c) for c in range(3)
+    ]
+    dzi = client.get(layers[1]["tileSource"])
+    assert dzi.status_code == 200
+    assert b'Width="400"' in dzi.data
+
+
+def test_channel_tiles_are_windowed(client, omeFile):
+    plane = _planes()[1]
+    low, high = percentile_window(plane)
+    expected = np.clip((plane[:255, :255] - low) * (255.0 / (high - low)), 0, 255)
+    tile = _tile(client, "/%s/s0/c1_files/9/0_0.png" % omeFile)
+    assert np.abs(tile - expected).max() <= 1
+    # The first channel is also the image itself
+    first = _tile(client, "/%s_files/9/0_0.png" % omeFile)
+    assert (first == _tile(client, "/%s/s0/c0_files/9/0_0.png" % omeFile)).all()
+    assert not (first == tile).all()
+
+
+def test_subifd_levels(slideDir, omeFile):
+    slide = ometiff.OMEPlaneSlide(str(slideDir / omeFile), 0, 2, 254, 1)
+    assert slide.levelSizes[:3] == [(400, 300), (200, 150), (100, 75)]
+    assert slide.mpp == 0.5
+    assert slide.properties["ome.channel"] == "CD8"
+    low, high = slide.window
+    expected = _planes()[2].reshape(150, 2, 200, 2).mean(axis=(1, 3))
+    expected = np.clip((expected - low) * (255.0 / (high - low)), 0, 255)
+    tile = np.asarray(slide.get_tile(8, (0, 0)).convert("L")).astype(int)
+    assert tile.shape == (150, 200)
+    assert np.abs(tile - expected).max() <= 2
+
+
+def test_parse_ome_xml_follows_tiff_data():
+    first = _image_xml(
+        0,
+        "a",
+        content='<Channel Name="x"/><Channel Name="y"/>'
+        '<TiffData FirstC="0" IFD="3" PlaneCount="1"/>'
+        '<TiffData FirstC="1" IFD="5" PlaneCount="1"/>',
+        channels=["x", "y"],
+    )
+    # Z before C: channel 1 of the second series is its third plane
+    second = _image_xml(1, "b", order="XYZCT", channels=["p", "q"], z=2, width=20, height=10)
+    series = ometiff.parse_ome_xml(OME_XML % (first + second), 10)
+    assert [s["name"] for s in series] == ["a", "b"]
+    assert series[0]["ifds"] == [3, 5]
+    assert series[1]["ifds"] == [6, 8]
+    assert (series[1]["width"], series[1]["height"]) == (20, 10)
+    assert series[0]["mpp"] == 0.5
+    # Planes in other files of a dataset are left out
+    series = ometiff.parse_ome_xml(OME_XML % (first + second), 7)
+    assert series[1]["ifds"] == [6, None]
+
+
+def test_layer_paths():
+    assert ometiff.split_layer_path("a/b.ome.tif/s1/c2") == ("a/b.ome.tif", 1, 2)
+    assert ometiff.split_layer_path("a/b.tif/s1/c2") is None
+    assert ometiff.source_path("b.ome.tiff/s0/c0") == "b.ome.tiff"
+
+
+def test_missing_channels(client, omeFile):
+    assert client.get("/%s/s0/c3.dzi" % omeFile).status_code == 404
+    assert client.get("/%s/s1/c0.dzi" % omeFile).status_code == 404
+    assert client.get("/%s/s0/c0_files/10/0_0.png" % omeFile).status_code == 404
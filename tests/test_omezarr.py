@@ -0,0 +1,140 @@
+import io
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from tissuumaps import omezarr
+
+zarr = pytest.importorskip("zarr")
+
+WIDTH, HEIGHT = 400, 300
+CHANNELS = ["DAPI", "CD3"]
+
+
+def _planes(offset=0):
+    yy, xx = np.mgrid[0:HEIGHT, 0:WIDTH]
+    return np.stack(
+        [((xx * 7 + yy * 3 + c * 1000 + offset) % 4000).astype(np.uint16) for c in range(2)]
+    )
+
+
+def _write_image(group, planes, name="tissue"):
+    axes = [
+        {"name": "c", "type": "channel"},
+        {"name": "y", "type": "space", "unit": "micrometer"},
+        {"name": "x", "type": "space", "unit": "micrometer"},
+    ]
+    group.create_array("0", data=planes, chunks=(1, 64, 64))
+    group.create_array("1", data=planes[:, ::2, ::2], chunks=(1, 64, 64))
+    group.attrs["multiscales"] = [
+        {
+            "version": "0.4",
+            "name": name,
+            "axes": axes,
+            "datasets": [
+                {"path": str(i), "coordinateTransformations": [{"type": "scale", "scale": [1, s, s]}]}
+                for i, s in enumerate([0.5, 1.0])
+            ],
+        }
+    ]
+    group.attrs["omero"] = {
+        "channels": [
+            {"label": CHANNELS[0], "window": {"start": 0, "end": 4000}},
+            {"label": CHANNELS[1]},
+        ]
+    }
+
+
+def _write_store(path, offset=0):
+    root = zarr.open_group(str(path), mode="w", zarr_format=2)
+    _write_image(root, _planes(offset))
+
+
+@pytest.fixture(scope="module")
+def zarrImage(slideDir):
+    _write_store(slideDir / "image.zarr")
+    return "image.zarr"
+
+
+def _tile(client, url):
+    resp = client.get(url)
+    assert resp.status_code == 200
+    return np.asarray(Image.open(io.BytesIO(resp.data)).convert("L")).astype(int)
+
+
+def test_layers(client, zarrImage):
+    layers = client.get("/%s.dzi/layers" % zarrImage).get_json()["layers"]
+    assert [l["name"] for l in layers] == ["tissue - %s" % c for c in CHANNELS]
+    assert [l["tileSource"] for l in layers] == [
+        "/%s/s0/c%d.dzi" % (zarrImage, c) for c in range(2)
+    ]
+    dzi = client.get(layers[1]["tileSource"])
+    assert dzi.status_code == 200
+    assert b'Width="400"' in dzi.data and b'Height="300"' in dzi.data
+
+
+def test_tiles_follow_the_omero_window(client, zarrImage):
+    plane = _planes()[0]
+    expected = np.clip(plane[:255, 253:] * (255.0 / 4000), 0, 255)
+    tile = _tile(client, "/%s/s0/c0_files/9/1_0.png" % zarrImage)
+    assert tile.shape == (255, WIDTH - 253)
+    assert np.abs(tile - expected).max() <= 1
+    # The image itself is its first channel
+    assert (tile == _tile(client, "/%s_files/9/1_0.png" % zarrImage)).all()
+
+
+def test_lower_levels_read_the_multiscale_datasets(slideDir, zarrImage):
+    slide = omezarr.ZarrSlide(str(slideDir / zarrImage), 0, 1, 254, 1)
+    assert slide.levelSizes == [(400, 300), (200, 150)]
+    assert slide.mpp == 0.5
+    assert slide.properties["zarr.channel"] == "CD3"
+    low, high = slide.window
+    expected = _planes()[1][::2, ::2]
+    expected = np.clip((expected - low) * (255.0 / (high - low)), 0, 255)
+    tile = np.asarray(slide.get_tile(8, (0, 0)).convert("L")).astype(int)
+    assert tile.shape == (150, 200)
+    assert np.abs(tile - expected).max() <= 1
+
+
+def test_bioformats2raw_series(slideDir):
+    root = zarr.open_group(str(slideDir / "series.zarr"), mode="w", zarr_format=2)
+    _write_image(root.create_group("0"), _planes())
+    _write_image(root.create_group("1"), _planes(500)[:, :100, :200])
+    image = omezarr.OMEZarr(str(slideDir / "series.zarr"))
+    assert [s["name"] for s in image.series] == ["tissue", "tissue"]
+    assert [(l["series"], l["channel"], l["width"]) for l in image.layers()] == [
+        (0, 0, 400),
+        (0, 1, 400),
+        (1, 0, 200),
+        (1, 1, 200),
+    ]
+
+
+def test_rewritten_stores_are_reloaded(client, slideDir):
+    path = slideDir / "changing.zarr"
+    _write_store(path)
+    url = "/changing.zarr/s0/c0_files/9/0_0.png"
+    before = _tile(client, url)
+    _write_store(path, offset=2000)
+    # Make sure the metadata times change, whatever the file system resolution
+    for name in [".zattrs", ".zgroup"]:
+        stat = os.stat(path / name)
+        os.utime(path / name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    after = _tile(client, url)
+    expected = np.clip(_planes(2000)[0][:255, :255] * (255.0 / 4000), 0, 255)
+    assert not (before == after).all()
+    assert np.abs(after - expected).max() <= 1
+
+
+def test_layer_paths():
+    assert omezarr.split_layer_path("a/b.zarr/s1/c2") == ("a/b.zarr", 1, 2)
+    assert omezarr.split_layer_path("a/b.tif/s1/c2") is None
+    assert omezarr.source_path("b.zarr/s0/c0") == "b.zarr"
+
+
+def test_missing_channels(client, zarrImage):
+    assert client.get("/%s/s0/c2.dzi" % zarrImage).status_code == 404
+    assert client.get("/%s/s1/c0.dzi" % zarrImage).status_code == 404
+    assert client.get("/%s/s0/c0_files/10/0_0.png" % zarrImage).status_code == 404
@@ -0,0 +1,176 @@
+import threading
+import time
+import types
+
+import numpy as np
+import pytest
+from openslide import OpenSlide
+
+from tissuumaps import app, pluginhost, views
+from tissuumaps.pluginhost import PluginHost
+
+from conftest import IMAGE_HEIGHT, IMAGE_WIDTH
+
+
+class Plugin(object):
+    instances = 0
+
+    def __init__(self, app):
+        Plugin.instances += 1
+        self.app = app
+
+
+def _load(name):
+    if name != "counter":
+        raise ImportError("No plugin %s" % name)
+    return types.SimpleNamespace(Plugin=Plugin)
+
+
+@pytest.fixture
+def host():
+    return PluginHost(app, _load, 1, 1000)
+
+
+def _wait(client, url):
+    for _ in range(200):
+        status = client.get(url).get_json()
+        if status["state"] != "running":
+            return status
+        time.sleep(0.05)
+    raise AssertionError("Job still running")
+
+
+def test_instances_are_kept(host):
+    Plugin.instances = 0
+    assert host.context("counter", create=False) is None
+    instance = host.get("counter")
+    assert host.get("counter") is instance
+    assert Plugin.instances == 1
+    assert instance.host is host.context("counter", create=False)
+    assert instance.host.name == "counter"
+    with pytest.raises(ImportError):
+        host.get("nothing")
+    assert host.context("nothing", create=False) is None
+
+
+def test_jobs(host):
+    context = host.context("counter")
+    release = threading.Event()
+
+    def work(job, value, factor=1):
+        job.set_progress(0.5, "half")
+        release.wait(10)
+        return value * factor
+
+    def fail(job):
+        raise ValueError("broken")
+
+    job = context.submit(work, 3, factor=2)
+    # One thread: the next jobs wait for the first
+    failing = context.submit(fail)
+    cancelled = context.submit(work, 0)
+    for _ in range(200):
+        if job.progress:
+            break
+        time.sleep(0.01)
+    assert job.status() == {
+        "id": job.id,
+        "name": "work",
+        "progress": 0.5,
+        "message": "half",
+        "state": "running",
+    }
+    assert cancelled.cancel()
+    release.set()
+    assert job.result(10) == 6
+    assert job.status()["state"] == "done" and job.status()["result"] == 6
+    with pytest.raises(ValueError):
+        failing.result(10)
+    assert failing.status()["state"] == "failed"
+    assert failing.status()["message"] == "broken"
+    assert cancelled.status()["state"] == "cancelled"
+    assert context.job(job.id) is job
+    assert context.job("nothing") is None
+    assert context.jobs() == [job, failing, cancelled]
+
+
+def test_finished_jobs_are_dropped(host, monkeypatch):
+    monkeypatch.setattr(pluginhost, "MAX_FINISHED_JOBS", 2)
+    context = host.context("counter")
+    jobs = []
+    for index in range(4):
+        jobs.append(context.submit(lambda job: None))
+        jobs[-1].result(10)
+    assert context.job(jobs[0].id) is None
+    assert context.jobs()[-2:] == jobs[-2:]
+    assert len(context.jobs()) <= 3
+
+
+def test_caches_are_bounded_in_bytes(host):
+    cache = host.context("counter").cache
+    cache.put("bytes", b"x" * 600)
+    cache.put("array", np.zeros(100, dtype=np.uint8))
+    assert cache.get("bytes") == b"x" * 600
+    assert cache.get("array") is not None
+    # The least recently used values make room
+    cache.put("more", b"y" * 600)
+    assert cache.get("bytes") is None
+    assert cache.get("array") is not None
+    assert host.context("other").cache.get("array") is None
+
+
+def test_binary_responses():
+    with app.test_request_context():
+        resp = views._plugin_response(b"\x00\x01")
+        assert resp.mimetype == "application/octet-stream"
+        assert resp.get_data() == b"\x00\x01"
+        resp = views._plugin_response(chunk for chunk in [b"a", b"b"])
+        assert resp.is_streamed
+        assert resp.get_data() == b"ab"
+        assert views._plugin_response({"a": 1}) == {"a": 1}
+
+
+def test_bake_job(client, slideDir, pluginsAvailable):
+    resp = client.post(
+        "/plugins/transform/bake",
+        json={"path": "/image.tif.dzi", "matrix": [1, 0, 0, 1, 10, 0], "outputSuffix": "_baked"},
+    )
+    assert resp.status_code == 200
+    data = resp.get_json()
+    assert data["image"] == "/image_baked.tif"
+    status = _wait(client, "/plugins/transform/jobs/" + data["job"])
+    assert status["state"] == "done"
+    assert status["result"] == {"image": "/image_baked.tif"}
+    assert status["progress"] == 1.0
+    with OpenSlide(str(slideDir / "image_baked.tif")) as slide:
+        assert slide.dimensions == (IMAGE_WIDTH + 10, IMAGE_HEIGHT)
+    # Transforms of affine layers are their own
+    resp = client.post(
+        "/plugins/transform/bake",
+        json={"path": "/image.tif/affine/2,0,0,2,0,0.dzi", "outputSuffix": "_double"},
+    )
+    status = _wait(client, "/plugins/transform/jobs/" + resp.get_json()["job"])
+    assert status["result"] == {"image": "/image_double.tif"}
+
+
+def test_bad_requests(client, pluginsAvailable):
+    for content in [
+        {"path": "/image.tif.dzi"},
+        {"path": "/image.tif.dzi", "matrix": [1, 2, 2, 4, 0, 0]},
+        {"path": "/image.tif.dzi", "matrix": "a,b"},
+        {"path": "/image.tif.dzi", "matrix": [1, 0, 0, 1, 0, 0], "outputSuffix": "/../../x"},
+    ]:
+        assert client.post("/plugins/transform/bake", json=content).status_code == 400, content
+    content = {"path": "/../image.tif.dzi", "matrix": [1, 0, 0, 1, 0, 0]}
+    assert client.post("/plugins/transform/bake", json=content).status_code == 404
+    content = {"path": "/nothing.tif.dzi", "matrix": [1, 0, 0, 1, 0, 0]}
+    assert client.post("/plugins/transform/bake", json=content).status_code == 404
+
+
+def test_only_plugin_methods_are_served(client, pluginsAvailable):
+    for method in ["host", "app", "_get_slide", "nothing"]:
+        assert client.get("/plugins/transform/" + method).status_code == 404, method
+    assert client.get("/plugins/transform/jobs/nothing").status_code == 404
+    assert client.get("/plugins/nothing/bake").status_code == 404
+    assert client.get("/plugins/nothing/jobs/nothing").status_code == 404
+    assert app.pluginHost.context("nothing", create=False) is None
@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+import pytest
+
+from tissuumaps import app, markerstats
+
+from conftest import MARKER_COUNT, markers_frame
+
+
+def _columns(profile):
+    return dict((column["name"], column) for column in profile["columns"])
+
+
+def test_profile_matches_pandas(client):
+    resp = client.get("/markers.csv/profile")
+    assert resp.status_code == 200
+    profile = resp.get_json()
+    assert profile["nrows"] == MARKER_COUNT
+    columns = _columns(profile)
+    frame = markers_frame()
+    x = columns["x"]
+    assert x["type"] == "numeric"
+    assert (x["count"], x["missing"]) == (MARKER_COUNT, 0)
+    assert x["min"] == pytest.approx(frame["x"].min())
+    assert x["max"] == pytest.approx(frame["x"].max())
+    assert x["mean"] == pytest.approx(frame["x"].mean())
+    assert x["quantiles"]["0.5"] == pytest.approx(np.quantile(frame["x"], 0.5))
+    assert x["distinct"] is None and "values" not in x
+    gene = columns["gene"]
+    assert gene["type"] == "text"
+    assert gene["distinct"] == 4
+    assert dict((v["value"], v["count"]) for v in gene["values"]) == (
+        frame["gene"].value_counts().to_dict()
+    )
+    cl = columns["cl"]
+    assert cl["type"] == "integer"
+    assert dict((v["value"], v["count"]) for v in cl["values"]) == dict(
+        (str(k), v) for k, v in frame["cl"].value_counts().items()
+    )
+
+
+def test_profile_does_not_depend_on_chunks(client, monkeypatch):
+    table = app.markerCache.get(os.path.join(app.basedir, "markers.csv")).table
+    whole = markerstats.build_profile(table)
+    monkeypatch.setattr(markerstats, "CSV_CHUNK_ROWS", 7)
+    chunked = markerstats.build_profile(table)
+    for column, expected in zip(chunked["columns"], whole["columns"]):
+        # Sums of chunks only differ by rounding
+        assert column.pop("mean", None) == pytest.approx(expected.pop("mean", None))
+    assert chunked == whole
+
+
+def test_column_selection(client):
+    profile = client.get("/markers.csv/profile?column=gene&column=x").get_json()
+    assert [c["name"] for c in profile["columns"]] == ["x", "gene"]
+    assert client.get("/markers.csv/profile?column=nothing").status_code == 404
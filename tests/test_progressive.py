@@ -0,0 +1,57 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+from tissuumaps import markers
+
+from conftest import IMAGE_HEIGHT, IMAGE_WIDTH, MARKER_COUNT, markers_frame
+
+
+def _csv(resp):
+    assert resp.status_code == 200
+    return pd.read_csv(io.BytesIO(resp.data))
+
+
+def test_full_read_is_a_permutation(client):
+    rows = _csv(client.get("/markers.csv/progressive?rowIndex=1"))
+    assert sorted(rows["_row"]) == list(range(MARKER_COUNT))
+    frame = markers_frame().iloc[rows["_row"]]
+    assert np.allclose(rows["x"], frame["x"])
+    assert (rows["gene"].to_numpy() == frame["gene"].to_numpy()).all()
+
+
+def test_ranges_and_headers(client):
+    resp = client.get("/markers.csv/progressive?start=100&stop=250&column=x&rowIndex=1")
+    assert resp.headers["X-Total-Count"] == str(MARKER_COUNT)
+    assert resp.headers["X-Record-Count"] == "150"
+    assert resp.headers["X-Record-Range"] == "100-250"
+    rows = _csv(resp)
+    assert list(rows.columns) == ["x", "_row"]
+    full = _csv(client.get("/markers.csv/progressive?rowIndex=1"))
+    assert (rows["_row"] == full["_row"].iloc[100:250].to_numpy()).all()
+    resp = client.get("/markers.csv/progressive?start=%d" % (MARKER_COUNT + 5))
+    assert resp.headers["X-Record-Count"] == "0"
+
+
+def test_prefixes_are_spatially_uniform(client):
+    rows = _csv(client.get("/markers.csv/progressive?stop=400"))
+    quadrants = np.bincount(
+        (rows["x"] >= IMAGE_WIDTH / 2) * 2 + (rows["y"] >= IMAGE_HEIGHT / 2),
+        minlength=4,
+    )
+    assert quadrants.min() > 70 and quadrants.max() < 130
+
+
+def test_stratified_order_interleaves_cells():
+    cellIds = np.repeat([0, 1], [10, 30])
+    order = markers._stratified_order(cellIds)
+    assert sorted(order) == list(range(40))
+    # Every prefix of 8 rows holds about one row of cell 0 for three of cell 1
+    assert (cellIds[order[:8]] == 0).sum() == 2
+
+
+def test_bad_requests(client):
+    assert client.get("/markers.csv/progressive?start=a").status_code == 400
+    assert client.get("/markers.csv/progressive?column=nothing").status_code == 404
+    assert client.get("/markers.csv/progressive?X=nothing").status_code == 404
@@ -0,0 +1,81 @@
+import gzip
+import os
+
+
+def _body(slideDir):
+    with open(slideDir / "markers.csv", "rb") as f:
+        return f.read()
+
+
+def test_full_response_accepts_ranges(client, slideDir):
+    resp = client.get("/markers.csv")
+    assert resp.status_code == 200
+    assert resp.headers["Accept-Ranges"] == "bytes"
+    assert resp.data == _body(slideDir)
+
+
+def test_single_range(client, slideDir):
+    body = _body(slideDir)
+    resp = client.get("/markers.csv", headers={"Range": "bytes=10-19"})
+    assert resp.status_code == 206
+    assert resp.headers["Content-Range"] == "bytes 10-19/%d" % len(body)
+    assert resp.data == body[10:20]
+
+
+def test_open_and_suffix_ranges(client, slideDir):
+    body = _body(slideDir)
+    resp = client.get("/markers.csv", headers={"Range": "bytes=%d-" % (len(body) - 5)})
+    assert resp.status_code == 206
+    assert resp.data == body[-5:]
+    resp = client.get("/markers.csv", headers={"Range": "bytes=-7"})
+    assert resp.status_code == 206
+    assert resp.data == body[-7:]
+
+
+def test_multiple_ranges(client, slideDir):
+    body = _body(slideDir)
+    resp = client.get("/markers.csv", headers={"Range": "bytes=0-4,100-109"})
+    assert resp.status_code == 206
+    assert resp.mimetype == "multipart/byteranges"
+    assert body[0:5] in resp.data
+    assert body[100:110] in resp.data
+
+
+def test_unsatisfiable_range(client, slideDir):
+    size = len(_body(slideDir))
+    resp = client.get("/markers.csv", headers={"Range": "bytes=%d-" % (size + 10)})
+    assert resp.status_code == 416
+    assert resp.headers["Content-Range"] == "bytes */%d" % size
+
+
+def test_malformed_range_sends_everything(client, slideDir):
+    resp = client.get("/markers.csv", headers={"Range": "bytes=9-2"})
+    assert resp.status_code == 200
+    assert resp.data == _body(slideDir)
+
+
+def test_conditional_requests(client, slideDir):
+    etag = client.get("/markers.csv").headers["ETag"]
+    assert client.get("/markers.csv", headers={"If-None-Match": etag}).status_code == 304
+    # A stale If-Range sends the whole file again
+    resp = client.get(
+        "/markers.csv", headers={"Range": "bytes=0-9", "If-Range": '"stale"'}
+    )
+    assert resp.status_code == 200
+    resp = client.get("/markers.csv", headers={"Range": "bytes=0-9", "If-Range": etag})
+    assert resp.status_code == 206
+
+
+def test_precompressed_variant(client, slideDir):
+    body = _body(slideDir)
+    with open(slideDir / "markers.csv.gz", "wb") as f:
+        f.write(gzip.compress(body))
+    try:
+        resp = client.get("/markers.csv", headers={"Accept-Encoding": "gzip"})
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(resp.data) == body
+        resp = client.get("/markers.csv")
+        assert "Content-Encoding" not in resp.headers
+        assert resp.data == body
+    finally:
+        os.remove(slideDir / "markers.csv.gz")
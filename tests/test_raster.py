@@ -0,0 +1,83 @@
+import io
+
+import numpy as np
+from PIL import Image
+
+from tissuumaps import markertiles
+
+from conftest import IMAGE_HEIGHT, IMAGE_WIDTH, markers_frame
+
+SPEC = {
+    "expectedHeader": {"X": "x", "Y": "y", "gb_col": "gene"},
+    "expectedRadios": {},
+    "width": IMAGE_WIDTH,
+    "height": IMAGE_HEIGHT,
+    "markerSize": 6,
+    "colors": {"A": "#ff0000"},
+    "keys": ["A"],
+}
+
+
+def _tile(client, tileSource, level, col, row):
+    resp = client.get(tileSource.replace(".dzi", "_files/%d/%d_%d.png" % (level, col, row)))
+    assert resp.status_code == 200
+    return np.asarray(Image.open(io.BytesIO(resp.data)))
+
+
+def test_raster_tiles_draw_the_visible_keys(client):
+    resp = client.post("/markers.csv/raster", json=SPEC)
+    assert resp.status_code == 200
+    tileSource = resp.get_json()["tileSource"]
+    dzi = client.get(tileSource)
+    assert dzi.status_code == 200
+    assert b'Width="%d"' % IMAGE_WIDTH in dzi.data
+    # The full resolution level of a 1000 pixels wide image is 10
+    tile = _tile(client, tileSource, 10, 0, 0)
+    colors = set(map(tuple, tile.reshape(-1, 4)))
+    assert colors == {(0, 0, 0, 0), (255, 0, 0, 255)}
+    frame = markers_frame()
+    visible = frame[(frame["gene"] == "A") & (frame["x"] < 250) & (frame["y"] < 250)]
+    for x, y in zip(visible["x"], visible["y"]):
+        assert tuple(tile[int(y), int(x)]) == (255, 0, 0, 255)
+    assert _tile(client, tileSource, 0, 0, 0).shape[:2] == (1, 1)
+
+
+def test_spec_ids_are_stable(client):
+    first = client.post("/markers.csv/raster", json=SPEC).get_json()
+    second = client.post("/markers.csv/raster", json=dict(SPEC)).get_json()
+    assert first == second
+
+
+def test_check_spec_converts_sizes():
+    spec = markertiles.check_spec({"width": 10.2, "height": "7", "range": [0, "1"]})
+    assert (spec["width"], spec["height"]) == (11, 7)
+    assert spec["range"] == [0.0, 1.0]
+    assert spec["expectedHeader"] == {} and spec["expectedRadios"] == {}
+
+
+def test_invalid_specs(client):
+    for spec in [
+        "abc",
+        [1],
+        {"width": "a", "height": 1},
+        {"width": 10 ** 12, "height": 1},
+        {"width": float("nan"), "height": 1},
+        {"width": True, "height": 1},
+        {"markerSize": -1},
+        {"keys": "A"},
+        {"colors": ["#ff0000"]},
+        {"range": [0]},
+        {"expectedHeader": []},
+    ]:
+        assert client.post("/markers.csv/raster", json=spec).status_code == 400, spec
+    resp = client.post(
+        "/markers.csv/raster", json={"expectedHeader": {"X": "nothing"}}
+    )
+    assert resp.status_code == 404
+
+
+def test_unknown_spec_and_tile(client):
+    assert client.get("/markers.csv/raster/0123456789abcdef.dzi").status_code == 404
+    tileSource = client.post("/markers.csv/raster", json=SPEC).get_json()["tileSource"]
+    resp = client.get(tileSource.replace(".dzi", "_files/10/40_0.png"))
+    assert resp.status_code == 404
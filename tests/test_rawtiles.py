@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+import pyvips
+
+from tissuumaps import rawtiles
+from tissuumaps.pyramid import VIPS_FORMATS
+
+from conftest import save_pyramid
+
+zstandard = pytest.importorskip("zstandard")
+
+
+@pytest.fixture(scope="module")
+def images(slideDir):
+    yy, xx = np.mgrid[0:300, 0:500]
+    deep = (xx * 100 + yy).astype(np.uint16)
+    save_pyramid(deep, slideDir / "deep.tif")
+    values = (xx / 7.0 - yy / 3.0).astype(np.float32)
+    save_pyramid(values, slideDir / "float.tif")
+    return {"deep": deep, "float": values}
+
+
+def _zst(resp):
+    assert resp.status_code == 200
+    shape = tuple(int(v) for v in resp.headers["X-Shape"].split(","))
+    dtype = np.dtype(resp.headers["X-Dtype"]).newbyteorder("<")
+    data = zstandard.ZstdDecompressor().decompress(resp.data)
+    return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+
+def test_info(client, images):
+    info = client.get("/deep.tif.dzi/raw").get_json()
+    assert (info["width"], info["height"], info["bands"]) == (500, 300, 1)
+    assert info["dtype"] == "uint16"
+    assert info["levels"] == 10
+    assert "zst" in info["formats"] and "png" in info["formats"]
+    low, high = info["window"][0]
+    assert images["deep"].min() <= low < high <= images["deep"].max()
+
+
+def test_full_resolution_tiles_keep_their_values(client, images):
+    tile = _zst(client.get("/deep.tif.dzi/raw/9/1_0.zst"))
+    # Tiles after the first have an overlap on their left side
+    assert tile.shape == (255, 500 - 253, 1)
+    assert (tile[:, :, 0] == images["deep"][:255, 253:]).all()
+    resp = client.get("/deep.tif.dzi/raw/9/0_0.png")
+    assert resp.mimetype == "image/png"
+    png = pyvips.Image.new_from_buffer(resp.data, "")
+    assert png.format == "ushort"
+    decoded = np.frombuffer(png.write_to_memory(), dtype=VIPS_FORMATS[png.format])
+    assert (decoded.reshape(255, 255) == images["deep"][:255, :255]).all()
+
+
+def test_float_images(client, images):
+    assert client.get("/float.tif.dzi/raw").get_json()["dtype"] == "float32"
+    tile = _zst(client.get("/float.tif.dzi/raw/9/0_1.zst"))
+    assert np.array_equal(tile[:, :, 0], images["float"][253:, :255])
+    # PNG can not hold floats
+    assert client.get("/float.tif.dzi/raw/9/0_0.png").status_code == 400
+
+
+def test_lower_levels_are_mean_reduced(client, images):
+    tile = _zst(client.get("/deep.tif.dzi/raw/8/0_0.zst"))
+    assert tile.shape == (150, 250, 1)
+    expected = images["deep"].reshape(150, 2, 250, 2).mean(axis=(1, 3))
+    assert np.abs(tile[:, :, 0] - expected).max() <= 1
+
+
+def test_encode_tile():
+    tile = np.arange(12, dtype=np.int32).reshape(2, 2, 3)
+    with pytest.raises(ValueError):
+        rawtiles.encode_tile(tile, "png")
+    with pytest.raises(ValueError):
+        rawtiles.encode_tile(tile, "tif")
+    data = zstandard.ZstdDecompressor().decompress(rawtiles.encode_tile(tile, "zst"))
+    assert (np.frombuffer(data, dtype="<i4").reshape(2, 2, 3) == tile).all()
+
+
+def test_invalid_tiles(client, images):
+    assert client.get("/deep.tif.dzi/raw/10/0_0.zst").status_code == 404
+    assert client.get("/deep.tif.dzi/raw/9/2_0.zst").status_code == 404
+    assert client.get("/nothing.tif.dzi/raw").status_code == 404
@@ -0,0 +1,88 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+from tissuumaps import regions
+
+from conftest import markers_frame
+
+
+def _rectangle(x0, y0, x1, y1):
+    return [[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]
+
+
+def _feature(name, regionClass, *rings):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "MultiPolygon", "coordinates": [list(rings)]},
+        "properties": {"name": name, "classification": {"name": regionClass}},
+    }
+
+
+REGIONS = {
+    "type": "FeatureCollection",
+    "features": [
+        _feature("left", "tissue", _rectangle(0, 0, 400, 700)),
+        _feature("centre", "tumour", _rectangle(300, 200, 650, 500)),
+    ],
+}
+
+
+def _inside(frame, x0, y0, x1, y1):
+    return frame[
+        (frame["x"] >= x0) & (frame["x"] < x1) & (frame["y"] >= y0) & (frame["y"] < y1)
+    ]
+
+
+def test_contains_follows_the_winding_rule():
+    # A square with a hole wound the other way
+    outer = _rectangle(0, 0, 10, 10)
+    hole = _rectangle(3, 3, 7, 7)[::-1]
+    region = regions.Region("r", "", [outer, hole])
+    inside = region.contains([1, 5, 11, 8], [1, 5, 5, 8])
+    assert inside.tolist() == [True, False, False, True]
+
+
+def test_load_regions_accepts_features_and_geometries():
+    loaded = regions.load_regions(
+        [REGIONS, {"type": "Polygon", "coordinates": [_rectangle(0, 0, 1, 1)]}]
+    )
+    assert [r.name for r in loaded] == ["left", "centre", "Region_3"]
+    assert [r.regionClass for r in loaded] == ["tissue", "tumour", ""]
+    assert loaded[1].bbox == (300, 200, 650, 500)
+
+
+def test_counts_match_pandas(client):
+    resp = client.post(
+        "/markers.csv/regions", json={"regions": REGIONS, "gb_col": "gene"}
+    )
+    assert resp.status_code == 200
+    data = resp.get_json()
+    frame = markers_frame()
+    for result, bounds in zip(data["regions"], [(0, 0, 400, 700), (300, 200, 650, 500)]):
+        expected = _inside(frame, *bounds)
+        assert result["total"] == len(expected)
+        assert result["counts"] == expected["gene"].value_counts().to_dict()
+    assert [r["class"] for r in data["regions"]] == ["tissue", "tumour"]
+
+
+def test_points_in_regions_csv(client):
+    resp = client.post(
+        "/markers.csv/regions",
+        json={"regions": REGIONS, "format": "csv", "columns": ["x", "y"]},
+    )
+    assert resp.status_code == 200
+    rows = pd.read_csv(io.StringIO(resp.get_data(as_text=True)))
+    assert list(rows.columns) == ["x", "y", "regionName", "regionClass"]
+    centre = rows[rows["regionName"] == "centre"]
+    expected = _inside(markers_frame(), 300, 200, 650, 500)
+    assert np.allclose(np.sort(centre["x"]), np.sort(expected["x"]))
+
+
+def test_bad_requests(client):
+    assert client.post("/markers.csv/regions", json={}).status_code == 400
+    resp = client.post(
+        "/markers.csv/regions", json={"regions": REGIONS, "gb_col": "nothing"}
+    )
+    assert resp.status_code == 404
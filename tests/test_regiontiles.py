@@ -0,0 +1,118 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from tissuumaps import regiontiles
+
+
+def _feature(name, x0, y0, x1, y1, **properties):
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [[[x0, y0], [x1, y0], [x1, y1], [x0, y1], [x0, y0]]],
+        },
+        "properties": dict(properties, name=name),
+    }
+
+
+def _write(path, features):
+    with open(path, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+
+
+@pytest.fixture(scope="module")
+def regionFile(slideDir):
+    _write(
+        slideDir / "regions.geojson",
+        [
+            _feature("a", 0, 0, 300, 300, color="#ff0000"),
+            _feature("b", 400, 100, 1000, 700),
+            _feature("tiny", 10, 10, 10.5, 10.5),
+        ],
+    )
+    return "/regions.geojson"
+
+
+def _decode_tile(data):
+    """Inverse of ``regiontiles.encode_tile``: ``{feature: [rings]}``."""
+    features, rings, points = np.frombuffer(data[:12], dtype="<u4")
+    offset = 12
+    ids = np.frombuffer(data, dtype="<u4", count=features, offset=offset)
+    offset += 4 * features
+    ringOffsets = np.frombuffer(data, dtype="<u4", count=features + 1, offset=offset)
+    offset += 4 * (features + 1)
+    pointOffsets = np.frombuffer(data, dtype="<u4", count=rings + 1, offset=offset)
+    offset += 4 * (rings + 1)
+    coordinates = np.frombuffer(data, dtype="<i2", count=2 * points, offset=offset)
+    assert offset + 4 * points == len(data)
+    coordinates = coordinates.reshape(-1, 2)
+    allRings = [
+        coordinates[pointOffsets[i] : pointOffsets[i + 1]] for i in range(rings)
+    ]
+    return dict(
+        (int(ids[i]), allRings[ringOffsets[i] : ringOffsets[i + 1]])
+        for i in range(features)
+    )
+
+
+def _tile(client, regionFile, level, col, row):
+    resp = client.get("%s/vtiles/%d/%d_%d.bin" % (regionFile, level, col, row))
+    assert resp.status_code == 200
+    return _decode_tile(resp.data)
+
+
+def test_info(client, regionFile):
+    info = client.get(regionFile + "/vtiles").get_json()
+    assert (info["width"], info["height"], info["maxLevel"]) == (1000, 700, 10)
+    assert [f["name"] for f in info["features"]] == ["a", "b", "tiny"]
+    assert info["features"][0]["color"] == "#ff0000"
+
+
+def test_full_resolution_tiles_are_clipped(client, regionFile):
+    q = regiontiles.QUANTIZATION
+    edge = (regiontiles.TILE_SIZE + regiontiles.CLIP_BUFFER) * q
+    tile = _tile(client, regionFile, 10, 0, 0)
+    # b starts right of the tile and tiny is smaller than a pixel
+    assert list(tile) == [0]
+    (ring,) = tile[0]
+    assert (ring[0] == ring[-1]).all()
+    assert ring.min(axis=0).tolist() == [0, 0]
+    assert ring.max(axis=0).tolist() == [edge, edge]
+    tile = _tile(client, regionFile, 10, 1, 0)
+    assert sorted(tile) == [0, 1]
+    assert tile[0][0].min(axis=0).tolist() == [-regiontiles.CLIP_BUFFER * q, 0]
+    assert tile[0][0].max(axis=0).tolist() == [(300 - 256) * q, edge]
+
+
+def test_lower_levels_are_scaled(client, regionFile):
+    q = regiontiles.QUANTIZATION
+    tile = _tile(client, regionFile, 8, 0, 0)
+    assert sorted(tile) == [0, 1]
+    assert tile[1][0].min(axis=0).tolist() == [100 * q, 25 * q]
+    assert tile[1][0].max(axis=0).tolist() == [250 * q, 175 * q]
+    # Both regions are smaller than a pixel at the top level
+    assert _tile(client, regionFile, 0, 0, 0) == {}
+
+
+def test_changed_files_are_reloaded(client, slideDir):
+    path = slideDir / "changing.geojson"
+    # The far region keeps 10 levels in both versions
+    far = _feature("far", 900, 600, 1000, 700)
+    _write(path, [_feature("a", 0, 0, 100, 100), far])
+    assert list(_tile(client, "/changing.geojson", 10, 0, 0)) == [0]
+    _write(path, [far, _feature("a", 0, 0, 100, 100)])
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert list(_tile(client, "/changing.geojson", 10, 0, 0)) == [1]
+    names = [f["name"] for f in client.get("/changing.geojson/vtiles").get_json()["features"]]
+    assert names == ["far", "a"]
+
+
+def test_invalid_tiles(client, regionFile):
+    for level, col, row in [(11, 0, 0), (10, 4, 0), (10, 0, 3), (0, 1, 0)]:
+        resp = client.get("%s/vtiles/%d/%d_%d.bin" % (regionFile, level, col, row))
+        assert resp.status_code == 404
+    assert client.get("/nothing.geojson/vtiles").status_code == 404
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from tissuumaps import registration
+
+from conftest import save_pyramid
+
+SHIFT = (35, 20)
+
+
+def _texture(height, width, seed=0):
+    noise = np.random.RandomState(seed).rand(height, width)
+    texture = ndimage.gaussian_filter(noise, 4)
+    texture = (texture - texture.min()) / (texture.max() - texture.min()) * 255
+    return np.repeat(texture.astype(np.uint8)[:, :, None], 3, axis=2)
+
+
+@pytest.fixture(scope="module")
+def layers(slideDir):
+    texture = _texture(700, 900)
+    save_pyramid(texture[:600, :800], slideDir / "fixed.tif")
+    # Moving pixel (x, y) is fixed pixel (x + 35, y + 20)
+    save_pyramid(texture[SHIFT[1] : SHIFT[1] + 600, SHIFT[0] : SHIFT[0] + 800], slideDir / "moving.tif")
+    return "/fixed.tif.dzi", "/moving.tif.dzi"
+
+
+def test_phase_correlation():
+    image = _texture(128, 128)[:, :, 0].astype(float)
+    shifted = np.roll(image, (5, -7), axis=(0, 1))
+    (dy, dx), peak = registration.phase_correlation(shifted, image)
+    assert (dy, dx) == (pytest.approx(5, abs=0.1), pytest.approx(-7, abs=0.1))
+    assert peak > 0.5
+
+
+def test_compose():
+    scale = [2, 0, 0, 2, 0, 0]
+    shift = [1, 0, 0, 1, 10, 5]
+    assert registration._compose(scale, shift) == [2, 0, 0, 2, 20, 10]
+    assert registration._compose(shift, scale) == [2, 0, 0, 2, 10, 5]
+
+
+def test_translation_is_recovered(client, layers):
+    resp = client.post("/register", json={"fixed": layers[0], "moving": layers[1]})
+    assert resp.status_code == 200
+    data = resp.get_json()
+    a, b, c, d, e, f = data["matrix"]
+    assert [a, b, c, d] == pytest.approx([1, 0, 0, 1], abs=0.01)
+    assert (e, f) == (pytest.approx(SHIFT[0], abs=1), pytest.approx(SHIFT[1], abs=1))
+    assert data["steps"][0]["shrink"] == 1
+    assert data["steps"][-1] == {"shrink": 0, "matches": 9}
+    assert data["tileSource"].startswith("/moving.tif/affine/")
+    assert client.get(data["tileSource"]).status_code == 200
+
+
+def test_bad_requests(client, layers):
+    for content in [{}, {"fixed": layers[0]}, {"fixed": layers[0], "moving": 3}]:
+        assert client.post("/register", json=content).status_code == 400, content
+    content = {"fixed": layers[0], "moving": layers[1], "finestShrink": "a"}
+    assert client.post("/register", json=content).status_code == 400
+    content = {"fixed": layers[0], "moving": "/nothing.tif.dzi"}
+    assert client.post("/register", json=content).status_code == 404
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+
+from tissuumaps import views
+
+from conftest import markers_frame
+
+
+def test_rows_by_index(client):
+    frame = markers_frame()
+    data = client.get("/markers.csv/rows?index=5&index=0&column=x&column=gene").get_json()
+    assert data["indices"] == [5, 0]
+    assert [set(row) for row in data["rows"]] == [{"x", "gene"}] * 2
+    assert data["rows"][0]["x"] == pytest.approx(frame["x"][5], rel=1e-12)
+    assert data["rows"][1]["gene"] == frame["gene"][0]
+    data = client.post("/markers.csv/rows", json={"indices": [7]}).get_json()
+    assert data["rows"][0]["cl"] == frame["cl"][7]
+
+
+def test_nearest_rows_match_brute_force(client):
+    frame = markers_frame()
+    distances = np.hypot(frame["x"] - 500, frame["y"] - 350)
+    data = client.get("/markers.csv/rows?x=500&y=350&k=5").get_json()
+    assert data["indices"] == list(np.argsort(distances)[:5])
+    assert np.allclose(data["distances"], np.sort(distances)[:5])
+    data = client.get("/markers.csv/rows?x=500&y=350&k=100&radius=20").get_json()
+    assert sorted(data["indices"]) == list(np.flatnonzero(distances <= 20))
+
+
+def test_rows_are_bounded(client, monkeypatch):
+    monkeypatch.setattr(views, "MAX_ROWS", 3)
+    data = client.get("/markers.csv/rows?x=500&y=350&k=50").get_json()
+    assert len(data["indices"]) == 3
+    data = client.post("/markers.csv/rows", json={"indices": list(range(10))}).get_json()
+    assert data["indices"] == [0, 1, 2]
+
+
+def test_bad_requests(client):
+    for params in [
+        {"indices": "12"},
+        {"indices": 12},
+        {"indices": [0], "columns": "x"},
+        {"indices": [0], "columns": [["x"]]},
+        {"indices": ["a"]},
+        {"x": "a", "y": 0},
+        {},
+        [1, 2],
+    ]:
+        assert client.post("/markers.csv/rows", json=params).status_code == 400, params
+    assert client.get("/markers.csv/rows?index=%d" % len(markers_frame())).status_code == 404
+    assert client.get("/markers.csv/rows?index=-1").status_code == 404
+    assert client.get("/markers.csv/rows?index=0&column=nothing").status_code == 404
+    assert client.get("/markers.csv/rows?x=0&y=0&X=nothing").status_code == 404
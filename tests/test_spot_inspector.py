@@ -0,0 +1,210 @@
+import io
+import os
+import threading
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from tissuumaps import app
+
+from conftest import save_pyramid
+
+pytest.importorskip("matplotlib")
+
+ROUNDS = ["R1", "R2"]
+CHANNELS = ["A", "B"]
+BBOX = [100, 120, 20, 20]
+
+
+def _layer_array(index):
+    yy, xx = np.mgrid[0:300, 0:300]
+    grey = ((xx + 2 * yy + 50 * index) % 256).astype(np.uint8)
+    return np.repeat(grey[:, :, None], 3, axis=2)
+
+
+@pytest.fixture(scope="module")
+def spotInspector(pluginsAvailable, client):
+    from tissuumaps.plugins import Spot_Inspector
+
+    return Spot_Inspector
+
+
+@pytest.fixture(scope="module")
+def spots(slideDir):
+    folder = slideDir / "spots"
+    folder.mkdir()
+    names = []
+    for r, round in enumerate(ROUNDS):
+        for c, channel in enumerate(CHANNELS):
+            name = "%s_%s" % (round, channel)
+            save_pyramid(_layer_array(2 * r + c), folder / (name + ".tif"))
+            names.append(name)
+    return folder, names
+
+
+def _spec(names, **options):
+    spec = {
+        "bbox": BBOX,
+        "layers": [{"name": n, "tileSource": n + ".tif.dzi"} for n in names],
+        "path": "spots",
+        "markers": [],
+        "figureSize": 4,
+        "order_rounds": None,
+        "order_channels": None,
+    }
+    spec.update(options)
+    return spec
+
+
+def _png(resp):
+    assert resp.status_code == 200
+    assert resp.mimetype == "image/png"
+    return np.asarray(Image.open(io.BytesIO(resp.data)).convert("RGB")).astype(int)
+
+
+def test_grid_holds_the_regions_of_every_layer(client, spotInspector, spots):
+    _, names = spots
+    image = _png(client.post("/plugins/Spot_Inspector/getMatrix", json=_spec(names)))
+    # Same layout as getGrid: 5 pixels per region pixel, 20 pixels left, 5 on top
+    zoom, left, top = 5, 20, 5
+    lut = spotInspector._colormap_lut("Greys_r").astype(int)
+    for r in range(len(ROUNDS)):
+        for c in range(len(CHANNELS)):
+            region = _layer_array(2 * r + c)[BBOX[1] : BBOX[1] + 20, BBOX[0] : BBOX[0] + 20, 0]
+            for y, x in [(2, 3), (10, 10), (17, 15)]:
+                pixel = image[
+                    top + (r * 20 + y) * zoom + zoom // 2, left + (c * 20 + x) * zoom + zoom // 2
+                ]
+                assert (pixel == lut[region[y, x]]).all(), (r, c, y, x)
+
+
+def test_matrices_are_cached_by_file_version(client, spotInspector, spots, monkeypatch):
+    folder, names = spots
+    spec = _spec(names, cmap="viridis")
+    first = client.post("/plugins/Spot_Inspector/getMatrix", json=spec).data
+    reads = []
+    getTile = spotInspector.Plugin.getTile
+
+    def countingGetTile(self, path, bbox):
+        reads.append(path)
+        return getTile(self, path, bbox)
+
+    monkeypatch.setattr(spotInspector.Plugin, "getTile", countingGetTile)
+    assert client.post("/plugins/Spot_Inspector/getMatrix", json=spec).data == first
+    assert reads == []
+    stat = os.stat(folder / "R1_A.tif")
+    os.utime(folder / "R1_A.tif", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert client.post("/plugins/Spot_Inspector/getMatrix", json=spec).data == first
+    assert sorted(reads) == sorted("spots/%s.tif.dzi" % n for n in names)
+
+
+def test_matplotlib_renderer(client, spotInspector, spots):
+    _, names = spots
+    markers = [{"global_X_pos": 110, "global_Y_pos": 125, "letters": "AB", "color": "#00ff00"}]
+    spec = _spec(names, markers=markers, renderer="matplotlib")
+    image = _png(client.post("/plugins/Spot_Inspector/getMatrix", json=spec))
+    assert image.shape == (4 * 4 * 80 // 5, 4 * 80, 3)
+
+
+def test_traces(spotInspector):
+    tiles = dict(
+        (round, dict((channel, Image.new("RGB", (20, 20))) for channel in CHANNELS))
+        for round in ROUNDS
+    )
+    plugin = spotInspector.Plugin(app)
+    markers = [
+        {"global_X_pos": 110, "global_Y_pos": 125, "letters": "AB", "color": "red"},
+        {"global_X_pos": 110, "global_Y_pos": 125, "rounds": "1;0", "channels": "1;0", "color": "blue"},
+    ]
+    traces = plugin.getTraces(tiles, ROUNDS, CHANNELS, markers, BBOX)
+    assert traces[0] == ([9.5, 29.5], [4.5, 24.5], "red", "AB")
+    assert traces[1] == ([29.5, 9.5], [4.5, 24.5], "blue", ["B", "A"])
+    concat = plugin.getConcat(tiles, ROUNDS, CHANNELS)
+    assert concat.size == (40, 40)
+
+
+@pytest.fixture(scope="module")
+def importFolder(slideDir):
+    folder = slideDir / "import"
+    folder.mkdir()
+    save_pyramid(_layer_array(0), folder / "R1_A.tif")
+    save_pyramid(_layer_array(1), folder / "R1_B.tif")
+    # Read once converted, and not at all
+    Image.fromarray(_layer_array(2)).save(folder / "R2_A.png")
+    (folder / "R2_B.tif").write_bytes(b"not an image")
+    return folder
+
+
+def test_import_lists_conversions_as_pending(client, spotInspector, importFolder, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    convert = spotInspector._convert
+
+    def blockedConvert(path, newpath):
+        started.set()
+        release.wait(10)
+        return convert(path, newpath)
+
+    monkeypatch.setattr(spotInspector, "_convert", blockedConvert)
+    resp = client.post(
+        "/plugins/Spot_Inspector/importFolder", json={"path": "/import", "pathFormat": "*"}
+    )
+    assert resp.status_code == 200
+    project = resp.get_json()
+    assert [l["tileSource"] for l in project["layers"]] == ["/R1_A.tif.dzi", "/R1_B.tif.dzi"]
+    assert project["layerFilters"] == {
+        "0": [{"name": "Color", "value": "100,0,0"}],
+        "1": [{"name": "Color", "value": "0,100,0"}],
+    }
+    assert project["pendingLayers"] == [
+        {
+            "name": "R2_A.png",
+            "tileSource": "/R2_A.png.dzi",
+            "layerFilter": [{"name": "Color", "value": "100,0,0"}],
+        }
+    ]
+    assert started.wait(10)
+    status = {"path": "/import", "tileSources": ["/R1_A.tif.dzi", "/R2_A.png.dzi", "/../../x.tif.dzi"]}
+    resp = client.post("/plugins/Spot_Inspector/importStatus", json=status)
+    assert resp.get_json() == {"ready": ["/R1_A.tif.dzi"], "failed": ["/../../x.tif.dzi"]}
+    release.set()
+    spotInspector._schedule_conversion(str(importFolder / "R2_A.png")).result(30)
+    resp = client.post("/plugins/Spot_Inspector/importStatus", json=status)
+    assert resp.get_json()["ready"] == ["/R1_A.tif.dzi", "/R2_A.png.dzi"]
+    assert (importFolder / ".tissuumaps" / "R2_A.tif").is_file()
+    # Converted files are listed as layers from then on
+    resp = client.post(
+        "/plugins/Spot_Inspector/importFolder", json={"path": "import", "pathFormat": "*"}
+    )
+    assert [l["name"] for l in resp.get_json()["layers"]] == ["R1_A.tif", "R1_B.tif", "R2_A.png"]
+    assert resp.get_json()["pendingLayers"] == []
+
+
+def test_file_formats_are_cached_by_version(client, spotInspector, importFolder, monkeypatch):
+    plugin = app.pluginHost.get("Spot_Inspector")
+    assert plugin._file_format(str(importFolder / "R1_A.tif")) == "slide"
+    assert plugin._file_format(str(importFolder / "R2_A.png")) == "convert"
+    assert plugin._file_format(str(importFolder / "R2_B.tif")) is None
+    assert plugin._file_format(str(importFolder / "nothing.tif")) is None
+    calls = []
+
+    def failingOpen(path, *args, **kwargs):
+        calls.append(path)
+        raise spotInspector.pyvips.Error("unreadable")
+
+    monkeypatch.setattr(spotInspector.pyvips.Image, "new_from_file", failingOpen)
+    path = importFolder / "R2_A.png"
+    assert plugin._file_format(str(path)) == "convert"
+    assert plugin._file_format(str(importFolder / "R2_B.tif")) is None
+    assert calls == []
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert plugin._file_format(str(path)) is None
+    assert calls == [str(path)]
+
+
+def test_import_stays_in_the_slide_folder(client, spotInspector, importFolder):
+    resp = client.post(
+        "/plugins/Spot_Inspector/importFolder", json={"path": "import", "pathFormat": "../../*"}
+    )
+    assert resp.get_json()["layers"] == []
@@ -0,0 +1,85 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import markers_frame
+
+
+@pytest.fixture(scope="module")
+def parquetFile(slideDir):
+    frame = markers_frame()
+    frame["gene"] = frame["gene"].astype("category")
+    frame["name"] = ["cell_%d" % i for i in range(len(frame))]
+    frame.to_parquet(slideDir / "markers.parquet", index=False)
+    return "markers.parquet"
+
+
+@pytest.fixture(scope="module")
+def h5adFile(slideDir):
+    anndata = pytest.importorskip("anndata")
+    frame = markers_frame()
+    obs = pd.DataFrame(
+        {
+            "gene": pd.Categorical(frame["gene"]),
+            "cl": pd.array(frame["cl"], dtype="Int64"),
+            "value": frame["value"],
+        },
+        index=["cell_%d" % i for i in range(len(frame))],
+    )
+    obs.loc[obs.index[:10], "cl"] = pd.NA
+    adata = anndata.AnnData(
+        X=np.zeros((len(frame), 1), dtype=np.float32),
+        obs=obs,
+        obsm={"spatial": frame[["x", "y"]].to_numpy()},
+    )
+    adata.write_h5ad(slideDir / "markers.h5ad")
+    return "markers.h5ad"
+
+
+def _csv(client, url):
+    resp = client.get(url)
+    assert resp.status_code == 200
+    return pd.read_csv(io.BytesIO(resp.data), keep_default_na=False, na_values=[""])
+
+
+def test_parquet_columns(client, parquetFile):
+    rows = _csv(client, "/" + parquetFile)
+    assert list(rows.columns) == ["x", "y", "gene", "cl", "value", "name"]
+    frame = markers_frame()
+    assert np.allclose(rows["x"], frame["x"])
+    assert (rows["gene"] == frame["gene"]).all()
+    assert rows["name"].iloc[5] == "cell_5"
+    rows = _csv(client, "/%s?column=cl&column=gene" % parquetFile)
+    assert list(rows.columns) == ["cl", "gene"]
+    assert (rows["cl"] == frame["cl"]).all()
+
+
+def test_parquet_counts(client, parquetFile):
+    data = client.get("/%s/counts?gb_col=gene" % parquetFile).get_json()
+    expected = markers_frame()["gene"].value_counts().to_dict()
+    assert dict(zip(data["keys"], data["counts"])) == expected
+
+
+def test_h5ad_columns(client, h5adFile):
+    rows = _csv(client, "/" + h5adFile)
+    assert {"x", "y", "gene", "cl", "value"} <= set(rows.columns)
+    frame = markers_frame()
+    assert np.allclose(rows["x"], frame["x"])
+    assert np.allclose(rows["y"], frame["y"])
+    assert (rows["gene"] == frame["gene"]).all()
+    # Missing values of nullable columns stay missing
+    assert rows["cl"].iloc[:10].isna().all()
+    assert (rows["cl"].iloc[10:] == frame["cl"].iloc[10:]).all()
+
+
+def test_h5ad_counts(client, h5adFile):
+    data = client.get("/%s/counts?gb_col=gene" % h5adFile).get_json()
+    expected = markers_frame()["gene"].value_counts().to_dict()
+    assert dict(zip(data["keys"], data["counts"])) == expected
+    assert data["total"] == len(markers_frame())
+
+
+def test_unknown_columns(client, parquetFile):
+    assert client.get("/%s?column=nothing" % parquetFile).status_code == 404
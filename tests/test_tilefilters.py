@@ -0,0 +1,95 @@
+import io
+import json
+from urllib.parse import quote
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from tissuumaps import tilefilters
+
+from conftest import image_array
+
+
+def _filters(*items):
+    return tilefilters.parse_filters([{"name": n, "value": v} for n, v in items])
+
+
+def _tile(resp):
+    assert resp.status_code == 200
+    return np.asarray(Image.open(io.BytesIO(resp.data)).convert("RGB"))
+
+
+def test_default_slider_values_keep_tiles():
+    tile = image_array()[:64, :64]
+    for name, value in [
+        ("Threshold", 256),
+        ("Color", "100,100,100"),
+        ("Color", 0),
+        ("Brightness", 0),
+        ("Contrast", 1),
+        ("Gamma", 1),
+        ("Invert", False),
+        ("Erosion", 1),
+    ]:
+        assert (tilefilters.apply_filters(tile, _filters((name, value))) == tile).all(), name
+
+
+def test_filters():
+    tile = image_array()[:64, :64]
+    inverted = tilefilters.apply_filters(tile, _filters(("Invert", "true")))
+    assert (inverted == 255 - tile).all()
+    grey = tilefilters.apply_filters(tile, _filters(("Greyscale", 1)))
+    assert (grey[:, :, 0] == np.round(tile.mean(axis=2))).all()
+    binary = tilefilters.apply_filters(tile, _filters(("Threshold", 100)))
+    assert set(np.unique(binary)) <= {0, 255}
+    red = tilefilters.apply_filters(tile, _filters(("Color", "100,0,0")))
+    assert (red[:, :, 0] == tile[:, :, 0]).all() and (red[:, :, 1:] == 0).all()
+    # Filters apply in order
+    both = _filters(("Invert", 1), ("Threshold", 100))
+    assert (
+        tilefilters.apply_filters(tile, both)
+        == tilefilters.apply_filters(inverted, _filters(("Threshold", 100)))
+    ).all()
+
+
+def test_morphology_kernels_are_clamped():
+    tile = np.zeros((40, 40, 3), dtype=np.uint8)
+    tile[20, 20] = 255
+    assert _filters(("Dilation", 50))[0]["value"] == tilefilters.MAX_KERNEL_SIZE
+    assert _filters(("Erosion", -3))[0]["value"] == tilefilters.MIN_KERNEL_SIZE
+    dilated = tilefilters.apply_filters(tile, _filters(("Dilation", 50)))
+    assert (dilated[:, :, 0] > 0).sum() == tilefilters.MAX_KERNEL_SIZE ** 2
+    assert (tilefilters.apply_filters(dilated, _filters(("Erosion", 11))) == tile).all()
+
+
+def test_invalid_filters():
+    for filters in [
+        "{",
+        {"name": "Invert"},
+        [{"name": "Blur", "value": 1}],
+        ["Invert"],
+        [{"name": "Brightness", "value": "a"}],
+        [{"name": "Brightness", "value": "nan"}],
+        [{"name": "Brightness", "value": None}],
+        [{"name": "Color", "value": "1,2"}],
+        [{"name": "Erosion", "value": "inf"}],
+    ]:
+        with pytest.raises(ValueError):
+            tilefilters.parse_filters(filters)
+
+
+def test_filtered_tiles(client):
+    filters = quote(json.dumps([{"name": "Invert", "value": True}]))
+    plain = _tile(client.get("/image.tif_files/10/0_0.png"))
+    inverted = _tile(client.get("/image.tif_files/10/0_0.png?filters=" + filters))
+    assert (inverted == 255 - plain).all()
+    threshold = quote(json.dumps([{"name": "Threshold", "value": 256}]))
+    assert (_tile(client.get("/image.tif_files/10/0_0.png?filters=" + threshold)) == plain).all()
+
+
+def test_bad_requests(client):
+    for filters in ["{", quote('[{"name": "Blur"}]'), quote('[{"name": "Gamma", "value": "x"}]')]:
+        assert client.get("/image.tif_files/10/0_0.png?filters=" + filters).status_code == 400
+    filters = quote(json.dumps([{"name": "Invert", "value": True}]))
+    assert client.get("/image.tif_files/10/9_0.png?filters=" + filters).status_code == 404
@@ -28,6 +28,13 @@ log.setLevel(logging.INFO)
 
 SLIDE_DIR = "/mnt/data/shared/"
 SLIDE_CACHE_SIZE = 60
+MARKER_CACHE_SIZE = 16
+REGION_CACHE_SIZE = 4
+TILE_CACHE_BYTES = 256 * 1024 * 1024
+RAW_TILE_CACHE_BYTES = 512 * 1024 * 1024
+CHUNK_CACHE_BYTES = 256 * 1024 * 1024
+PLUGIN_CACHE_BYTES = 64 * 1024 * 1024
+PLUGIN_JOB_THREADS = 4
 DEEPZOOM_FORMAT = 'png'
 DEEPZOOM_TILE_SIZE = 254
 DEEPZOOM_OVERLAP = 1
@@ -71,4 +78,8 @@ logging.debug("Plugin list:",app.config["PLUGINS"])
 
 app.config["isStandalone"] = False
 
-from . import views
+from .parallel import is_worker
+
+# Process pool workers only compute: they do not need the server
+if not is_worker():
+    from . import views
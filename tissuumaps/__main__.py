@@ -1,9 +1,11 @@
 from optparse import OptionParser
+import multiprocessing
 import os
 
-from . import views
-
 def main ():
+    # Imported here: process pool workers import this module too
+    from . import views
+
     parser = OptionParser(usage='Usage: %prog [options] [slide-directory]')
     parser.add_option('-B', '--ignore-bounds', dest='DEEPZOOM_LIMIT_BOUNDS',
                 default=False, action='store_false',
@@ -56,4 +58,5 @@ def main ():
     views.app.run(host=opts.host, port=opts.port, threaded=True, debug=opts.DEBUG)
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()
     main ()
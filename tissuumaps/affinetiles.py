@@ -0,0 +1,197 @@
+#
+# Virtual affine-transformed image layers for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+import math
+import re
+
+import numpy as np
+from PIL import Image
+from scipy import ndimage
+
+from tissuumaps.pyramid import PyramidSlide, deepzoom_bounds
+
+# Virtual layers: <source layer>/affine/<a,b,c,d,e,f>
+LAYER_PATTERN = re.compile(
+    r"^(?P<path>.+)[/\\]affine[/\\](?P<matrix>[-+0-9.eE]+(?:,[-+0-9.eE]+){5})$"
+)
+# Source pixels read around the inverse-mapped tile, for interpolation
+MARGIN = 2
+
+
+def parse_matrix(value):
+    """Affine matrix ``[a, b, c, d, e, f]`` from a list or comma separated text.
+
+    Source pixels ``(u, v)`` go to ``(a*u + b*v + e, c*u + d*v + f)``, as
+    in the transform plugin. Raises ``ValueError`` for singular matrices.
+    """
+    if isinstance(value, str):
+        value = value.split(",")
+    matrix = [float(v) for v in value]
+    if len(matrix) != 6 or not all(math.isfinite(v) for v in matrix):
+        raise ValueError("An affine matrix has six finite values")
+    if abs(matrix[0] * matrix[3] - matrix[1] * matrix[2]) < 1e-12:
+        raise ValueError("Singular affine matrix")
+    return matrix
+
+
+def format_matrix(matrix):
+    return ",".join("%.10g" % v for v in matrix)
+
+
+def split_layer_path(path):
+    """Return ``(sourcePath, matrix)`` of a virtual layer path, or ``None``."""
+    match = LAYER_PATTERN.match(path)
+    if match is None:
+        return None
+    try:
+        return match.group("path"), parse_matrix(match.group("matrix"))
+    except ValueError:
+        return None
+
+
+def source_path(path):
+    """Path of the layer an affine layer is computed from, transforms removed."""
+    layer = split_layer_path(path)
+    while layer is not None:
+        path = layer[0]
+        layer = split_layer_path(path)
+    return path
+
+
+def layer_path(path, matrix):
+    return "%s/affine/%s" % (path, format_matrix(matrix))
+
+
+def output_size(width, height, matrix):
+    """Size of the transformed image, as written by the transform plugin."""
+    a, b, c, d, e, f = matrix
+    corners = [(0, 0), (width, 0), (width, height), (0, height)]
+    return (
+        max(1, max(int(a * u + b * v + e) for u, v in corners)),
+        max(1, max(int(c * u + d * v + f) for u, v in corners)),
+    )
+
+
+def read_region(readTile, tileSize, overlap, level, x0, y0, x1, y1):
+    """Pixels ``[x0, x1) x [y0, y1)`` of a DeepZoom level, from its RGB tiles.
+
+    ``readTile(level, col, row)`` returns a tile array or ``None``; missing
+    tiles are black.
+    """
+    region = np.zeros((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+    for row in range(max(y0, 0) // tileSize, (y1 - 1) // tileSize + 1):
+        for col in range(max(x0, 0) // tileSize, (x1 - 1) // tileSize + 1):
+            tile = readTile(level, col, row)
+            if tile is None:
+                continue
+            # Drop the overlap: the tile starts at (col, row) * tileSize
+            tile = tile[(overlap if row > 0 else 0) :, (overlap if col > 0 else 0) :][
+                :tileSize, :tileSize
+            ]
+            top, left = row * tileSize, col * tileSize
+            ty0, tx0 = max(y0, top), max(x0, left)
+            ty1 = min(y1, top + tile.shape[0])
+            tx1 = min(x1, left + tile.shape[1])
+            if ty1 > ty0 and tx1 > tx0:
+                region[ty0 - y0 : ty1 - y0, tx0 - x0 : tx1 - x0] = tile[
+                    ty0 - top : ty1 - top, tx0 - left : tx1 - left, :3
+                ]
+    return region
+
+
+class AffineSlide(PyramidSlide):
+    """DeepZoom tiles of a layer seen through an affine transform.
+
+    Nothing is written to disk: every tile is inverse-mapped to the
+    source, the source tiles covering it are read at the closest DeepZoom
+    level of at least the needed resolution, and resampled bilinearly.
+    ``readTile(level, col, row)`` returns a source tile as an RGB array,
+    or ``None``; it defaults to ``source.get_tile``. The source is tiled
+    with the same tile size and overlap.
+    """
+
+    def __init__(self, source, matrix, tileSize, overlap, readTile=None):
+        self.source = source
+        self.matrix = matrix
+        self.readTile = readTile or self._read_source_tile
+        self.sourceWidth, self.sourceHeight = source.level_dimensions[-1]
+        a, b, c, d, e, f = matrix
+        self.forward = np.array([[a, b], [c, d]], dtype=np.float64)
+        self.inverse = np.linalg.inv(self.forward)
+        self.offset = np.array([e, f], dtype=np.float64)
+        PyramidSlide.__init__(
+            self,
+            [output_size(self.sourceWidth, self.sourceHeight, matrix)],
+            tileSize,
+            overlap,
+        )
+        self.mpp = getattr(source, "mpp", 0) / max(
+            np.sqrt(abs(np.linalg.det(self.forward))), 1e-12
+        )
+        self.properties = {"affine.matrix": format_matrix(matrix)}
+
+    def _read_source_tile(self, level, col, row):
+        try:
+            with self.source.tileLock:
+                tile = self.source.get_tile(level, (col, row))
+        except ValueError:
+            return None
+        return np.asarray(tile.convert("RGB"))
+
+    def get_tile(self, level, address):
+        (x, width), (y, height) = deepzoom_bounds(
+            self.width, self.height, self.tileSize, self.overlap, level, *address
+        )
+        scale = 2 ** (self.level_count - 1 - level)
+        # Source pixels per tile pixel, along the most compressed direction
+        step = scale * np.linalg.svd(self.inverse, compute_uv=False).min()
+        sourceShrink = int(
+            min(
+                max(math.floor(math.log2(max(step, 1))), 0),
+                self.source.level_count - 1,
+            )
+        )
+        sourceLevel = self.source.level_count - 1 - sourceShrink
+        sourceScale = 2**sourceShrink
+        levelWidth, levelHeight = self.source.level_dimensions[sourceLevel]
+        # Tile pixel centres to source level pixel indices:
+        # index = (inverse @ ((tile + 0.5) * scale - offset)) / sourceScale - 0.5
+        linear = self.inverse * scale / sourceScale
+        origin = (
+            self.inverse @ ((np.array([x, y]) + 0.5) * scale - self.offset)
+        ) / sourceScale - 0.5
+        corners = np.array(
+            [[0, 0], [width, 0], [width, height], [0, height]], dtype=np.float64
+        )
+        mapped = corners @ linear.T + origin
+        x0 = max(int(math.floor(mapped[:, 0].min())) - MARGIN, 0)
+        y0 = max(int(math.floor(mapped[:, 1].min())) - MARGIN, 0)
+        x1 = min(int(math.ceil(mapped[:, 0].max())) + MARGIN, levelWidth)
+        y1 = min(int(math.ceil(mapped[:, 1].max())) + MARGIN, levelHeight)
+        if x1 <= x0 or y1 <= y0:
+            return Image.new("RGB", (width, height))
+        region = read_region(
+            self.readTile, self.tileSize, self.overlap, sourceLevel, x0, y0, x1, y1
+        ).astype(np.float32)
+        # ndimage works in (row, column) order
+        matrix = np.array(
+            [
+                [linear[1, 1], linear[1, 0], 0],
+                [linear[0, 1], linear[0, 0], 0],
+                [0, 0, 1],
+            ]
+        )
+        tile = ndimage.affine_transform(
+            region,
+            matrix,
+            offset=[origin[1] - y0, origin[0] - x0, 0],
+            output_shape=(height, width, 3),
+            order=1,
+            mode="constant",
+            cval=0,
+        )
+        return Image.fromarray(np.clip(np.round(tile), 0, 255).astype(np.uint8), "RGB")
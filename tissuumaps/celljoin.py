@@ -0,0 +1,288 @@
+#
+# Assignment of markers (transcripts) to segmented cells for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+import io
+import json
+import logging
+import math
+import os
+import shutil
+import uuid
+
+import numpy as np
+import pandas as pd
+import pyvips
+import scipy.io
+import scipy.sparse
+
+from tissuumaps.markers import STREAM_CHUNK_ROWS
+from tissuumaps.pyramid import VIPS_FORMATS
+from tissuumaps.spatial import STRTree
+
+# Side of the label image tiles read at once, in pixels
+LABEL_TILE_SIZE = 2048
+# Average number of markers per tile when joining with polygons
+TILE_POINTS = 1 << 20
+
+class LabelImage(object):
+    """Full resolution label image, read by regions with exact label values.
+
+    Images with three or more bands are read as 24-bit RGB-encoded labels
+    (``R + 256 G + 65536 B``); otherwise the first band holds the label.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.image = pyvips.Image.new_from_file(path, access="random")
+        self.width = self.image.width
+        self.height = self.image.height
+
+    def read(self, x, y, width, height, step=1):
+        """Labels of a region, keeping every ``step``-th pixel when ``step > 1``.
+
+        Regions past the right and bottom edges repeat the edge pixels.
+        """
+        image = self.image
+        if x + width > self.width or y + height > self.height:
+            image = image.embed(
+                0,
+                0,
+                max(self.width, x + width),
+                max(self.height, y + height),
+                extend="copy",
+            )
+        region = image.crop(x, y, width, height)
+        if step > 1:
+            region = region.subsample(step, step)
+        width, height = region.width, region.height
+        data = np.frombuffer(
+            region.write_to_memory(), dtype=VIPS_FORMATS[region.format]
+        ).reshape(height, width, region.bands)
+        if region.bands >= 3:
+            data = data.astype(np.int64)
+            return data[:, :, 0] + (data[:, :, 1] << 8) + (data[:, :, 2] << 16)
+        return data[:, :, 0].astype(np.int64)
+
+
+def get_label_image(slide, path):
+    """Return the :class:`LabelImage` of ``path``, kept with its slide cache entry.
+
+    The pyramid of the slide cache may be 8-bit and lossy, so labels are
+    read from the source image; the slide only scopes the lifetime.
+    """
+    with slide.tileLock:
+        labelImage = getattr(slide, "labelImage", None)
+        if labelImage is None or labelImage.path != path:
+            labelImage = slide.labelImage = LabelImage(path)
+        return labelImage
+
+
+def label_assignments(labelImage, index, scale=1.0):
+    """Yield ``(rows, cells)``: markers and the label under them, tile by tile.
+
+    Marker coordinates times ``scale`` are pixel coordinates of the label
+    image; label 0 is background. Each label tile is read once.
+    """
+    tile = LABEL_TILE_SIZE
+    for ty in range(0, labelImage.height, tile):
+        for tx in range(0, labelImage.width, tile):
+            width = min(tile, labelImage.width - tx)
+            height = min(tile, labelImage.height - ty)
+            rows = index.query_bbox(
+                tx / scale, ty / scale, (tx + width) / scale, (ty + height) / scale
+            )
+            if len(rows) == 0:
+                continue
+            px = np.floor(index.x[rows] * scale).astype(np.int64) - tx
+            py = np.floor(index.y[rows] * scale).astype(np.int64) - ty
+            inside = (px >= 0) & (px < width) & (py >= 0) & (py < height)
+            rows, px, py = rows[inside], px[inside], py[inside]
+            if len(rows) == 0:
+                continue
+            cells = labelImage.read(tx, ty, width, height)[py, px]
+            foreground = cells != 0
+            yield rows[foreground], cells[foreground]
+
+
+def region_assignments(regions, index):
+    """Yield ``(rows, cells)``: markers and the index of the region containing them.
+
+    Markers are processed in tiles of about ``TILE_POINTS`` points; the
+    regions crossing a tile are found with an STR-tree over their bounding
+    boxes. A marker inside overlapping regions goes to the first one.
+    """
+    boxes = [r.bbox if r.bbox is not None else (np.inf,) * 4 for r in regions]
+    tree = STRTree(boxes)
+    xmin, ymin, xmax, ymax = index.bounds
+    tiles = max(int(math.ceil(math.sqrt(len(index.x) / TILE_POINTS))), 1)
+    tileSize = max(xmax - xmin, ymax - ymin, 1e-9) / tiles
+    for row in range(tiles):
+        for col in range(tiles):
+            x0, y0 = xmin + col * tileSize, ymin + row * tileSize
+            rows = index.query_bbox(x0, y0, x0 + tileSize, y0 + tileSize)
+            if len(rows) == 0:
+                continue
+            px, py = index.x[rows], index.y[rows]
+            # Markers on a tile border belong to one tile only
+            own = (
+                (np.minimum(((px - xmin) // tileSize), tiles - 1) == col)
+                & (np.minimum(((py - ymin) // tileSize), tiles - 1) == row)
+            )
+            rows, px, py = rows[own], px[own], py[own]
+            cells = np.full(len(rows), -1, dtype=np.int64)
+            for r in tree.query(x0, y0, x0 + tileSize, y0 + tileSize):
+                bx0, by0, bx1, by1 = regions[r].bbox
+                candidates = np.flatnonzero(
+                    (cells < 0) & (px >= bx0) & (px <= bx1) & (py >= by0) & (py <= by1)
+                )
+                if len(candidates):
+                    inside = regions[r].contains(px[candidates], py[candidates])
+                    cells[candidates[inside]] = r
+            assigned = cells >= 0
+            yield rows[assigned], cells[assigned]
+
+
+class CellCounts(object):
+    """Cell x key count matrix with the centroid of the markers of every cell."""
+
+    def __init__(self, cells, keys, matrix, x, y, unassigned):
+        self.cells = cells
+        self.keys = keys
+        self.matrix = matrix
+        self.x = x
+        self.y = y
+        self.unassigned = unassigned
+
+    def to_csv(self, cellNames=None, extra=None):
+        """Yield one row per cell: cell, x, y, total and the count of every key."""
+        columns = ["cell", "x", "y", "total"] + list(extra or {}) + list(self.keys)
+        buf = io.StringIO()
+        pd.DataFrame(columns=columns).to_csv(buf, index=False)
+        yield buf.getvalue()
+        totals = np.asarray(self.matrix.sum(axis=1)).ravel()
+        for start in range(0, len(self.cells), STREAM_CHUNK_ROWS):
+            rows = slice(start, start + STREAM_CHUNK_ROWS)
+            cells = self.cells[rows]
+            frame = pd.DataFrame(
+                {
+                    "cell": cells if cellNames is None else [cellNames[c] for c in cells],
+                    "x": self.x[rows],
+                    "y": self.y[rows],
+                    "total": totals[rows],
+                }
+            )
+            for name, values in (extra or {}).items():
+                frame[name] = [values[c] for c in cells]
+            counts = pd.DataFrame(self.matrix[rows].toarray(), columns=self.keys)
+            frame = pd.concat([frame, counts], axis=1)
+            buf = io.StringIO()
+            frame.to_csv(buf, index=False, header=False)
+            yield buf.getvalue()
+
+
+def count_cells(markerFile, key, x, y, assignments):
+    """Count the markers of every ``key`` value in every cell.
+
+    ``assignments`` yields ``(rows, cells)`` chunks as
+    :func:`label_assignments` and :func:`region_assignments` do; only the
+    per-cell sums of each chunk are kept, so memory does not grow with the
+    number of markers. Markers with an empty key are left out.
+    """
+    keys, codes = markerFile.key_codes(key)
+    index = markerFile.spatial_index(x, y)
+    nkeys = len(keys)
+    missing = keys.index("") if "" in keys else None
+    pairs, pairCounts, sums = [], [], []
+    assigned = 0
+    for rows, cells in assignments:
+        genes = np.asarray(codes[rows], dtype=np.int64)
+        if missing is not None:
+            valid = genes != missing
+            rows, cells, genes = rows[valid], cells[valid], genes[valid]
+        assigned += len(rows)
+        uniquePairs, counts = np.unique(cells * nkeys + genes, return_counts=True)
+        pairs.append(uniquePairs)
+        pairCounts.append(counts)
+        uniqueCells, inverse = np.unique(cells, return_inverse=True)
+        sums.append(
+            np.column_stack(
+                [
+                    uniqueCells,
+                    np.bincount(inverse, weights=index.x[rows]),
+                    np.bincount(inverse, weights=index.y[rows]),
+                    np.bincount(inverse),
+                ]
+            )
+        )
+    pairs = np.concatenate(pairs) if pairs else np.zeros(0, dtype=np.int64)
+    pairCounts = np.concatenate(pairCounts) if pairCounts else np.zeros(0, dtype=np.int64)
+    sums = np.concatenate(sums) if sums else np.zeros((0, 4))
+    cells, cellIndex = np.unique(pairs // nkeys, return_inverse=True)
+    matrix = scipy.sparse.csr_matrix(
+        (pairCounts, (cellIndex.ravel(), pairs % nkeys)), shape=(len(cells), nkeys)
+    )
+    if missing is not None:
+        keep = [i for i in range(nkeys) if i != missing]
+        matrix = matrix[:, keep]
+        keys = [keys[i] for i in keep]
+    # Cells are split across tiles: sum their partial coordinates
+    sumIndex = np.searchsorted(cells, sums[:, 0].astype(np.int64))
+    weights = [
+        np.bincount(sumIndex, weights=sums[:, i], minlength=len(cells)) for i in (1, 2, 3)
+    ]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cx, cy = weights[0] / weights[2], weights[1] / weights[2]
+    total = len(codes)
+    if missing is not None:
+        total -= int(np.count_nonzero(np.asarray(codes) == missing))
+    return CellCounts(cells, keys, matrix, cx, cy, total - assigned)
+
+
+def write_cell_counts(counts, outputPath, cellNames=None, extra=None, source=None):
+    """Write ``<outputPath>.csv``, ``<outputPath>.mtx`` and ``<outputPath>.json``.
+
+    The CSV has one row per cell and can be opened as a marker file; the
+    Matrix Market file holds the sparse cell x key counts, with the cell
+    and key names in the JSON summary.
+    """
+    tmpPath = outputPath + ".tmp-" + uuid.uuid4().hex[:8]
+    os.makedirs(tmpPath)
+    try:
+        with open(os.path.join(tmpPath, "cells.csv"), "w", newline="") as f:
+            for text in counts.to_csv(cellNames, extra):
+                f.write(text)
+        with open(os.path.join(tmpPath, "cells.mtx"), "wb") as f:
+            scipy.io.mmwrite(f, counts.matrix)
+        names = [
+            c if cellNames is None else cellNames[c] for c in counts.cells.tolist()
+        ]
+        summary = {
+            "source": source,
+            "cells": names,
+            "keys": counts.keys,
+            "assigned": int(counts.matrix.sum()),
+            "unassigned": counts.unassigned,
+        }
+        with open(os.path.join(tmpPath, "cells.json"), "w") as f:
+            json.dump(summary, f)
+        for extension in ("csv", "mtx", "json"):
+            os.replace(
+                os.path.join(tmpPath, "cells." + extension),
+                outputPath + "." + extension,
+            )
+    finally:
+        shutil.rmtree(tmpPath, ignore_errors=True)
+    logging.info("Wrote %d cells to %s" % (len(counts.cells), outputPath))
+    return summary
+
+
+def is_current(outputPath, source):
+    try:
+        with open(outputPath + ".json") as f:
+            return json.load(f).get("source") == source
+    except (OSError, ValueError):
+        return False
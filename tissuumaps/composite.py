@@ -0,0 +1,135 @@
+#
+# Server-side compositing of multi-channel image layers for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+
+import numpy as np
+
+from tissuumaps.markers import cache_path
+from tissuumaps.markertiles import _hex_to_rgb, spec_id
+from tissuumaps.parallel import WORKERS
+
+# Same names as the canvas composite operations of filterUtils
+COMPOSITE_MODES = ["source-over", "lighter", "lighten"]
+# Threads reading member tiles, shared by all composite tiles
+READ_THREADS = max(4, 2 * WORKERS)
+
+_readers = None
+
+
+def _get_readers():
+    global _readers
+    if _readers is None:
+        _readers = ThreadPoolExecutor(max_workers=READ_THREADS)
+    return _readers
+
+
+def parse_color(value):
+    """Per-channel factors of a colour.
+
+    Accepts the ``"r,g,b"`` percentages of the ``Color`` filter of
+    filterUtils and ``#rrggbb`` colours; anything else keeps the tile as is.
+    """
+    if isinstance(value, str) and value.startswith("#"):
+        return np.array(_hex_to_rgb(value), dtype=np.float32) / 255
+    if isinstance(value, str) and value.count(",") == 2:
+        try:
+            return np.clip(
+                np.array([float(v) for v in value.split(",")], dtype=np.float32) / 100,
+                0,
+                1,
+            )
+        except ValueError:
+            pass
+    return np.ones(3, dtype=np.float32)
+
+
+def intensity_lut(low=0, high=255, gamma=1.0):
+    """``uint8`` lookup table mapping ``low..high`` to ``0..255`` with a gamma."""
+    ramp = np.clip((np.arange(256, dtype=np.float64) - low) / max(high - low, 1e-9), 0, 1)
+    return np.round(255 * ramp ** (1 / max(gamma, 1e-3))).astype(np.uint8)
+
+
+def normalize_spec(spec):
+    """Return the composite specification with defaults filled in.
+
+    ``spec`` holds ``layers``, each with a ``tileSource`` and optionally a
+    ``color``, an intensity window ``min``/``max`` and a ``gamma``, and a
+    ``compositeMode`` (one of ``COMPOSITE_MODES``). Raises ``ValueError``.
+    """
+    layers = spec.get("layers") or []
+    if not isinstance(layers, list) or not layers:
+        raise ValueError("A composite needs layers")
+    mode = spec.get("compositeMode", "lighter")
+    if mode not in COMPOSITE_MODES:
+        raise ValueError("Unknown composite mode: %s" % mode)
+    normalized = []
+    for layer in layers:
+        normalized.append(
+            {
+                "tileSource": str(layer["tileSource"]),
+                "color": layer.get("color"),
+                "min": float(layer.get("min", 0)),
+                "max": float(layer.get("max", 255)),
+                "gamma": float(layer.get("gamma", 1)),
+            }
+        )
+    return {"layers": normalized, "compositeMode": mode}
+
+
+def save_spec(layerPath, spec):
+    """Store ``spec`` next to its first layer and return its identifier."""
+    specId = spec_id(spec)
+    specPath = cache_path(layerPath, ".composite")
+    os.makedirs(specPath, exist_ok=True)
+    with open(os.path.join(specPath, specId + ".json"), "w") as f:
+        json.dump(spec, f)
+    return specId
+
+
+def load_spec(layerPath, specId):
+    if not specId.isalnum():
+        raise KeyError(specId)
+    try:
+        with open(os.path.join(cache_path(layerPath, ".composite"), specId + ".json")) as f:
+            return json.load(f)
+    except OSError:
+        raise KeyError(specId)
+
+
+def read_tiles(readers):
+    """Call every tile reader concurrently; return their results in order."""
+    return list(_get_readers().map(lambda read: read(), readers))
+
+
+def blend(tiles, spec):
+    """Blend the RGB ``uint8`` tiles of the layers of ``spec`` into one.
+
+    Every tile goes through the intensity lookup table and colour of its
+    layer. ``lighter`` adds layers, ``lighten`` keeps the brightest and
+    ``source-over`` the last one. Missing tiles (``None``) are skipped.
+    """
+    result = None
+    for tile, layer in zip(tiles, spec["layers"]):
+        if tile is None:
+            continue
+        lut = intensity_lut(layer["min"], layer["max"], layer["gamma"])
+        mapped = lut[tile[:, :, :3]].astype(np.float32) * parse_color(layer["color"])
+        if result is None or spec["compositeMode"] == "source-over":
+            result = mapped
+        elif result.shape != mapped.shape:
+            # Edge tiles of layers with other dimensions
+            continue
+        elif spec["compositeMode"] == "lighter":
+            result += mapped
+        else:
+            np.maximum(result, mapped, out=result)
+    if result is None:
+        return None
+    return np.clip(np.round(result), 0, 255).astype(np.uint8)
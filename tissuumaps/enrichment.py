@@ -0,0 +1,172 @@
+#
+# Neighbourhood enrichment and co-occurrence statistics for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+import numpy as np
+
+from tissuumaps import graph, regions as regionUtils
+from tissuumaps.parallel import WORKERS, process_pool
+
+DEFAULT_GRAPH = {"type": "knn", "k": 6}
+# Permutations below which no process pool is used: a thousand take a
+# fraction of a second, less than sending the arrays to the workers
+MIN_POOL_PERMUTATIONS = 5000
+# Most permutations a request may ask for
+MAX_PERMUTATIONS = 100000
+# Most co-occurrence distances a request may ask for
+MAX_DISTANCES = 50
+
+
+def _pair_counts(sources, targets, labels, nkeys):
+    """Undirected count of edges between every pair of keys."""
+    counts = np.bincount(
+        labels[sources] * nkeys + labels[targets], minlength=nkeys * nkeys
+    ).reshape(nkeys, nkeys)
+    return counts + counts.T
+
+
+def _permutation_counts(sources, targets, labels, nkeys, seed, start, stop):
+    """Sum and sum of squares of the pair counts of permutations ``start..stop``.
+
+    Permutation ``i`` is seeded with ``(seed, i)``, so results do not depend
+    on how permutations are split between processes.
+    """
+    total = np.zeros((nkeys, nkeys), dtype=np.float64)
+    squares = np.zeros((nkeys, nkeys), dtype=np.float64)
+    for i in range(start, stop):
+        rng = np.random.default_rng([seed, i])
+        counts = _pair_counts(sources, targets, rng.permutation(labels), nkeys)
+        total += counts
+        squares += counts.astype(np.float64) ** 2
+    return total, squares
+
+
+def _selection(markerFile, key, x, y, region):
+    """Return ``(keys, codes, selected)``: rows with a key, optionally inside ``region``."""
+    keys, codes = markerFile.key_codes(key)
+    selected = np.ones(len(codes), dtype=bool)
+    if "" in keys:
+        selected &= codes != keys.index("")
+    if region is not None:
+        inside = np.zeros(len(codes), dtype=bool)
+        inside[regionUtils.points_in_region(markerFile, region, x, y)] = True
+        selected &= inside
+    return keys, codes, selected
+
+
+def _local_edges(edges, selected):
+    """Edges with both ends selected, renumbered to positions among selected rows."""
+    edges = np.asarray(edges, dtype=np.int64)
+    keep = selected[edges[:, 0]] & selected[edges[:, 1]]
+    positions = np.cumsum(selected) - 1
+    return positions[edges[keep, 0]], positions[edges[keep, 1]], keep
+
+
+def neighbourhood_enrichment(
+    markerFile,
+    key,
+    x="x",
+    y="y",
+    graphSpec=None,
+    region=None,
+    permutations=1000,
+    seed=0,
+):
+    """Permutation z-scores of the edges between every pair of keys.
+
+    Edges come from the cached neighbourhood graph ``graphSpec`` (see
+    :func:`tissuumaps.graph.build_graph`), restricted to markers inside
+    ``region`` if given. Keys are shuffled over the markers ``permutations``
+    times, in a process pool; the result is the same for a given ``seed``.
+    """
+    graphSpec = dict(graphSpec or DEFAULT_GRAPH, X=x, Y=y)
+    edges, _ = graph.get_graph(markerFile, graphSpec)
+    keys, codes, selected = _selection(markerFile, key, x, y, region)
+    sources, targets, _ = _local_edges(edges, selected)
+    labels = np.asarray(codes[selected], dtype=np.int64)
+    nkeys = len(keys)
+    observed = _pair_counts(sources, targets, labels, nkeys)
+    permutations = max(int(permutations), 1)
+    if permutations >= MIN_POOL_PERMUTATIONS and WORKERS > 1:
+        bounds = np.linspace(0, permutations, min(WORKERS, permutations) + 1).astype(int)
+        executor = process_pool()
+        futures = [
+            executor.submit(
+                _permutation_counts, sources, targets, labels, nkeys, seed, start, stop
+            )
+            for start, stop in zip(bounds[:-1], bounds[1:])
+        ]
+        results = [future.result() for future in futures]
+        total = sum(r[0] for r in results)
+        squares = sum(r[1] for r in results)
+    else:
+        total, squares = _permutation_counts(
+            sources, targets, labels, nkeys, seed, 0, permutations
+        )
+    mean = total / permutations
+    std = np.sqrt(np.maximum(squares / permutations - mean**2, 0))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        zscore = (observed - mean) / std
+    # Pairs that never vary have no defined z-score
+    zscore[~np.isfinite(zscore)] = 0
+    if "" in keys:
+        keep = [i for i, k in enumerate(keys) if k != ""]
+        keys = [keys[i] for i in keep]
+        observed, zscore = observed[np.ix_(keep, keep)], zscore[np.ix_(keep, keep)]
+    return {
+        "keys": keys,
+        "markers": int(selected.sum()),
+        "edges": int(len(sources)),
+        "count": observed.tolist(),
+        "zscore": zscore.tolist(),
+    }
+
+
+def parse_distances(distances):
+    """Return co-occurrence distances as floats, checked by :func:`graph.parse_length`.
+
+    Raises ``ValueError`` unless ``distances`` is a list of 1 to
+    ``MAX_DISTANCES`` valid lengths.
+    """
+    if not isinstance(distances, list) or not 1 <= len(distances) <= MAX_DISTANCES:
+        raise ValueError("Distances must be a list of 1 to %d lengths" % MAX_DISTANCES)
+    return [graph.parse_length(d) for d in distances]
+
+
+def cooccurrence(markerFile, key, x="x", y="y", distances=(50,), region=None):
+    """Co-occurrence ratio ``P(b | a within d) / P(b)`` for every distance ``d``.
+
+    Pairs come from the cached radius graph at the largest distance,
+    restricted to markers inside ``region`` if given.
+    """
+    distances = sorted(float(d) for d in distances)
+    graphSpec = {"type": "radius", "radius": distances[-1], "X": x, "Y": y}
+    edges, lengths = graph.get_graph(markerFile, graphSpec)
+    keys, codes, selected = _selection(markerFile, key, x, y, region)
+    sources, targets, keep = _local_edges(edges, selected)
+    lengths = np.asarray(lengths)[keep]
+    labels = np.asarray(codes[selected], dtype=np.int64)
+    nkeys = len(keys)
+    frequency = np.bincount(labels, minlength=nkeys) / max(len(labels), 1)
+    ratios = []
+    for distance in distances:
+        within = lengths <= distance
+        counts = _pair_counts(sources[within], targets[within], labels, nkeys)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            conditional = counts / counts.sum(axis=1, keepdims=True)
+            ratio = conditional / frequency[None, :]
+        ratio[~np.isfinite(ratio)] = 0
+        ratios.append(ratio)
+    if "" in keys:
+        keep = [i for i, k in enumerate(keys) if k != ""]
+        keys = [keys[i] for i in keep]
+        ratios = [r[np.ix_(keep, keep)] for r in ratios]
+    return {
+        "keys": keys,
+        "markers": int(selected.sum()),
+        "distances": distances,
+        "ratio": [r.tolist() for r in ratios],
+    }
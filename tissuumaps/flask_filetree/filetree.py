@@ -17,7 +17,7 @@ def get_files(d, fnfilter, dfilter, rel=True):
                 ffn = os.path.join(d, fn)
                 if not rel:
                     fn = ffn
-                if os.path.isdir(ffn):
+                if os.path.isdir(ffn) and not fnfilter(ffn):
                     if dfilter(ffn):
                         dirs.append(fn)
                 else:
@@ -0,0 +1,284 @@
+#
+# Neighbourhood graphs over marker coordinates for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import math
+import os
+import uuid
+
+import numpy as np
+from scipy.spatial import Delaunay
+
+try:
+    from scipy.spatial import QhullError
+except ImportError:
+    from scipy.spatial.qhull import QhullError
+
+from tissuumaps.markertiles import spec_id
+from tissuumaps.parallel import WORKERS, process_pool
+from tissuumaps.spatial import KDTreeIndex
+
+GRAPH_TYPES = ["knn", "radius", "delaunay"]
+# Largest k and lengths a request may ask for: graphs grow with both and
+# are kept on disk, one per spec
+MAX_K = 50
+MAX_LENGTH = 1000.0
+# Average number of points per spatial chunk
+CHUNK_POINTS = 1 << 18
+# Overlap of the Delaunay chunks, in average point spacings
+DELAUNAY_OVERLAP = 16
+
+
+def _points_tree(markerFile, x, y):
+    tree = markerFile.kdtree(x, y)
+    if not isinstance(tree, KDTreeIndex):
+        # Virtual files keep one tree per member: build one over all rows
+        tree = markerFile.derived(
+            ("kdtree-merged", x, y),
+            lambda: KDTreeIndex(markerFile.table.numeric(x), markerFile.table.numeric(y)),
+        )
+    return tree
+
+
+class _Chunks(object):
+    """Square spatial chunks of about ``CHUNK_POINTS`` points each."""
+
+    def __init__(self, points):
+        self.points = points
+        count = len(points)
+        if count:
+            self.xmin, self.ymin = points.min(axis=0)
+            xmax, ymax = points.max(axis=0)
+        else:
+            self.xmin = self.ymin = xmax = ymax = 0.0
+        self.extent = max(xmax - self.xmin, ymax - self.ymin, 1e-9)
+        self.tiles = max(int(math.ceil(math.sqrt(count / CHUNK_POINTS))), 1)
+        self.size = self.extent / self.tiles
+        self.spacing = self.extent / max(math.sqrt(count), 1)
+        tileIds = self.tile_ids(points)
+        self.order = np.argsort(tileIds, kind="stable")
+        self.offsets = np.searchsorted(
+            tileIds[self.order], np.arange(self.tiles * self.tiles + 1)
+        )
+
+    def tile_ids(self, points):
+        col = np.minimum((points[:, 0] - self.xmin) // self.size, self.tiles - 1)
+        row = np.minimum((points[:, 1] - self.ymin) // self.size, self.tiles - 1)
+        return row.astype(np.int64) * self.tiles + col.astype(np.int64)
+
+    def positions(self, row, col):
+        """Return the positions of the points of one chunk."""
+        if not (0 <= row < self.tiles and 0 <= col < self.tiles):
+            return np.zeros(0, dtype=np.int64)
+        tile = row * self.tiles + col
+        return self.order[self.offsets[tile] : self.offsets[tile + 1]]
+
+    def __iter__(self):
+        for row in range(self.tiles):
+            for col in range(self.tiles):
+                yield row, col
+
+
+def _knn_chunk(tree, positions, k):
+    if len(positions) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    count = len(tree.points)
+    distances, neighbours = tree.tree.query(tree.points[positions], k=min(k + 1, count))
+    neighbours = neighbours.reshape(len(positions), -1)
+    distances = distances.reshape(len(positions), -1)
+    # Drop the point itself (not always first with duplicates) and keep k
+    valid = (neighbours != positions[:, None]) & np.isfinite(distances)
+    valid &= np.cumsum(valid, axis=1) <= k
+    sources = np.broadcast_to(positions[:, None], neighbours.shape)[valid]
+    return np.column_stack([sources, neighbours[valid]])
+
+
+def _radius_chunk(tree, positions, radius):
+    if len(positions) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    neighbours = tree.tree.query_ball_point(
+        tree.points[positions], radius, return_sorted=False
+    )
+    lengths = np.array([len(n) for n in neighbours], dtype=np.int64)
+    targets = (
+        np.concatenate(neighbours).astype(np.int64)
+        if lengths.sum()
+        else np.zeros(0, dtype=np.int64)
+    )
+    sources = np.repeat(positions, lengths)
+    # Undirected: keep every pair once
+    keep = sources < targets
+    return np.column_stack([sources[keep], targets[keep]])
+
+
+def _delaunay_chunk(points, positions, tiles, core):
+    """Delaunay edges of a chunk and its overlap, kept if their middle is in ``core``."""
+    if len(positions) < 3:
+        return np.zeros((0, 2), dtype=np.int64)
+    try:
+        triangulation = Delaunay(points)
+    except QhullError:
+        return np.zeros((0, 2), dtype=np.int64)
+    simplices = triangulation.simplices
+    edges = np.concatenate([simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [0, 2]]])
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    middles = (points[edges[:, 0]] + points[edges[:, 1]]) / 2
+    xmin, ymin, size, count = tiles
+    col = np.minimum((middles[:, 0] - xmin) // size, count - 1)
+    row = np.minimum((middles[:, 1] - ymin) // size, count - 1)
+    edges = edges[(row == core[0]) & (col == core[1])]
+    edges = positions[edges]
+    return np.sort(edges, axis=1)
+
+
+def parse_length(value):
+    """Return a radius or edge length as a float in ``(0, MAX_LENGTH]``.
+
+    Raises ``ValueError`` for anything else.
+    """
+    if isinstance(value, bool):
+        raise ValueError("Lengths must be numbers")
+    try:
+        value = float(value)
+    except TypeError:
+        raise ValueError("Lengths must be numbers")
+    if not math.isfinite(value) or value <= 0 or value > MAX_LENGTH:
+        raise ValueError("Lengths must be in (0, %g]" % MAX_LENGTH)
+    return value
+
+
+def parse_spec(params):
+    """Validate a graph description: ``type``, ``k``, ``radius`` and ``maxLength``.
+
+    Returns a spec with only these keys, converted: ``k`` in ``[1, MAX_K]``
+    for kNN graphs, lengths as by :func:`parse_length`. Raises
+    ``ValueError`` for unknown types, missing or invalid values.
+    """
+    if not isinstance(params, dict):
+        raise ValueError("A graph is described by an object")
+    spec = {"type": params.get("type", "knn")}
+    if not isinstance(spec["type"], str) or spec["type"] not in GRAPH_TYPES:
+        raise ValueError("Unknown graph type: %s" % spec["type"])
+    if spec["type"] == "knn":
+        k = params.get("k", 6)
+        if isinstance(k, bool) or isinstance(k, float) and not k.is_integer():
+            raise ValueError("k must be an integer")
+        try:
+            k = int(k)
+        except TypeError:
+            raise ValueError("k must be an integer")
+        if not 1 <= k <= MAX_K:
+            raise ValueError("k must be in [1, %d]" % MAX_K)
+        spec["k"] = k
+    elif spec["type"] == "radius":
+        if params.get("radius") is None:
+            raise ValueError("A radius is needed for a radius graph")
+        spec["radius"] = parse_length(params["radius"])
+    if params.get("maxLength") is not None:
+        spec["maxLength"] = parse_length(params["maxLength"])
+    return spec
+
+
+def build_graph(markerFile, x, y, graphType="knn", k=6, radius=None):
+    """Return ``(edges, distances)`` of a neighbourhood graph over the markers.
+
+    ``edges`` are pairs of row indices. The kNN graph is directed (each
+    point to its ``k`` nearest neighbours); radius and Delaunay graphs are
+    undirected with every edge once. Points are processed in spatial
+    chunks: KD-tree queries run in threads, Delaunay chunks in processes
+    with an overlap of ``DELAUNAY_OVERLAP`` average spacings, so edges
+    longer than the overlap can differ from a global triangulation near
+    chunk borders.
+    """
+    if graphType not in GRAPH_TYPES:
+        raise ValueError("Unknown graph type: %s" % graphType)
+    tree = _points_tree(markerFile, x, y)
+    chunks = _Chunks(tree.points)
+    if graphType == "delaunay":
+        margin = min(chunks.spacing * DELAUNAY_OVERLAP, chunks.size)
+        tiles = (chunks.xmin, chunks.ymin, chunks.size, chunks.tiles)
+        tasks = []
+        for row, col in chunks:
+            if len(chunks.positions(row, col)) == 0:
+                continue
+            positions = np.concatenate(
+                [
+                    chunks.positions(row + dr, col + dc)
+                    for dr in (-1, 0, 1)
+                    for dc in (-1, 0, 1)
+                ]
+            )
+            x0 = chunks.xmin + col * chunks.size - margin
+            y0 = chunks.ymin + row * chunks.size - margin
+            x1 = x0 + chunks.size + 2 * margin
+            y1 = y0 + chunks.size + 2 * margin
+            points = tree.points[positions]
+            inside = (
+                (points[:, 0] >= x0)
+                & (points[:, 0] <= x1)
+                & (points[:, 1] >= y0)
+                & (points[:, 1] <= y1)
+            )
+            tasks.append((tree.points[positions[inside]], positions[inside], tiles, (row, col)))
+        if len(tasks) > 1 and WORKERS > 1:
+            results = list(process_pool().map(_delaunay_chunk, *zip(*tasks)))
+        else:
+            results = [_delaunay_chunk(*task) for task in tasks]
+    else:
+        if graphType == "knn":
+            query = lambda positions: _knn_chunk(tree, positions, int(k))
+        else:
+            if radius is None:
+                raise ValueError("A radius is needed for a radius graph")
+            query = lambda positions: _radius_chunk(tree, positions, float(radius))
+        with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+            results = list(
+                executor.map(lambda tile: query(chunks.positions(*tile)), chunks)
+            )
+    edges = np.concatenate(results) if results else np.zeros((0, 2), dtype=np.int64)
+    distances = np.hypot(*(tree.points[edges[:, 0]] - tree.points[edges[:, 1]]).T)
+    return tree.rows[edges], distances
+
+
+def get_graph(markerFile, spec):
+    """Return the ``(edges, distances)`` of :func:`build_graph` for ``spec``.
+
+    Graphs are kept as ``uint32`` edges and ``float32`` distances in the
+    ``graphs`` folder of the column store, until the marker file changes.
+    """
+    graphPath = os.path.join(markerFile.storePath, "graphs", spec_id(spec))
+    try:
+        with open(graphPath + ".json") as f:
+            if json.load(f).get("source") == markerFile.signature:
+                return (
+                    np.load(graphPath + ".edges.npy", mmap_mode="r"),
+                    np.load(graphPath + ".distances.npy", mmap_mode="r"),
+                )
+    except (OSError, ValueError):
+        pass
+    logging.info("Building %s graph of %s" % (spec["type"], markerFile.path))
+    edges, distances = build_graph(
+        markerFile, spec["X"], spec["Y"], spec["type"], spec.get("k", 6), spec.get("radius")
+    )
+    maxLength = spec.get("maxLength")
+    if maxLength is not None:
+        keep = distances <= float(maxLength)
+        edges, distances = edges[keep], distances[keep]
+    edges = edges.astype(np.uint32)
+    distances = distances.astype(np.float32)
+    os.makedirs(os.path.dirname(graphPath), exist_ok=True)
+    tmp = "." + uuid.uuid4().hex[:8]
+    np.save(graphPath + tmp + ".edges.npy", edges)
+    np.save(graphPath + tmp + ".distances.npy", distances)
+    os.replace(graphPath + tmp + ".edges.npy", graphPath + ".edges.npy")
+    os.replace(graphPath + tmp + ".distances.npy", graphPath + ".distances.npy")
+    with open(graphPath + tmp + ".json", "w") as f:
+        json.dump({"source": markerFile.signature, "spec": spec}, f)
+    os.replace(graphPath + tmp + ".json", graphPath + ".json")
+    return edges, distances
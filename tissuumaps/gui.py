@@ -1,4 +1,9 @@
 import logging
+import multiprocessing
+if __name__ == '__main__':
+    # In the standalone build, process pool workers run this script too:
+    # they start working here, before the GUI is imported.
+    multiprocessing.freeze_support()
 try:
     from PyQt5.QtCore import *
     from PyQt5.QtWebEngineWidgets import *
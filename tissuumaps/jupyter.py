@@ -104,7 +104,7 @@ def loaddata (images=[], csvFiles=[], xSelector="x", ySelector="y", keySelector=
               fixedShape=None, scaleFactor=1,
               colormap=None,
               compositeMode="source-over",
-              boundingBox=None,
+              boundingBox=None, sourceColumn=None,
               port=5100, height=700, tmapFilename="_project"):
     # make str input to arrays:
     if isinstance(images, str):
@@ -171,6 +171,12 @@ def loaddata (images=[], csvFiles=[], xSelector="x", ySelector="y", keySelector=
             }
         if len(csvFiles) == 1:
             csvFiles = csvFiles[0]
+        else:
+            # Serve all files as one virtual marker file
+            markersFile = os.path.join(rootPath,f"{tmapFilename}.markers")
+            with open(markersFile, "w") as f:
+                json.dump({"files": csvFiles, "sourceColumn": sourceColumn}, f)
+            csvFiles = f"{tmapFilename}.markers"
         jsonTmap["markerFiles"] = [{
             "comment": "All markers",
             "path": csvFiles,
@@ -0,0 +1,305 @@
+#
+# Conversion of label images to GeoJSON regions for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+import json
+import logging
+import os
+import uuid
+
+import numpy as np
+
+from tissuumaps.celljoin import LabelImage
+from tissuumaps.markers import _signature, cache_path
+from tissuumaps.parallel import WORKERS, process_pool
+
+TILE_SIZE = 2048
+DEFAULT_TOLERANCE = 1.0
+
+
+def _runs(major, minor, labels):
+    """Merge consecutive ``minor`` positions with the same ``major`` and label."""
+    if len(labels) == 0:
+        return labels, major, minor, minor
+    breaks = np.ones(len(labels), dtype=bool)
+    breaks[1:] = (
+        (major[1:] != major[:-1])
+        | (minor[1:] != minor[:-1] + 1)
+        | (labels[1:] != labels[:-1])
+    )
+    starts = np.flatnonzero(breaks)
+    ends = np.append(starts[1:], len(labels)) - 1
+    return labels[starts], major[starts], minor[starts], minor[ends]
+
+
+def _tile_segments(block, r0, c0):
+    """Boundary segments of the labels of ``block[1:-1, 1:-1]``.
+
+    ``block`` has a one pixel halo. Segments run along pixel edges with the
+    label on their right (image coordinates, y down), so outer rings and
+    holes wind in opposite directions. Returns ``(label, sx, sy, ex, ey)``.
+    """
+    inner = block[1:-1, 1:-1]
+    pieces = []
+    # Top and bottom edges, merged along rows
+    for neighbour, bottom in ((block[:-2, 1:-1], False), (block[2:, 1:-1], True)):
+        rows, cols = np.nonzero((inner != neighbour) & (inner != 0))
+        labels, r, ca, cb = _runs(rows, cols, inner[rows, cols])
+        y = r + r0 + (1 if bottom else 0)
+        if bottom:
+            pieces.append((labels, cb + c0 + 1, y, ca + c0, y))
+        else:
+            pieces.append((labels, ca + c0, y, cb + c0 + 1, y))
+    # Left and right edges, merged along columns
+    for neighbour, right in ((block[1:-1, :-2], False), (block[1:-1, 2:], True)):
+        cols, rows = np.nonzero(((inner != neighbour) & (inner != 0)).T)
+        labels, c, ra, rb = _runs(cols, rows, inner[rows, cols])
+        x = c + c0 + (1 if right else 0)
+        if right:
+            pieces.append((labels, x, ra + r0, x, rb + r0 + 1))
+        else:
+            pieces.append((labels, x, rb + r0 + 1, x, ra + r0))
+    return tuple(
+        np.concatenate([p[i] for p in pieces]).astype(np.int64) for i in range(5)
+    )
+
+
+def _trace(sx, sy, ex, ey):
+    """Chain the segments of one label into closed rings of vertices."""
+    starts = {}
+    for i, start in enumerate(zip(sx.tolist(), sy.tolist())):
+        starts.setdefault(start, []).append(i)
+    used = np.zeros(len(sx), dtype=bool)
+    rings = []
+    for first in range(len(sx)):
+        if used[first]:
+            continue
+        ring = []
+        i = first
+        while not used[i]:
+            used[i] = True
+            ring.append((sx[i], sy[i]))
+            end = (ex[i], ey[i])
+            candidates = [j for j in starts.get(end, []) if not used[j]]
+            if not candidates:
+                break
+            if len(candidates) > 1:
+                # Pinch point: turn right to stay on the same pixel
+                dx, dy = np.sign(ex[i] - sx[i]), np.sign(ey[i] - sy[i])
+                for j in candidates:
+                    if (np.sign(ex[j] - sx[j]), np.sign(ey[j] - sy[j])) == (-dy, dx):
+                        candidates = [j]
+                        break
+            i = candidates[0]
+        ring.append(ring[0])
+        rings.append(np.array(ring, dtype=np.int64))
+    return rings
+
+
+def _simplify_path(points, tolerance):
+    """Douglas-Peucker simplification of an open path, keeping both ends."""
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first].astype(np.float64), points[last].astype(np.float64)
+        inner = points[first + 1 : last].astype(np.float64)
+        direction = end - start
+        length = np.hypot(*direction)
+        if length == 0:
+            distances = np.hypot(*(inner - start).T)
+        else:
+            offsets = inner - start
+            distances = (
+                np.abs(direction[0] * offsets[:, 1] - direction[1] * offsets[:, 0])
+                / length
+            )
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return points[keep]
+
+
+def simplify_ring(ring, tolerance):
+    """Simplify a closed ring, kept as is if simplifying leaves no area."""
+    points = ring[:-1]
+    if len(points) < 3:
+        return None
+    # Split at the vertex farthest from the first one
+    split = int(np.argmax(np.hypot(*(points - points[0]).T)))
+    head = _simplify_path(points[: split + 1], tolerance)
+    tail = _simplify_path(np.concatenate([points[split:], points[:1]]), tolerance)
+    simplified = np.concatenate([head, tail[1:]])
+    if len(simplified) < 4 or _area(simplified) == 0:
+        return ring if _area(ring) != 0 else None
+    return simplified
+
+
+def _area(ring):
+    """Signed area of a closed ring: positive for outer rings, negative for holes."""
+    x, y = ring[:, 0].astype(np.float64), ring[:, 1].astype(np.float64)
+    return float(np.dot(x[:-1], y[1:]) - np.dot(x[1:], y[:-1])) / 2
+
+
+def _rings_by_label(labels, sx, sy, ex, ey, tolerance):
+    if len(labels) == 0:
+        return {}
+    order = np.argsort(labels, kind="stable")
+    labels, sx, sy, ex, ey = labels[order], sx[order], sy[order], ex[order], ey[order]
+    bounds = np.flatnonzero(np.diff(labels)) + 1
+    result = {}
+    for start, stop in zip(np.r_[0, bounds], np.r_[bounds, len(labels)]):
+        rings = []
+        rows = slice(start, stop)
+        for ring in _trace(sx[rows], sy[rows], ex[rows], ey[rows]):
+            ring = simplify_ring(ring, tolerance)
+            if ring is not None:
+                rings.append(ring)
+        result[int(labels[start])] = rings
+    return result
+
+
+def _trace_tile(path, r0, c0, height, width, tolerance):
+    """Worker: rings of the labels inside one tile, segments of those on its border."""
+    image = LabelImage(path)
+    top, left = max(r0 - 1, 0), max(c0 - 1, 0)
+    bottom = min(r0 + height + 1, image.height)
+    right = min(c0 + width + 1, image.width)
+    block = np.zeros((height + 2, width + 2), dtype=np.int64)
+    block[
+        top - r0 + 1 : bottom - r0 + 1, left - c0 + 1 : right - c0 + 1
+    ] = image.read(left, top, right - left, bottom - top)
+    labels, sx, sy, ex, ey = _tile_segments(block, r0, c0)
+    inner = block[1:-1, 1:-1]
+    border = np.unique(
+        np.concatenate([inner[0], inner[-1], inner[:, 0], inner[:, -1]])
+    )
+    onBorder = np.isin(labels, border)
+    inside = ~onBorder
+    rings = _rings_by_label(
+        labels[inside], sx[inside], sy[inside], ex[inside], ey[inside], tolerance
+    )
+    segments = tuple(a[onBorder] for a in (labels, sx, sy, ex, ey))
+    return rings, segments
+
+
+def _inside_ring(point, ring):
+    x, y = point
+    x1, y1 = ring[:-1, 0], ring[:-1, 1]
+    x2, y2 = ring[1:, 0], ring[1:, 1]
+    spans = (y1 > y) != (y2 > y)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        crossing = (x2 - x1) * (y - y1) / (y2 - y1) + x1
+    return bool(np.count_nonzero(spans & (x < crossing)) % 2)
+
+
+def _polygons(rings):
+    """Group rings into GeoJSON MultiPolygon coordinates: outers with their holes."""
+    if len(rings) == 1:
+        return [[rings[0].tolist()]]
+    outers = [r for r in rings if _area(r) > 0]
+    polygons = [[r.tolist()] for r in outers]
+    for hole in (r for r in rings if _area(r) <= 0):
+        for outer, polygon in zip(outers, polygons):
+            if _inside_ring((hole[0] + hole[1]) / 2, outer):
+                polygon.append(hole.tolist())
+                break
+        else:
+            polygons.append([hole.tolist()])
+    return polygons
+
+
+def label_regions(path, tolerance=DEFAULT_TOLERANCE, tileSize=TILE_SIZE):
+    """Yield one GeoJSON feature per label of the label image at ``path``.
+
+    Tiles are traced in a process pool. Labels entirely inside a tile are
+    traced and simplified there; labels crossing tile borders are traced
+    once all their segments are gathered. Coordinates are image pixels.
+    """
+    image = LabelImage(path)
+    tasks = [
+        (
+            path,
+            r0,
+            c0,
+            min(tileSize, image.height - r0),
+            min(tileSize, image.width - c0),
+            tolerance,
+        )
+        for r0 in range(0, image.height, tileSize)
+        for c0 in range(0, image.width, tileSize)
+    ]
+    if len(tasks) > 1 and WORKERS > 1:
+        results = process_pool().map(_trace_tile, *zip(*tasks))
+    else:
+        results = (_trace_tile(*task) for task in tasks)
+    rings = {}
+    segments = []
+    for tileRings, tileSegments in results:
+        for label, labelRings in tileRings.items():
+            rings.setdefault(label, []).extend(labelRings)
+        segments.append(tileSegments)
+    if segments:
+        merged = [np.concatenate([s[i] for s in segments]) for i in range(5)]
+        for label, labelRings in _rings_by_label(*merged, tolerance).items():
+            rings.setdefault(label, []).extend(labelRings)
+    for label in sorted(rings):
+        if not rings[label]:
+            continue
+        yield {
+            "type": "Feature",
+            "geometry": {
+                "type": "MultiPolygon",
+                "coordinates": _polygons(rings[label]),
+            },
+            "properties": {
+                "name": str(label),
+                "classification": {"name": ""},
+                "isLocked": False,
+            },
+        }
+
+
+def get_label_regions(path, tolerance=DEFAULT_TOLERANCE):
+    """Return the path of the GeoJSON regions of a label image, converting it if needed.
+
+    The GeoJSON file is cached in the ``.tissuumaps`` folder of the image
+    until the image changes.
+    """
+    outputPath = cache_path(path, ".regions-%g.geojson" % tolerance)
+    source = _signature(path)
+    try:
+        with open(outputPath + ".json") as f:
+            if json.load(f).get("source") == source and os.path.isfile(outputPath):
+                return outputPath
+    except (OSError, ValueError):
+        pass
+    logging.info("Tracing the labels of %s" % path)
+    os.makedirs(os.path.dirname(outputPath), exist_ok=True)
+    tmpPath = outputPath + ".tmp-" + uuid.uuid4().hex[:8]
+    count = 0
+    try:
+        with open(tmpPath, "w") as f:
+            f.write('{"type": "FeatureCollection", "features": [')
+            for feature in label_regions(path, tolerance):
+                f.write(("," if count else "") + "\n" + json.dumps(feature))
+                count += 1
+            f.write("\n]}\n")
+        os.replace(tmpPath, outputPath)
+    except:
+        if os.path.isfile(tmpPath):
+            os.remove(tmpPath)
+        raise
+    with open(outputPath + ".json", "w") as f:
+        json.dump({"source": source, "features": count}, f)
+    logging.info("Wrote %d regions to %s" % (count, outputPath))
+    return outputPath
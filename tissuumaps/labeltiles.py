@@ -0,0 +1,108 @@
+#
+# Label mask layers with server-side recolouring for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+import numpy as np
+
+from tissuumaps.markertiles import _hex_to_rgb, deterministic_color
+
+DOWNSAMPLING = ["nearest", "mode"]
+# Side of the blocks reduced to their most frequent label in "mode" downsampling
+MODE_BLOCK = 4
+# Largest cell id kept in a dense lookup table; sparse ids are searched
+DENSE_LUT_MAX = 1 << 22
+
+
+class LabelColors(object):
+    """Lookup table from cell ids to RGBA colours, read from a marker file.
+
+    ``cellColumn`` holds the label of every cell in the mask and
+    ``colorColumn`` either a ``#rrggbb`` colour or a category, coloured as
+    the client colours marker keys unless given in ``colors``. Cells that
+    are not in the table, or have an empty category, are transparent.
+    """
+
+    def __init__(self, markerFile, cellColumn, colorColumn, colors=None):
+        colors = colors or {}
+        ids = np.asarray(markerFile.table.numeric(cellColumn), dtype=np.float64)
+        keys, codes = markerFile.key_codes(colorColumn)
+        palette = np.zeros((len(keys), 4), dtype=np.uint8)
+        for i, key in enumerate(keys):
+            if key in colors:
+                palette[i] = _hex_to_rgb(colors[key]) + [255]
+            elif key.startswith("#"):
+                palette[i] = _hex_to_rgb(key) + [255]
+            elif key != "":
+                palette[i] = deterministic_color(key) + [255]
+        valid = np.isfinite(ids) & (ids > 0)
+        ids = ids[valid].astype(np.int64)
+        rgba = palette[np.asarray(codes)[valid]]
+        if len(ids) == 0 or ids.max() <= DENSE_LUT_MAX:
+            self.dense = np.zeros((ids.max() + 1 if len(ids) else 1, 4), dtype=np.uint8)
+            self.dense[ids] = rgba
+        else:
+            self.dense = None
+            order = np.argsort(ids, kind="stable")
+            self.ids, self.rgba = ids[order], rgba[order]
+
+    def __call__(self, labels):
+        """Return the ``(height, width, 4)`` colours of a label array."""
+        result = np.zeros(labels.shape + (4,), dtype=np.uint8)
+        if self.dense is not None:
+            known = (labels >= 0) & (labels < len(self.dense))
+            result[known] = self.dense[labels[known]]
+        elif len(self.ids):
+            positions = np.minimum(np.searchsorted(self.ids, labels), len(self.ids) - 1)
+            known = self.ids[positions] == labels
+            result[known] = self.rgba[positions[known]]
+        return result
+
+
+def random_colors(labels):
+    """Colour every label by a hash of its id; background (0) is transparent."""
+    hashed = (labels.astype(np.uint64) * np.uint64(2654435761)) & np.uint64(0xFFFFFF)
+    result = np.empty(labels.shape + (4,), dtype=np.uint8)
+    for channel in range(3):
+        # Keep colours away from black
+        result[..., channel] = 64 + ((hashed >> np.uint64(8 * channel)) & np.uint64(0xFF)) * 191 // 255
+    result[..., 3] = np.where(labels != 0, 255, 0)
+    return result
+
+
+def _block_mode(labels, block):
+    """Most frequent label of every ``block`` x ``block`` block; ties go to the smallest."""
+    height, width = labels.shape[0] // block, labels.shape[1] // block
+    blocks = (
+        labels.reshape(height, block, width, block)
+        .transpose(0, 2, 1, 3)
+        .reshape(height, width, block * block)
+    )
+    blocks = np.sort(blocks, axis=2)
+    counts = (blocks[..., :, None] == blocks[..., None, :]).sum(axis=3)
+    best = np.argmax(counts, axis=2)
+    return np.take_along_axis(blocks, best[..., None], axis=2)[..., 0]
+
+
+def read_label_tile(labelImage, slide, level, col, row, downsample="nearest"):
+    """Labels of one DeepZoom tile of ``slide``, read from the label image.
+
+    Labels are never averaged: ``nearest`` keeps the label at the centre of
+    every tile pixel, ``mode`` the most frequent of ``MODE_BLOCK`` x
+    ``MODE_BLOCK`` samples per tile pixel. Raises ``ValueError`` for
+    invalid tile addresses, as ``DeepZoomGenerator`` does.
+    """
+    (x0, y0), _, _ = slide.get_tile_coordinates(level, (col, row))
+    width, height = slide.get_tile_dimensions(level, (col, row))
+    scale = 2 ** (slide.level_count - 1 - level)
+    block = min(MODE_BLOCK, scale) if downsample == "mode" else 1
+    step = scale // block
+    offset = step // 2
+    labels = labelImage.read(
+        x0 + offset, y0 + offset, width * block * step, height * block * step, step
+    )
+    if block > 1:
+        labels = _block_mode(labels, block)
+    return labels
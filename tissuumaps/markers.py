@@ -0,0 +1,1021 @@
+#
+# Columnar marker tables for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+from collections import OrderedDict
+import io
+import json
+import logging
+import math
+import os
+import shutil
+from threading import Lock
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from tissuumaps.spatial import ConcatGridIndex, ConcatKDTreeIndex, GridIndex, KDTreeIndex
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+STORE_VERSION = 1
+MARKER_EXTENSIONS = ["csv", "h5ad", "parquet", "markers"]
+CSV_CHUNK_ROWS = 1000000
+# Number of rows encoded per chunk when streaming CSV back to the client
+STREAM_CHUNK_ROWS = 100000
+# Most keys of a column the table is grouped by: more is a continuous
+# column, whose grouped copy would hold one key per row
+MAX_GROUP_KEYS = 10000
+
+
+def cache_path(path, suffix):
+    """Return the path of a file derived from ``path`` in its ``.tissuumaps`` folder."""
+    return os.path.join(
+        os.path.dirname(path), ".tissuumaps", os.path.basename(path) + suffix
+    )
+
+
+def _signature(path):
+    stat = os.stat(path)
+    return {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def _save(filename, array):
+    np.save(filename, np.ascontiguousarray(array))
+
+
+def _load(filename):
+    array = np.load(filename, mmap_mode="r")
+    return array
+
+
+def _open_output(filename, dtype, length):
+    if length == 0:
+        _save(filename, np.zeros(0, dtype=dtype))
+        return None
+    return np.lib.format.open_memmap(filename, mode="w+", dtype=dtype, shape=(length,))
+
+
+def _encode(values, mapping):
+    """Encode ``values`` as int32 codes into ``mapping`` (value -> code), -1 for missing."""
+    codes, uniques = pd.factorize(pd.Series(values), use_na_sentinel=True)
+    lut = np.array(
+        [mapping.setdefault(str(u), len(mapping)) for u in uniques] + [-1],
+        dtype=np.int32,
+    )
+    return lut[codes]
+
+
+def format_key(value):
+    """Format a group key the way it appears in the CSV file."""
+    if isinstance(value, (float, np.floating)):
+        if math.isnan(value):
+            return ""
+        if float(value).is_integer():
+            return str(int(value))
+    return str(value)
+
+
+def _write_table(storePath, signature, nrows, columns):
+    """Write ``meta.json`` of a column store whose ``.npy`` files already exist."""
+    meta = {
+        "version": STORE_VERSION,
+        "source": signature,
+        "nrows": int(nrows),
+        "columns": columns,
+    }
+    with open(os.path.join(storePath, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+
+def _replace_dir(tmpPath, path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmpPath, path)
+
+
+def _convert_csv(path, storePath):
+    """Convert a CSV marker file into a column store, one chunk at a time."""
+    tmpPath = storePath + ".tmp-" + uuid.uuid4().hex[:8]
+    os.makedirs(tmpPath)
+    try:
+        columns = None
+        chunkArrays = []
+        mappings = []
+        isText = []
+        nrows = 0
+        for chunkIndex, chunk in enumerate(
+            pd.read_csv(path, chunksize=CSV_CHUNK_ROWS, low_memory=False)
+        ):
+            if columns is None:
+                columns = [str(c) for c in chunk.columns]
+                chunkArrays = [[] for _ in columns]
+                mappings = [{} for _ in columns]
+                isText = [False for _ in columns]
+            for index, name in enumerate(chunk.columns):
+                series = chunk[name]
+                filename = os.path.join(tmpPath, "%d.%d.npy" % (index, chunkIndex))
+                if series.dtype.kind in "biuf":
+                    _save(filename, series.to_numpy())
+                    chunkArrays[index].append((filename, False))
+                else:
+                    isText[index] = True
+                    _save(filename, _encode(series.to_numpy(), mappings[index]))
+                    chunkArrays[index].append((filename, True))
+            nrows += len(chunk)
+        if columns is None:
+            columns = [str(c) for c in pd.read_csv(path, nrows=0).columns]
+            chunkArrays = [[] for _ in columns]
+            mappings = [{} for _ in columns]
+            isText = [False for _ in columns]
+
+        description = []
+        for index, name in enumerate(columns):
+            filename = "%d.npy" % index
+            if isText[index]:
+                dtype = np.int32
+            elif chunkArrays[index]:
+                dtype = np.result_type(
+                    *[np.load(f, mmap_mode="r").dtype for f, _ in chunkArrays[index]]
+                )
+            else:
+                dtype = np.float64
+            out = _open_output(os.path.join(tmpPath, filename), dtype, nrows)
+            offset = 0
+            for chunkFile, encoded in chunkArrays[index]:
+                values = np.load(chunkFile)
+                if isText[index] and not encoded:
+                    # Column switched from numbers to text in a later chunk
+                    values = _encode(
+                        [format_key(v) if not pd.isna(v) else None for v in values],
+                        mappings[index],
+                    )
+                out[offset : offset + len(values)] = values
+                offset += len(values)
+                os.remove(chunkFile)
+            if out is not None:
+                out.flush()
+                del out
+            column = {"name": name, "file": filename, "kind": "numeric"}
+            if isText[index]:
+                column["kind"] = "category"
+                column["categories"] = "%d.categories.json" % index
+                categories = [None] * len(mappings[index])
+                for value, code in mappings[index].items():
+                    categories[code] = value
+                with open(os.path.join(tmpPath, column["categories"]), "w") as f:
+                    json.dump(categories, f)
+            description.append(column)
+        _write_table(tmpPath, _signature(path), nrows, description)
+        _replace_dir(tmpPath, storePath)
+    except:
+        shutil.rmtree(tmpPath, ignore_errors=True)
+        raise
+
+
+class _Table(object):
+    """Operations shared by all marker tables.
+
+    Subclasses set ``nrows`` and ``columns`` and implement :meth:`column`
+    (raw values, int32 codes for text columns) and :meth:`categories`.
+    """
+
+    def __len__(self):
+        return self.nrows
+
+    def is_category(self, name):
+        return self.categories(name) is not None
+
+    def values(self, name, rows=slice(None)):
+        """Return the decoded values of a column for ``rows``."""
+        data = self.column(name)[rows]
+        categories = self.categories(name)
+        if categories is None:
+            return np.asarray(data)
+        return pd.Categorical.from_codes(data, categories=categories)
+
+    def numeric(self, name, rows=slice(None)):
+        """Return a column for ``rows`` as float64 (codes for text columns)."""
+        return np.asarray(self.column(name)[rows], dtype=np.float64)
+
+    def frame(self, columns=None, rows=slice(None)):
+        if columns is None:
+            columns = self.columns
+        return pd.DataFrame(
+            OrderedDict((name, self.values(name, rows)) for name in columns)
+        )
+
+    def key_codes(self, name):
+        """Return ``(keys, codes)`` grouping the rows by the values of a column.
+
+        ``keys`` are formatted as in the CSV file and missing values are
+        grouped under the empty key.
+        """
+        categories = self.categories(name)
+        if categories is not None:
+            keys = list(categories)
+            codes = np.asarray(self.column(name), dtype=np.int32)
+        else:
+            uniques, codes = np.unique(self.column(name), return_inverse=True)
+            codes = codes.astype(np.int32).ravel()
+            keys = [format_key(u) for u in uniques]
+            if len(uniques) and isinstance(uniques[-1], np.floating):
+                missing = np.isnan(uniques)
+                if missing.any():
+                    # np.unique keeps NaNs at the end
+                    firstMissing = int(np.argmax(missing))
+                    codes[codes >= firstMissing] = -1
+                    keys = keys[:firstMissing]
+        if (codes < 0).any():
+            codes = codes.copy()
+            codes[codes < 0] = len(keys)
+            keys.append("")
+        return keys, codes
+
+    def to_csv(self, columns=None, rows=slice(None), header=True):
+        """Yield ``rows`` of the table as CSV text, in bounded chunks."""
+        if columns is None:
+            columns = self.columns
+        if isinstance(rows, slice):
+            start, stop, _ = rows.indices(self.nrows)
+            bounds = range(start, stop, STREAM_CHUNK_ROWS)
+            pieces = (slice(b, min(b + STREAM_CHUNK_ROWS, stop)) for b in bounds)
+        else:
+            rows = np.asarray(rows)
+            pieces = (
+                rows[b : b + STREAM_CHUNK_ROWS]
+                for b in range(0, len(rows), STREAM_CHUNK_ROWS)
+            )
+        if header:
+            buf = io.StringIO()
+            pd.DataFrame(columns=columns).to_csv(buf, index=False)
+            yield buf.getvalue()
+        for piece in pieces:
+            buf = io.StringIO()
+            self.frame(columns, piece).to_csv(buf, index=False, header=False)
+            yield buf.getvalue()
+
+
+class MarkerTable(_Table):
+    """Memory-mapped, column-wise view of a marker file.
+
+    The columns live under ``.tissuumaps/<name>.columns/`` as one ``.npy``
+    file each; text columns are stored as int32 codes into a list of
+    categories. Columns are only mapped when first used.
+    """
+
+    def __init__(self, storePath):
+        self.storePath = storePath
+        with open(os.path.join(storePath, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.nrows = self.meta["nrows"]
+        self._columns = OrderedDict((c["name"], c) for c in self.meta["columns"])
+        self.columns = list(self._columns.keys())
+        self._arrays = {}
+        self._categories = {}
+        self._lock = Lock()
+
+    def _column(self, name):
+        try:
+            return self._columns[name]
+        except KeyError:
+            raise KeyError("Unknown marker column: %s" % name)
+
+    def column(self, name):
+        """Return the raw array of a column (codes for text columns)."""
+        with self._lock:
+            if name not in self._arrays:
+                self._arrays[name] = _load(
+                    os.path.join(self.storePath, self._column(name)["file"])
+                )
+            return self._arrays[name]
+
+    def categories(self, name):
+        """Return the category list of a text column, None for numeric columns."""
+        column = self._column(name)
+        if column["kind"] != "category":
+            return None
+        with self._lock:
+            if name not in self._categories:
+                with open(os.path.join(self.storePath, column["categories"])) as f:
+                    self._categories[name] = json.load(f)
+            return self._categories[name]
+
+
+class GroupedLayout(object):
+    """Copy of a marker table sorted by one key column.
+
+    The rows of each key are contiguous; ``index.json`` records the offset
+    and count of every key so the rows of a key are one slice of each column.
+    """
+
+    def __init__(self, layoutPath):
+        self.table = MarkerTable(layoutPath)
+        with open(os.path.join(layoutPath, "index.json")) as f:
+            index = json.load(f)
+        self.column = index["column"]
+        self.keys = index["keys"]
+        self.offsets = index["offsets"]
+        self.counts = index["counts"]
+        self._keyIndex = dict((key, i) for i, key in enumerate(self.keys))
+
+    def slices(self, keys):
+        """Return the row slice of each requested key, ignoring unknown keys."""
+        slices = []
+        for key in keys:
+            i = self._keyIndex.get(key)
+            if i is not None and self.counts[i] > 0:
+                slices.append(slice(self.offsets[i], self.offsets[i] + self.counts[i]))
+        return slices
+
+    def to_csv(self, keys, columns=None):
+        yield from self.table.to_csv(columns, slice(0, 0), header=True)
+        for rows in self.slices(keys):
+            yield from self.table.to_csv(columns, rows, header=False)
+
+
+def _write_columns(table, tmpPath, order=None):
+    """Write the columns of ``table``, optionally reordered, as a column store.
+
+    Returns the column descriptions for :func:`_write_table`.
+    """
+    description = []
+    for index, name in enumerate(table.columns):
+        source = table.column(name)
+        column = {"name": name, "file": "%d.npy" % index, "kind": "numeric"}
+        out = _open_output(
+            os.path.join(tmpPath, column["file"]), source.dtype, table.nrows
+        )
+        for start in range(0, table.nrows, CSV_CHUNK_ROWS):
+            stop = min(start + CSV_CHUNK_ROWS, table.nrows)
+            if order is None:
+                out[start:stop] = source[start:stop]
+            else:
+                out[start:stop] = source[order[start:stop]]
+        if out is not None:
+            out.flush()
+            del out
+        categories = table.categories(name)
+        if categories is not None:
+            column["kind"] = "category"
+            column["categories"] = "%d.categories.json" % index
+            with open(os.path.join(tmpPath, column["categories"]), "w") as f:
+                json.dump(categories, f)
+        description.append(column)
+    return description
+
+
+class ProgressiveLayout(object):
+    """Copy of a marker table in stratified random order.
+
+    Rows are shuffled within the cells of a spatial grid and the cells are
+    interleaved in proportion to their counts, so every prefix of the table
+    is a spatially uniform subsample of the whole. ``order.npy`` maps each
+    position back to the row index in the original file.
+    """
+
+    def __init__(self, layoutPath):
+        self.table = MarkerTable(layoutPath)
+        self.order = np.load(os.path.join(layoutPath, "order.npy"), mmap_mode="r")
+
+    def to_csv(self, columns=None, start=0, stop=None, rowIndex=False):
+        if columns is None:
+            columns = self.table.columns
+        start, stop, _ = slice(start, stop).indices(len(self.table))
+        header = list(columns) + (["_row"] if rowIndex else [])
+        buf = io.StringIO()
+        pd.DataFrame(columns=header).to_csv(buf, index=False)
+        yield buf.getvalue()
+        for begin in range(start, stop, STREAM_CHUNK_ROWS):
+            rows = slice(begin, min(begin + STREAM_CHUNK_ROWS, stop))
+            frame = self.table.frame(columns, rows)
+            if rowIndex:
+                frame["_row"] = np.asarray(self.order[rows])
+            buf = io.StringIO()
+            frame.to_csv(buf, index=False, header=False)
+            yield buf.getvalue()
+
+
+def _stratified_order(cellIds, seed=0):
+    """Return a permutation interleaving the grid cells proportionally."""
+    rng = np.random.default_rng(seed)
+    n = len(cellIds)
+    # Random order inside each cell: sort by (cell, random)
+    byCell = np.lexsort((rng.random(n), cellIds))
+    sortedCells = cellIds[byCell]
+    counts = np.bincount(sortedCells)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    rank = np.arange(n) - starts[sortedCells]
+    # Rank within the cell, jittered and normalized by the cell size
+    key = np.empty(n, dtype=np.float64)
+    key[byCell] = (rank + rng.random(n)) / counts[sortedCells]
+    return np.argsort(key, kind="stable")
+
+
+def _build_progressive(table, spatialIndex, layoutPath, signature):
+    tmpPath = layoutPath + ".tmp-" + uuid.uuid4().hex[:8]
+    os.makedirs(tmpPath)
+    try:
+        order = _stratified_order(spatialIndex.cell_ids())
+        description = _write_columns(table, tmpPath, order)
+        _write_table(tmpPath, signature, table.nrows, description)
+        np.save(os.path.join(tmpPath, "order.npy"), order.astype(np.int64))
+        _replace_dir(tmpPath, layoutPath)
+    except:
+        shutil.rmtree(tmpPath, ignore_errors=True)
+        raise
+
+
+def _build_grouped(table, name, layoutPath, signature):
+    tmpPath = layoutPath + ".tmp-" + uuid.uuid4().hex[:8]
+    os.makedirs(tmpPath)
+    try:
+        keys, codes = table.key_codes(name)
+        order = np.argsort(codes, kind="stable")
+        counts = np.bincount(codes, minlength=len(keys))
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+        description = _write_columns(table, tmpPath, order)
+        _write_table(tmpPath, signature, table.nrows, description)
+        with open(os.path.join(tmpPath, "index.json"), "w") as f:
+            json.dump(
+                {
+                    "column": name,
+                    "keys": keys,
+                    "offsets": offsets.tolist(),
+                    "counts": counts.tolist(),
+                },
+                f,
+            )
+        _replace_dir(tmpPath, layoutPath)
+    except:
+        shutil.rmtree(tmpPath, ignore_errors=True)
+        raise
+
+
+def _decode_strings(values):
+    return [v.decode("utf-8") if isinstance(v, bytes) else v for v in values]
+
+
+def _factorize(values):
+    """Return ``(codes, categories)`` for an array of text values."""
+    codes, uniques = pd.factorize(pd.Series(values), use_na_sentinel=True)
+    return codes.astype(np.int32), [str(u) for u in uniques]
+
+
+class ParquetTable(_Table):
+    """Marker table read column by column from a Parquet file with pyarrow."""
+
+    def __init__(self, path):
+        if pq is None:
+            raise ImportError("pyarrow is required to read Parquet marker files")
+        self.path = path
+        self._file = pq.ParquetFile(path)
+        self.nrows = self._file.metadata.num_rows
+        self.columns = [
+            name for name in self._file.schema_arrow.names
+            if not name.startswith("__index_level_")
+        ]
+        self._arrays = {}
+        self._categories = {}
+        self._lock = Lock()
+
+    def _read(self, name):
+        if name not in self.columns:
+            raise KeyError("Unknown marker column: %s" % name)
+        with self._lock:
+            if name in self._arrays:
+                return
+            array = self._file.read(columns=[name]).column(0).combine_chunks()
+            if pa.types.is_dictionary(array.type):
+                codes = array.indices.to_numpy(zero_copy_only=False)
+                codes = np.where(array.indices.is_null().to_numpy(zero_copy_only=False), -1, codes)
+                categories = [str(c) for c in array.dictionary.to_pylist()]
+                self._arrays[name] = codes.astype(np.int32)
+                self._categories[name] = categories
+            elif pa.types.is_string(array.type) or pa.types.is_large_string(array.type):
+                self._arrays[name], self._categories[name] = _factorize(
+                    array.to_numpy(zero_copy_only=False)
+                )
+            else:
+                if pa.types.is_boolean(array.type) and array.null_count == 0:
+                    values = array.to_numpy(zero_copy_only=False).astype(np.uint8)
+                else:
+                    values = array.to_numpy(zero_copy_only=False)
+                if values.dtype == object:
+                    values = values.astype(np.float64)
+                self._arrays[name] = values
+                self._categories[name] = None
+
+    def column(self, name):
+        self._read(name)
+        return self._arrays[name]
+
+    def categories(self, name):
+        self._read(name)
+        return self._categories[name]
+
+
+class H5ADTable(_Table):
+    """Marker table read column by column from an AnnData ``.h5ad`` file with h5py.
+
+    The ``obs`` columns keep their names. Two-dimensional ``obsm`` entries
+    give one column per dimension (up to three): ``x``, ``y`` (and ``z``) for
+    ``obsm["spatial"]`` and ``<key>_1``, ``<key>_2``... for the others.
+    """
+
+    def __init__(self, path):
+        if h5py is None:
+            raise ImportError("h5py is required to read AnnData marker files")
+        self.path = path
+        self._file = h5py.File(path, "r")
+        self._sources = OrderedDict()
+        obs = self._file["obs"]
+        indexName = obs.attrs.get("_index", "_index")
+        if isinstance(indexName, bytes):
+            indexName = indexName.decode()
+        columnOrder = [
+            c.decode() if isinstance(c, bytes) else c
+            for c in obs.attrs.get("column-order", [])
+        ]
+        names = [indexName] + [
+            c for c in columnOrder if c in obs and c != indexName
+        ] + [
+            c for c in obs.keys()
+            if c not in columnOrder and c != indexName and c != "__categories"
+        ]
+        for name in names:
+            node = obs.get(name)
+            if isinstance(node, h5py.Group) and "codes" not in node and "values" not in node:
+                # Encoded as nothing a column can be read from
+                continue
+            if node is not None:
+                self._sources[name] = ("obs", name, None)
+        self.nrows = len(obs[indexName]) if indexName in obs else 0
+        if "obsm" in self._file:
+            for key, dataset in self._file["obsm"].items():
+                if not isinstance(dataset, h5py.Dataset) or dataset.ndim != 2:
+                    continue
+                for dim in range(min(dataset.shape[1], 3)):
+                    if key == "spatial":
+                        name = "xyz"[dim]
+                    else:
+                        name = "%s_%d" % (key, dim + 1)
+                    if name not in self._sources:
+                        self._sources[name] = ("obsm", key, dim)
+        self.columns = list(self._sources.keys())
+        self._arrays = {}
+        self._categories = {}
+        self._lock = Lock()
+
+    def _read(self, name):
+        try:
+            group, key, dim = self._sources[name]
+        except KeyError:
+            raise KeyError("Unknown marker column: %s" % name)
+        with self._lock:
+            if name in self._arrays:
+                return
+            categories = None
+            if group == "obsm":
+                values = self._file["obsm"][key][:, dim]
+            else:
+                node = self._file["obs"][key]
+                if isinstance(node, h5py.Group) and "codes" in node:
+                    # AnnData >= 0.8 categorical
+                    values = node["codes"][()].astype(np.int32)
+                    categories = [str(c) for c in _decode_strings(node["categories"][()])]
+                elif isinstance(node, h5py.Group) and "values" in node:
+                    # AnnData >= 0.10 nullable integer, boolean or string array
+                    values = node["values"][()]
+                    mask = node["mask"][()].astype(bool) if "mask" in node else None
+                    if values.dtype.kind in "OSU":
+                        values, categories = _factorize(_decode_strings(values))
+                        if mask is not None:
+                            values[mask] = -1
+                    else:
+                        values = values.astype(np.float64)
+                        if mask is not None:
+                            values[mask] = np.nan
+                elif "categories" in node.attrs:
+                    # AnnData 0.7 categorical: codes referencing obs/__categories
+                    values = node[()].astype(np.int32)
+                    categories = [
+                        str(c) for c in _decode_strings(self._file[node.attrs["categories"]][()])
+                    ]
+                else:
+                    values = node[()]
+                    if values.dtype.kind in "OSU":
+                        values, categories = _factorize(_decode_strings(values))
+                    elif values.dtype.kind == "b":
+                        values = values.astype(np.uint8)
+            self._arrays[name] = values
+            self._categories[name] = categories
+
+    def column(self, name):
+        self._read(name)
+        return self._arrays[name]
+
+    def categories(self, name):
+        self._read(name)
+        return self._categories[name]
+
+
+class ConcatTable(_Table):
+    """Several marker tables read one after the other as a single table.
+
+    Columns missing from a member are missing values for its rows, and the
+    categories of text columns are merged across members. With
+    ``sourceColumn``, an extra text column holds the name of the member
+    each row comes from. Merged columns are built in memory on first use.
+    """
+
+    def __init__(self, tables, names, sourceColumn=None):
+        self.tables = tables
+        self.names = names
+        self.sourceColumn = sourceColumn
+        lengths = [len(table) for table in tables]
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+        self.nrows = int(sum(lengths))
+        columns = []
+        for table in tables:
+            columns.extend(
+                c for c in table.columns if c not in columns and c != sourceColumn
+            )
+        if sourceColumn:
+            columns.append(sourceColumn)
+        self.columns = columns
+        self._arrays = {}
+        self._categories = {}
+        self._lock = Lock()
+
+    def _members(self):
+        for table, start in zip(self.tables, self.offsets):
+            yield table, slice(start, start + len(table))
+
+    def _merge(self, name):
+        if name == self.sourceColumn:
+            codes = np.repeat(
+                np.arange(len(self.tables), dtype=np.int32),
+                [len(table) for table in self.tables],
+            )
+            return codes, list(self.names)
+        present = [table for table in self.tables if name in table.columns]
+        if not any(table.is_category(name) for table in present):
+            dtypes = [table.column(name).dtype for table in present]
+            if len(present) < len(self.tables):
+                dtypes.append(np.float64)
+            out = np.empty(self.nrows, dtype=np.result_type(*dtypes))
+            for table, rows in self._members():
+                out[rows] = table.column(name) if name in table.columns else np.nan
+            return out, None
+        mapping = OrderedDict()
+        out = np.empty(self.nrows, dtype=np.int32)
+        for table, rows in self._members():
+            if name not in table.columns:
+                out[rows] = -1
+                continue
+            if table.is_category(name):
+                codes = np.asarray(table.column(name))
+                uniques = table.categories(name)
+            else:
+                # Numbers become text formatted as in the CSV file
+                codes, uniques = pd.factorize(
+                    pd.Series(np.asarray(table.column(name))), use_na_sentinel=True
+                )
+                uniques = [format_key(u) for u in uniques]
+            lut = np.array(
+                [mapping.setdefault(u, len(mapping)) for u in uniques] + [-1],
+                dtype=np.int32,
+            )
+            out[rows] = lut[codes]
+        return out, list(mapping.keys())
+
+    def _column(self, name):
+        if name not in self.columns:
+            raise KeyError("Unknown marker column: %s" % name)
+        with self._lock:
+            if name not in self._arrays:
+                self._arrays[name], self._categories[name] = self._merge(name)
+
+    def column(self, name):
+        """Return the raw array of a column (codes for text columns)."""
+        self._column(name)
+        return self._arrays[name]
+
+    def categories(self, name):
+        """Return the category list of a text column, None for numeric columns."""
+        if name == self.sourceColumn:
+            return list(self.names)
+        if name not in self.columns:
+            raise KeyError("Unknown marker column: %s" % name)
+        if not any(
+            table.is_category(name) for table in self.tables if name in table.columns
+        ):
+            return None
+        self._column(name)
+        return self._categories[name]
+
+
+class MarkerFile(object):
+    """A marker file together with the data structures derived from it."""
+
+    def __init__(self, path):
+        self.path = path
+        self.signature = _signature(path)
+        self.storePath = cache_path(path, ".columns")
+        self._lock = Lock()
+        self._layouts = {}
+        self._keyCodes = {}
+        self._spatialIndexes = {}
+        self._derivedLock = Lock()
+        self._derivedLocks = {}
+        self._derived = {}
+        self.table = self._open_table()
+
+    def _is_current(self, storePath):
+        try:
+            with open(os.path.join(storePath, "meta.json")) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return False
+        return meta.get("version") == STORE_VERSION and meta.get("source") == self.signature
+
+    def _open_table(self):
+        extension = os.path.splitext(self.path)[1].lower()
+        if extension == ".h5ad":
+            os.makedirs(self.storePath, exist_ok=True)
+            return H5ADTable(self.path)
+        if extension == ".parquet":
+            os.makedirs(self.storePath, exist_ok=True)
+            return ParquetTable(self.path)
+        if not self._is_current(self.storePath):
+            logging.info("Building column store for %s" % self.path)
+            os.makedirs(os.path.dirname(self.storePath), exist_ok=True)
+            _convert_csv(self.path, self.storePath)
+        return MarkerTable(self.storePath)
+
+    def is_current(self):
+        try:
+            return _signature(self.path) == self.signature
+        except OSError:
+            return False
+
+    def _column_index(self, name):
+        if name not in self.table.columns:
+            raise KeyError("Unknown marker column: %s" % name)
+        return self.table.columns.index(name)
+
+    def key_codes(self, name):
+        """Cached :meth:`MarkerTable.key_codes`."""
+        self._column_index(name)
+        with self._lock:
+            if name not in self._keyCodes:
+                self._keyCodes[name] = self.table.key_codes(name)
+            return self._keyCodes[name]
+
+    def spatial_index(self, x, y):
+        """Return the grid index over the ``x`` and ``y`` columns."""
+        indexPath = os.path.join(
+            self.storePath,
+            "grid.%d.%d" % (self._column_index(x), self._column_index(y)),
+        )
+        with self._lock:
+            if (x, y) not in self._spatialIndexes:
+                xValues = self.table.numeric(x)
+                yValues = self.table.numeric(y)
+                if not GridIndex.is_current(indexPath, self.signature):
+                    logging.info("Indexing %s on %s, %s" % (self.path, x, y))
+                    GridIndex.build(indexPath, xValues, yValues, self.signature)
+                self._spatialIndexes[(x, y)] = GridIndex(indexPath, xValues, yValues)
+            return self._spatialIndexes[(x, y)]
+
+    def kdtree(self, x, y):
+        """Return the KD-tree over the ``x`` and ``y`` columns."""
+        self._column_index(x)
+        self._column_index(y)
+        return self.derived(
+            ("kdtree", x, y),
+            lambda: KDTreeIndex(self.table.numeric(x), self.table.numeric(y)),
+        )
+
+    def progressive(self, x, y):
+        """Return the stratified random ordering over the ``x`` and ``y`` columns."""
+        layoutPath = os.path.join(
+            self.storePath,
+            "progressive.%d.%d" % (self._column_index(x), self._column_index(y)),
+        )
+        spatialIndex = self.spatial_index(x, y)
+
+        def load():
+            if not self._is_current(layoutPath):
+                logging.info("Shuffling %s on %s, %s" % (self.path, x, y))
+                _build_progressive(self.table, spatialIndex, layoutPath, self.signature)
+            return ProgressiveLayout(layoutPath)
+
+        return self.derived(("progressive", x, y), load)
+
+    def derived(self, key, factory):
+        """Return ``factory()``, computed once for as long as this file is cached.
+
+        Factories run under a lock of their key only, so they may derive
+        other structures of the same file.
+        """
+        with self._derivedLock:
+            if key in self._derived:
+                return self._derived[key]
+            keyLock = self._derivedLocks.setdefault(key, Lock())
+        with keyLock:
+            with self._derivedLock:
+                if key in self._derived:
+                    return self._derived[key]
+            value = factory()
+            with self._derivedLock:
+                self._derived[key] = value
+                self._derivedLocks.pop(key, None)
+            return value
+
+    def grouped(self, name):
+        """Return the layout of the table sorted by the ``name`` column.
+
+        Raises ``ValueError`` if the column has more than ``MAX_GROUP_KEYS`` keys.
+        """
+        table = self.table
+        index = self._column_index(name)
+        with self._lock:
+            if name not in self._layouts:
+                layoutPath = os.path.join(self.storePath, "groupby.%d" % index)
+                if not self._is_current(layoutPath):
+                    categories = table.categories(name)
+                    if categories is not None:
+                        keyCount = len(categories)
+                    else:
+                        keyCount = len(pd.unique(np.asarray(table.column(name))))
+                    if keyCount > MAX_GROUP_KEYS:
+                        raise ValueError(
+                            "Too many keys to group by %s: %d" % (name, keyCount)
+                        )
+                    logging.info("Grouping %s by %s" % (self.path, name))
+                    _build_grouped(table, name, layoutPath, self.signature)
+                self._layouts[name] = GroupedLayout(layoutPath)
+            return self._layouts[name]
+
+
+class ConcatMarkerFile(MarkerFile):
+    """Virtual marker file concatenating the files listed in a ``.markers`` manifest.
+
+    The manifest is a JSON object ``{"files": [...], "sourceColumn": "file"}``
+    (or just the list of files) with paths relative to the manifest. Members
+    are opened through the marker cache, so their column stores and indexes
+    are their own and only a member that changed is rebuilt; the combined
+    key codes and spatial indexes are assembled from the member ones.
+    """
+
+    def __init__(self, path, markerCache, root=None):
+        with open(path) as f:
+            manifest = json.load(f)
+        if isinstance(manifest, list):
+            manifest = {"files": manifest}
+        names = [str(name) for name in manifest.get("files", [])]
+        self.memberPaths = [
+            os.path.abspath(os.path.join(os.path.dirname(path), name)) for name in names
+        ]
+        for memberPath in self.memberPaths:
+            if root is not None and not memberPath.startswith(root):
+                raise ValueError("Marker file outside of %s: %s" % (root, memberPath))
+            if os.path.splitext(memberPath)[1].lower() == ".markers":
+                raise ValueError("Marker manifests can not be nested: %s" % memberPath)
+        self.members = [markerCache.get(memberPath) for memberPath in self.memberPaths]
+        self._names = names
+        self._sourceColumn = manifest.get("sourceColumn") or None
+        MarkerFile.__init__(self, path)
+        self.signature = {
+            "manifest": self.signature,
+            "members": [member.signature for member in self.members],
+        }
+
+    def _open_table(self):
+        os.makedirs(self.storePath, exist_ok=True)
+        return ConcatTable(
+            [member.table for member in self.members], self._names, self._sourceColumn
+        )
+
+    def is_current(self):
+        try:
+            return self.signature == {
+                "manifest": _signature(self.path),
+                "members": [_signature(p) for p in self.memberPaths],
+            }
+        except OSError:
+            return False
+
+    def _has_columns(self, member, *names):
+        return all(name in member.table.columns for name in names)
+
+    def key_codes(self, name):
+        """Key codes merged from the cached key codes of every member."""
+        self._column_index(name)
+        if name == self.table.sourceColumn:
+            return MarkerFile.key_codes(self, name)
+        with self._lock:
+            if name not in self._keyCodes:
+                mapping = OrderedDict()
+                codes = np.empty(len(self.table), dtype=np.int32)
+                for member, start in zip(self.members, self.table.offsets):
+                    rows = slice(start, start + len(member.table))
+                    if not self._has_columns(member, name):
+                        codes[rows] = mapping.setdefault("", len(mapping))
+                        continue
+                    memberKeys, memberCodes = member.key_codes(name)
+                    lut = np.array(
+                        [mapping.setdefault(k, len(mapping)) for k in memberKeys],
+                        dtype=np.int32,
+                    )
+                    codes[rows] = lut[memberCodes]
+                self._keyCodes[name] = (list(mapping.keys()), codes)
+            return self._keyCodes[name]
+
+    def spatial_index(self, x, y):
+        """Return the grid indexes of the members, queried as one."""
+        self._column_index(x)
+        self._column_index(y)
+        return self.derived(
+            ("grid", x, y),
+            lambda: ConcatGridIndex(
+                [
+                    member.spatial_index(x, y) if self._has_columns(member, x, y) else None
+                    for member in self.members
+                ],
+                self.table.offsets,
+                self.table.numeric(x),
+                self.table.numeric(y),
+            ),
+        )
+
+    def kdtree(self, x, y):
+        """Return the KD-trees of the members, queried as one."""
+        self._column_index(x)
+        self._column_index(y)
+        return self.derived(
+            ("kdtree", x, y),
+            lambda: ConcatKDTreeIndex(
+                [
+                    member.kdtree(x, y) if self._has_columns(member, x, y) else None
+                    for member in self.members
+                ],
+                self.table.offsets,
+            ),
+        )
+
+
+class MarkerCache(object):
+    """LRU cache of :class:`MarkerFile` objects, refreshed when files change."""
+
+    def __init__(self, cache_size):
+        self.cache_size = cache_size
+        self._lock = Lock()
+        self._pathLocks = {}
+        self._cache = OrderedDict()
+
+    def _open(self, path, root):
+        if os.path.splitext(path)[1].lower() == ".markers":
+            return ConcatMarkerFile(path, self, root)
+        return MarkerFile(path)
+
+    def get(self, path, root=None):
+        """Return the cached :class:`MarkerFile` of ``path``.
+
+        ``root`` restricts the members of a ``.markers`` manifest to a folder.
+        """
+        with self._lock:
+            markerFile = self._cache.pop(path, None)
+            if markerFile is not None and markerFile.is_current():
+                # Move to end of LRU
+                self._cache[path] = markerFile
+                return markerFile
+            pathLock = self._pathLocks.setdefault(path, Lock())
+        # Only one thread builds the derived files of a given path
+        with pathLock:
+            with self._lock:
+                markerFile = self._cache.get(path)
+                if markerFile is not None and markerFile.is_current():
+                    return markerFile
+            markerFile = self._open(path, root)
+            with self._lock:
+                self._cache.pop(path, None)
+                while len(self._cache) >= self.cache_size:
+                    self._cache.popitem(last=False)
+                self._cache[path] = markerFile
+        return markerFile
@@ -0,0 +1,173 @@
+#
+# Schema and statistics of marker files for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+import json
+import logging
+import math
+import os
+import uuid
+
+import numpy as np
+
+from tissuumaps.markers import CSV_CHUNK_ROWS, STORE_VERSION, format_key
+
+PROFILE_VERSION = 1
+# Columns with at most this many distinct values get their value counts
+MAX_DISTINCT = 256
+QUANTILES = [0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+# Number of values sampled per column to estimate the quantiles
+QUANTILE_SAMPLE = 1000000
+
+
+def _number(value):
+    value = float(value)
+    if not math.isfinite(value):
+        return None
+    if value.is_integer() and abs(value) < 2**53:
+        return int(value)
+    return value
+
+
+class _ColumnProfile(object):
+    """Statistics of one column, accumulated chunk by chunk."""
+
+    def __init__(self, name, categories, dtype, step):
+        self.name = name
+        self.categories = categories
+        self.dtype = dtype
+        self.step = step
+        self.count = 0
+        self.missing = 0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.total = 0.0
+        self.samples = []
+        if categories is not None:
+            self.codeCounts = np.zeros(len(categories) + 1, dtype=np.int64)
+        self.distinct = {}
+
+    def update(self, start, values):
+        values = np.asarray(values)
+        if self.categories is not None:
+            # Missing values (-1) are counted in the last bin
+            codes = np.where(values < 0, len(self.categories), values)
+            self.codeCounts += np.bincount(codes, minlength=len(self.codeCounts))
+            return
+        values = values.astype(np.float64)
+        valid = values[np.isfinite(values)]
+        self.count += len(valid)
+        self.missing += len(values) - len(valid)
+        if len(valid):
+            self.minimum = min(self.minimum, float(valid.min()))
+            self.maximum = max(self.maximum, float(valid.max()))
+            self.total += float(valid.sum())
+        # Every ``step``-th row of the table, whatever the chunking
+        first = (-start) % self.step
+        sample = values[first :: self.step]
+        self.samples.append(sample[np.isfinite(sample)])
+        if self.distinct is not None:
+            uniques, counts = np.unique(valid, return_counts=True)
+            for value, count in zip(uniques.tolist(), counts.tolist()):
+                self.distinct[value] = self.distinct.get(value, 0) + count
+            if len(self.distinct) > MAX_DISTINCT:
+                self.distinct = None
+
+    def result(self):
+        if self.categories is not None:
+            present = np.flatnonzero(self.codeCounts[:-1])
+            profile = {
+                "name": self.name,
+                "type": "text",
+                "count": int(self.codeCounts[:-1].sum()),
+                "missing": int(self.codeCounts[-1]),
+                "distinct": len(present),
+            }
+            if len(present) <= MAX_DISTINCT:
+                order = present[np.argsort(-self.codeCounts[present], kind="stable")]
+                profile["values"] = [
+                    {"value": self.categories[i], "count": int(self.codeCounts[i])}
+                    for i in order
+                ]
+            return profile
+        samples = np.sort(np.concatenate(self.samples)) if self.samples else []
+        profile = {
+            "name": self.name,
+            "type": "integer" if self.dtype.kind in "biu" else "numeric",
+            "count": self.count,
+            "missing": self.missing,
+            "min": _number(self.minimum) if self.count else None,
+            "max": _number(self.maximum) if self.count else None,
+            "mean": _number(self.total / self.count) if self.count else None,
+            "quantiles": dict(
+                (str(q), _number(np.quantile(samples, q)) if len(samples) else None)
+                for q in QUANTILES
+            ),
+            "distinct": None if self.distinct is None else len(self.distinct),
+        }
+        if self.distinct is not None:
+            values = sorted(self.distinct.items(), key=lambda item: -item[1])
+            profile["values"] = [
+                {"value": format_key(value), "count": count} for value, count in values
+            ]
+        return profile
+
+
+def build_profile(table):
+    """Return the schema and statistics of every column of ``table``.
+
+    All columns are read in a single pass of ``CSV_CHUNK_ROWS`` rows.
+    Quantiles are computed on a regular sample of at most about
+    ``QUANTILE_SAMPLE`` values and are exact for smaller tables.
+    """
+    step = max(int(math.ceil(table.nrows / QUANTILE_SAMPLE)), 1)
+    columns = [
+        _ColumnProfile(
+            name, table.categories(name), table.column(name).dtype, step
+        )
+        for name in table.columns
+    ]
+    for start in range(0, table.nrows, CSV_CHUNK_ROWS):
+        stop = min(start + CSV_CHUNK_ROWS, table.nrows)
+        for column in columns:
+            column.update(start, table.column(column.name)[start:stop])
+    return {
+        "nrows": table.nrows,
+        "columns": [column.result() for column in columns],
+    }
+
+
+def get_profile(markerFile):
+    """Return the profile of a marker file, cached in its ``.tissuumaps`` folder."""
+
+    def load():
+        profilePath = os.path.join(markerFile.storePath, "profile.json")
+        try:
+            with open(profilePath) as f:
+                cached = json.load(f)
+            if (
+                cached.get("version") == [STORE_VERSION, PROFILE_VERSION]
+                and cached.get("source") == markerFile.signature
+            ):
+                return cached["profile"]
+        except (OSError, ValueError):
+            pass
+        logging.info("Profiling %s" % markerFile.path)
+        profile = build_profile(markerFile.table)
+        tmpPath = profilePath + ".tmp-" + uuid.uuid4().hex[:8]
+        with open(tmpPath, "w") as f:
+            json.dump(
+                {
+                    "version": [STORE_VERSION, PROFILE_VERSION],
+                    "source": markerFile.signature,
+                    "profile": profile,
+                },
+                f,
+            )
+        os.replace(tmpPath, profilePath)
+        return profile
+
+    return markerFile.derived(("profile",), load)
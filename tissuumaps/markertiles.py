@@ -0,0 +1,448 @@
+#
+# Server-side rasterization of marker files into DeepZoom tiles
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+import hashlib
+import json
+import math
+import os
+
+import numpy as np
+
+from tissuumaps.markers import cache_path
+from tissuumaps.pyramid import DZI_TEMPLATE
+
+# Same order as markerUtils._symbolStrings
+SYMBOLS = [
+    "cross", "diamond", "square", "triangle up", "star", "clobber", "disc",
+    "hbar", "vbar", "tailed arrow", "triangle down", "ring", "x", "arrow",
+]
+DEFAULT_MARKER_SIZE = 6
+MAX_RADIUS = 48
+# Number of candidate points processed at once
+POINT_BLOCK = 1 << 22
+# Largest raster a spec may describe, in pixels per side
+MAX_RASTER_SIZE = 1 << 20
+
+def _stamp(shape, radius):
+    """Boolean mask of a marker symbol with the given pixel radius."""
+    r = max(int(radius), 0)
+    yy, xx = np.mgrid[-r : r + 1, -r : r + 1].astype(np.float64)
+    rr = max(r, 0.5)
+    thickness = max(rr / 3.0, 0.5)
+    if shape == "square":
+        mask = np.ones_like(xx, dtype=bool)
+    elif shape == "diamond":
+        mask = np.abs(xx) + np.abs(yy) <= rr
+    elif shape == "cross":
+        mask = (np.abs(xx) <= thickness) | (np.abs(yy) <= thickness)
+    elif shape == "x":
+        mask = (np.abs(xx - yy) <= thickness * 1.4) | (np.abs(xx + yy) <= thickness * 1.4)
+    elif shape == "hbar":
+        mask = np.abs(yy) <= thickness
+    elif shape == "vbar":
+        mask = np.abs(xx) <= thickness
+    elif shape == "ring":
+        dist = np.sqrt(xx ** 2 + yy ** 2)
+        mask = (dist <= rr + 0.5) & (dist >= rr - thickness)
+    elif shape == "triangle up":
+        mask = (yy <= rr) & (np.abs(xx) * 2 <= yy + rr)
+    elif shape == "triangle down":
+        mask = (yy >= -rr) & (np.abs(xx) * 2 <= rr - yy)
+    else:
+        # disc, and the symbols that have no raster equivalent yet
+        mask = xx ** 2 + yy ** 2 <= (rr + 0.5) ** 2
+    return mask
+
+
+def _stamp_offsets(shape, radius):
+    dy, dx = np.nonzero(_stamp(shape, radius))
+    return dy - int(radius), dx - int(radius)
+
+
+def _hex_to_rgb(color):
+    color = str(color).strip().lstrip("#")
+    if len(color) == 3:
+        color = "".join(c * 2 for c in color)
+    try:
+        return [int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16)]
+    except ValueError:
+        return [255, 0, 0]
+
+
+def deterministic_color(key):
+    """Python port of ``HTMLElementUtils.determinsticHTMLColor``."""
+    key = str(key)
+    try:
+        number = int(key)
+        digits = ""
+        while True:
+            digits = "0123"[number % 4] + digits
+            number //= 4
+            if number == 0:
+                break
+        key = digits[::-1]
+    except ValueError:
+        pass
+    ggroup = ["g", "i", "s", "d", "w", "z", "1", "5", "9"]
+    agroup = ["a", "e", "o", "l", "p", "b", "k", "j", "2", "6"]
+    cgroup = ["c", "m", "f", "v", "3", "7", "q"]
+    tugroup = ["t", "r", "n", "u", "h", "y", "x", "4", "8", "0"]
+    first = key[0:1].lower()
+    U, V, y = 0, 255, 128
+    if first and first in ggroup:
+        U, V = 0, 0
+    elif first and first in cgroup:
+        U, V = 255, 0
+    elif first and first in agroup:
+        U, V = 255, 255
+    second = key[1:2].lower()
+    if second:
+        if second in agroup:
+            U += 80; V += 80
+        if second in cgroup:
+            U += 80; V -= 80
+        if second in ggroup:
+            U -= 80; V -= 80
+        if second in tugroup:
+            U -= 80; V += 80
+    U = min(max(U, 0), 255)
+    V = min(max(V, 0), 255)
+    third = key[2:3].lower()
+    if third:
+        if third in agroup or third in cgroup:
+            y += 35
+        if third in ggroup or third in tugroup:
+            y -= 35
+    rgb = [
+        math.floor(y + 1.402 * (V - 128)),
+        math.floor(y - 0.344136 * (U - 128) - 0.714136 * (V - 128)),
+        math.floor(y + 1.772 * (U - 128)),
+    ]
+    return [255 if c >= 255 else max(c, 0) for c in rgb]
+
+
+def _colormap_lut(name):
+    """Return a (256, 3) uint8 lookup table for a d3 or matplotlib colormap name."""
+    ramp = np.linspace(0, 1, 256)
+    if name:
+        cmapName = name.replace("interpolate", "")
+        try:
+            import matplotlib
+            from matplotlib import cm
+
+            for candidate in [cmapName, cmapName.lower()]:
+                try:
+                    if hasattr(matplotlib, "colormaps"):
+                        cmap = matplotlib.colormaps[candidate]
+                    else:
+                        cmap = cm.get_cmap(candidate)
+                except (KeyError, ValueError):
+                    continue
+                return (cmap(ramp)[:, :3] * 255).astype(np.uint8)
+        except ImportError:
+            pass
+    grey = (ramp * 255).astype(np.uint8)
+    return np.stack([grey, grey, grey], axis=1)
+
+
+def _parse_dict(value):
+    if isinstance(value, (dict, list)):
+        return value
+    if not value:
+        return None
+    try:
+        return json.loads(value)
+    except ValueError:
+        return None
+
+
+class MarkerRaster(object):
+    """Rasterizes one marker file with the options of a tmap ``markerFiles`` entry.
+
+    ``spec`` holds ``expectedHeader`` and ``expectedRadios`` as in tmap files,
+    the image ``width`` and ``height`` the marker coordinates refer to, and
+    optionally ``markerSize`` (pixels), ``colors`` (``{key: "#rrggbb"}``, the
+    legend colours shown by the client) and ``keys`` (the visible keys).
+    """
+
+    def __init__(self, markerFile, spec, tileSize, overlap, format):
+        self.markerFile = markerFile
+        self.table = markerFile.table
+        self.spec = spec
+        self.header = spec.get("expectedHeader", {})
+        self.radios = spec.get("expectedRadios", {})
+        self.width = int(spec["width"])
+        self.height = int(spec["height"])
+        self.tileSize = tileSize
+        self.overlap = overlap
+        self.format = format
+        self.maxLevel = int(math.ceil(math.log2(max(self.width, self.height, 1))))
+        self.x = self.header.get("X", "x")
+        self.y = self.header.get("Y", "y")
+        self.index = markerFile.spatial_index(self.x, self.y)
+        self._prepare_colors()
+        self._prepare_shapes()
+        self._prepare_scales()
+        self._prepare_visibility()
+
+    def get_dzi(self):
+        return DZI_TEMPLATE % (
+            self.format, self.overlap, self.tileSize, self.height, self.width
+        )
+
+    def _column(self, key):
+        name = self.header.get(key)
+        if name and name in self.table.columns:
+            return name
+        return None
+
+    def _prepare_colors(self):
+        opacity = int(round(255 * float(self.header.get("opacity", 1) or 1)))
+        colorColumn = self._column("cb_col")
+        keyColumn = self._column("gb_col")
+        self.keyCodes = None
+        if keyColumn:
+            self.keys, self.keyCodes = self.markerFile.key_codes(keyColumn)
+        if colorColumn and self.header.get("cb_cmap"):
+            # Scalar column mapped through a colormap
+            self.colorMode = "cmap"
+            self.colorValues = colorColumn
+            self.lut = _colormap_lut(self.header.get("cb_cmap"))
+            valueRange = self.spec.get("range")
+            if not valueRange:
+                values = self.table.numeric(colorColumn)
+                valueRange = [float(np.nanmin(values)), float(np.nanmax(values))]
+            self.valueRange = valueRange
+        elif colorColumn:
+            # One "#rrggbb" colour per marker
+            self.colorMode = "codes"
+            keys, codes = self.markerFile.key_codes(colorColumn)
+            self.colorCodes = codes
+            self.lut = np.array([_hex_to_rgb(k) for k in keys], dtype=np.uint8)
+        else:
+            self.colorMode = "codes"
+            if self.keyCodes is None:
+                self.colorCodes = None
+                self.lut = np.array([_hex_to_rgb(self.spec.get("color", "#ff0000"))])
+            else:
+                self.colorCodes = self.keyCodes
+                colors = _parse_dict(self.header.get("cb_gr_dict"))
+                if not self.radios.get("cb_gr_dict") or colors is None:
+                    colors = {}
+                if isinstance(colors, list):
+                    colors = dict(
+                        (k, colors[i % len(colors)]) for i, k in enumerate(self.keys)
+                    ) if colors else {}
+                colors.update(self.spec.get("colors") or {})
+                self.lut = np.array(
+                    [
+                        _hex_to_rgb(colors[k]) if k in colors else deterministic_color(k)
+                        for k in self.keys
+                    ],
+                    dtype=np.uint8,
+                ).reshape(-1, 3)
+        self.opacity = min(max(opacity, 0), 255)
+
+    def _prepare_shapes(self):
+        shapeColumn = self._column("shape_col")
+        self.shapeCodes = None
+        self.shapeLut = np.array([SYMBOLS.index("disc")])
+        if self.radios.get("shape_col") and shapeColumn:
+            keys, self.shapeCodes = self.markerFile.key_codes(shapeColumn)
+            self.shapeLut = np.array([self._symbol_index(k) for k in keys])
+        elif self.radios.get("shape_fixed") and self.header.get("shape_fixed"):
+            self.shapeLut = np.array([self._symbol_index(self.header["shape_fixed"])])
+        elif self.keyCodes is not None:
+            shapes = _parse_dict(self.header.get("shape_gr_dict")) or {}
+            if not isinstance(shapes, dict):
+                shapes = {}
+            self.shapeCodes = self.keyCodes
+            self.shapeLut = np.array(
+                [self._symbol_index(shapes.get(k, "disc")) for k in self.keys]
+            )
+
+    @staticmethod
+    def _symbol_index(value):
+        if value in SYMBOLS:
+            return SYMBOLS.index(value)
+        try:
+            return max(int(float(value)), 0) % len(SYMBOLS)
+        except (TypeError, ValueError):
+            return SYMBOLS.index("disc")
+
+    def _prepare_scales(self):
+        size = float(self.spec.get("markerSize", DEFAULT_MARKER_SIZE))
+        factor = float(self.header.get("scale_factor", 1) or 1)
+        self.baseRadius = size * factor / 2.0
+        self.scaleColumn = None
+        if self.radios.get("scale_check") and self._column("scale_col"):
+            self.scaleColumn = self._column("scale_col")
+            self.maxScale = float(np.nanmax(self.table.numeric(self.scaleColumn)))
+        else:
+            self.maxScale = 1.0
+
+    def _prepare_visibility(self):
+        self.visible = None
+        keys = self.spec.get("keys")
+        if keys is not None and self.keyCodes is not None:
+            wanted = set(keys)
+            self.visible = np.array([k in wanted for k in self.keys], dtype=bool)
+
+    def _tile_geometry(self, level, col, row):
+        if level < 0 or level > self.maxLevel:
+            raise ValueError("Invalid level")
+        scale = 2.0 ** (level - self.maxLevel)
+        levelWidth = max(int(math.ceil(self.width * scale)), 1)
+        levelHeight = max(int(math.ceil(self.height * scale)), 1)
+        cols = int(math.ceil(levelWidth / self.tileSize))
+        rows = int(math.ceil(levelHeight / self.tileSize))
+        if col < 0 or row < 0 or col >= cols or row >= rows:
+            raise ValueError("Invalid address")
+        left = self.overlap if col > 0 else 0
+        top = self.overlap if row > 0 else 0
+        right = self.overlap if col < cols - 1 else 0
+        bottom = self.overlap if row < rows - 1 else 0
+        x0 = col * self.tileSize - left
+        y0 = row * self.tileSize - top
+        width = min(self.tileSize, levelWidth - col * self.tileSize) + left + right
+        height = min(self.tileSize, levelHeight - row * self.tileSize) + top + bottom
+        return scale, x0, y0, width, height
+
+    def render(self, level, col, row):
+        """Return the RGBA ``(height, width, 4)`` array of a tile."""
+        scale, x0, y0, width, height = self._tile_geometry(level, col, row)
+        image = np.zeros((height, width, 4), dtype=np.uint8)
+        maxRadius = min(self.baseRadius * self.maxScale, MAX_RADIUS) + 1
+        candidates = self.index.query_bbox(
+            (x0 - maxRadius) / scale,
+            (y0 - maxRadius) / scale,
+            (x0 + width + maxRadius) / scale,
+            (y0 + height + maxRadius) / scale,
+        )
+        for start in range(0, len(candidates), POINT_BLOCK):
+            self._draw(image, candidates[start : start + POINT_BLOCK], scale, x0, y0)
+        return image
+
+    def _draw(self, image, rows, scale, x0, y0):
+        height, width = image.shape[:2]
+        if self.visible is not None:
+            rows = rows[self.visible[self.keyCodes[rows]]]
+        if len(rows) == 0:
+            return
+        px = np.floor(self.index.x[rows] * scale - x0).astype(np.int64)
+        py = np.floor(self.index.y[rows] * scale - y0).astype(np.int64)
+
+        if self.colorMode == "cmap":
+            values = self.table.numeric(self.colorValues, rows)
+            low, high = self.valueRange
+            normalized = (values - low) / (high - low) if high > low else values * 0
+            lutIndex = np.clip(np.nan_to_num(normalized) * 255, 0, 255).astype(np.int64)
+            rgb = self.lut[lutIndex]
+        elif self.colorCodes is None:
+            rgb = np.repeat(self.lut[:1], len(rows), axis=0)
+        else:
+            rgb = self.lut[self.colorCodes[rows]]
+        rgba = np.concatenate(
+            [rgb.astype(np.uint8), np.full((len(rows), 1), self.opacity, dtype=np.uint8)],
+            axis=1,
+        )
+
+        if self.shapeCodes is None:
+            shapes = np.full(len(rows), self.shapeLut[0])
+        else:
+            shapes = self.shapeLut[self.shapeCodes[rows]]
+        if self.scaleColumn is not None:
+            scales = np.nan_to_num(self.table.numeric(self.scaleColumn, rows))
+        else:
+            scales = np.ones(len(rows))
+        radii = np.clip(np.round(self.baseRadius * scales), 0, MAX_RADIUS).astype(np.int64)
+
+        # Draw each (shape, radius) group; within a group only the last
+        # marker landing on a given pixel is visible, so drop the others.
+        groups = shapes * (MAX_RADIUS + 1) + radii
+        for group in np.unique(groups):
+            members = np.flatnonzero(groups == group)
+            shape, radius = divmod(int(group), MAX_RADIUS + 1)
+            margin = MAX_RADIUS + 4
+            pixel = (py[members] + margin) * (width + 2 * margin) + px[members] + margin
+            _, lastIndex = np.unique(pixel[::-1], return_index=True)
+            members = members[len(members) - 1 - lastIndex]
+            gx, gy, gcolor = px[members], py[members], rgba[members]
+            dy, dx = _stamp_offsets(SYMBOLS[shape], radius)
+            for oy, ox in zip(dy, dx):
+                yy = gy + oy
+                xx = gx + ox
+                inside = (yy >= 0) & (yy < height) & (xx >= 0) & (xx < width)
+                image[yy[inside], xx[inside]] = gcolor[inside]
+
+
+def _finite(value):
+    if isinstance(value, bool):
+        raise ValueError("Expected a number")
+    try:
+        value = float(value)
+    except TypeError:
+        raise ValueError("Expected a number")
+    if not math.isfinite(value):
+        raise ValueError("Expected a finite number")
+    return value
+
+
+def check_spec(spec):
+    """Check a raster spec sent by a client and convert its numbers, in place.
+
+    ``width`` and ``height``, if given, become ints in
+    ``[1, MAX_RASTER_SIZE]``. Raises ``ValueError`` if the spec or one of
+    its entries has the wrong type or an invalid value.
+    """
+    if not isinstance(spec, dict):
+        raise ValueError("A raster spec is an object")
+    for name in ["expectedHeader", "expectedRadios"]:
+        if not isinstance(spec.setdefault(name, {}), dict):
+            raise ValueError("%s must be an object" % name)
+    for name in ["width", "height"]:
+        if name in spec:
+            size = int(math.ceil(_finite(spec[name])))
+            if not 1 <= size <= MAX_RASTER_SIZE:
+                raise ValueError("%s must be in [1, %d]" % (name, MAX_RASTER_SIZE))
+            spec[name] = size
+    if "markerSize" in spec and _finite(spec["markerSize"]) < 0:
+        raise ValueError("markerSize must not be negative")
+    if spec.get("keys") is not None and not isinstance(spec["keys"], list):
+        raise ValueError("keys must be a list")
+    if spec.get("colors") is not None and not isinstance(spec["colors"], dict):
+        raise ValueError("colors must be an object")
+    if spec.get("range"):
+        if not isinstance(spec["range"], list) or len(spec["range"]) != 2:
+            raise ValueError("range must be a list of two numbers")
+        spec["range"] = [_finite(v) for v in spec["range"]]
+    return spec
+
+
+def spec_id(spec):
+    """Stable identifier of a raster specification."""
+    canonical = json.dumps(spec, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(canonical.encode()).hexdigest()[:16]
+
+
+def save_spec(markerPath, spec):
+    specId = spec_id(spec)
+    specPath = cache_path(markerPath, ".raster")
+    os.makedirs(specPath, exist_ok=True)
+    with open(os.path.join(specPath, specId + ".json"), "w") as f:
+        json.dump(spec, f)
+    return specId
+
+
+def load_spec(markerPath, specId):
+    if not specId.isalnum():
+        raise KeyError(specId)
+    try:
+        with open(os.path.join(cache_path(markerPath, ".raster"), specId + ".json")) as f:
+            return json.load(f)
+    except OSError:
+        raise KeyError(specId)
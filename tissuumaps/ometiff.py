@@ -0,0 +1,242 @@
+#
+# OME-TIFF channels and series as virtual image layers for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+import re
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pyvips
+
+from tissuumaps.pyramid import (
+    VIPS_FORMATS,
+    WINDOW_LEVEL_SIZE,
+    PyramidSlide,
+    percentile_window,
+)
+
+OME_EXTENSIONS = (".ome.tif", ".ome.tiff")
+# Virtual layers: <file>.ome.tif/s<series>/c<channel>
+LAYER_PATTERN = re.compile(
+    r"^(?P<path>.+\.ome\.tiff?)[/\\]s(?P<series>\d+)[/\\]c(?P<channel>\d+)$",
+    re.IGNORECASE,
+)
+
+
+def is_ome(path):
+    return path.lower().endswith(OME_EXTENSIONS)
+
+
+def split_layer_path(path):
+    """Return ``(filePath, series, channel)`` of a virtual layer path, or ``None``."""
+    match = LAYER_PATTERN.match(path)
+    if match is None:
+        return None
+    return match.group("path"), int(match.group("series")), int(match.group("channel"))
+
+
+def source_path(path):
+    """Path of the file behind a layer path, virtual or not."""
+    layer = split_layer_path(path)
+    return layer[0] if layer else path
+
+
+def layer_path(path, series, channel):
+    return "%s/s%d/c%d" % (path, series, channel)
+
+
+def _plane_index(order, sizes, c, z, t):
+    """Index of plane ``(c, z, t)`` for a ``DimensionOrder`` such as ``XYZCT``."""
+    coordinates = {"C": c, "Z": z, "T": t}
+    index, stride = 0, 1
+    for dimension in order[2:]:
+        index += coordinates[dimension] * stride
+        stride *= sizes[dimension]
+    return index
+
+
+def _unit_factor(unit):
+    """Micrometres per unit of an OME length unit."""
+    return {"nm": 1e-3, "mm": 1e3, "cm": 1e4, "m": 1e6}.get(unit, 1.0)
+
+
+def parse_ome_xml(description, pageCount):
+    """Return the series of an OME-XML description.
+
+    Every series has a ``name``, its ``width`` and ``height``, the
+    ``channels`` names, ``mpp`` (0 if unknown) and ``ifds``, the page of
+    each channel at the first Z and T. Pages follow ``TiffData`` when
+    given, else series are stored one after the other in dimension order.
+    """
+    root = ET.fromstring(description)
+    namespace = root.tag[1:].split("}")[0] if root.tag.startswith("{") else ""
+    ns = {"ome": namespace} if namespace else {}
+    prefix = "ome:" if namespace else ""
+    series = []
+    offset = 0
+    for index, image in enumerate(root.findall(prefix + "Image", ns)):
+        pixels = image.find(prefix + "Pixels", ns)
+        channels = pixels.findall(prefix + "Channel", ns)
+        sizes = {
+            "C": len(channels) or int(pixels.get("SizeC", 1)),
+            "Z": int(pixels.get("SizeZ", 1)),
+            "T": int(pixels.get("SizeT", 1)),
+        }
+        order = pixels.get("DimensionOrder", "XYCZT")
+        planeCount = sizes["C"] * sizes["Z"] * sizes["T"]
+        planes = {}
+        for tiffData in pixels.findall(prefix + "TiffData", ns):
+            start = _plane_index(
+                order,
+                sizes,
+                int(tiffData.get("FirstC", 0)),
+                int(tiffData.get("FirstZ", 0)),
+                int(tiffData.get("FirstT", 0)),
+            )
+            ifd = int(tiffData.get("IFD", 0))
+            # Without IFD, TiffData covers every plane; with it, one plane
+            default = 1 if "IFD" in tiffData.attrib else planeCount - start
+            count = int(tiffData.get("PlaneCount", default))
+            for i in range(count):
+                planes[start + i] = ifd + i
+        if not planes:
+            planes = dict((i, offset + i) for i in range(planeCount))
+        offset = max(planes.values()) + 1
+        ifds = [planes.get(_plane_index(order, sizes, c, 0, 0)) for c in range(sizes["C"])]
+        if any(ifd is None or ifd >= pageCount for ifd in ifds):
+            # Planes in other files of a multi-file dataset
+            ifds = [ifd if ifd is not None and ifd < pageCount else None for ifd in ifds]
+        mpp = 0.0
+        if pixels.get("PhysicalSizeX"):
+            mpp = float(pixels.get("PhysicalSizeX")) * _unit_factor(
+                pixels.get("PhysicalSizeXUnit", "µm")
+            )
+        series.append(
+            {
+                "name": image.get("Name") or "Series %d" % index,
+                "width": int(pixels.get("SizeX")),
+                "height": int(pixels.get("SizeY")),
+                "type": pixels.get("Type", ""),
+                "channels": [
+                    channel.get("Name") or "Channel %d" % c
+                    for c, channel in enumerate(channels)
+                ]
+                or ["Channel %d" % c for c in range(sizes["C"])],
+                "mpp": mpp,
+                "ifds": ifds,
+            }
+        )
+    return series
+
+
+class OMETiff(object):
+    """Series and channels of an OME-TIFF file, read from its OME-XML."""
+
+    def __init__(self, path):
+        self.path = path
+        image = pyvips.Image.new_from_file(path)
+        self.pageCount = image.get("n-pages") if image.get_typeof("n-pages") else 1
+        description = (
+            image.get("image-description") if image.get_typeof("image-description") else ""
+        )
+        try:
+            self.series = parse_ome_xml(description, self.pageCount)
+        except (ET.ParseError, AttributeError, TypeError, ValueError):
+            self.series = []
+        if not self.series:
+            # Not OME-XML: one series with one channel per page
+            self.series = [
+                {
+                    "name": "Series 0",
+                    "width": image.width,
+                    "height": image.height,
+                    "type": image.format,
+                    "channels": ["Channel %d" % c for c in range(self.pageCount)],
+                    "mpp": 0.0,
+                    "ifds": list(range(self.pageCount)),
+                }
+            ]
+
+    def levels(self, ifd):
+        """Images of a page and of its SubIFD pyramid levels, largest first."""
+        page = pyvips.Image.new_from_file(self.path, page=ifd, access="random")
+        levels = [page]
+        subifds = page.get("n-subifds") if page.get_typeof("n-subifds") else 0
+        for subifd in range(subifds):
+            levels.append(
+                pyvips.Image.new_from_file(
+                    self.path, page=ifd, subifd=subifd, access="random"
+                )
+            )
+        return levels
+
+    def layers(self):
+        """Virtual layers, one per channel of every series."""
+        result = []
+        for s, series in enumerate(self.series):
+            for c, name in enumerate(series["channels"]):
+                if series["ifds"][c] is None:
+                    continue
+                result.append(
+                    {
+                        "series": s,
+                        "channel": c,
+                        "name": "%s - %s" % (series["name"], name),
+                        "width": series["width"],
+                        "height": series["height"],
+                    }
+                )
+        return result
+
+
+class OMEPlaneSlide(PyramidSlide):
+    """DeepZoom tiles of one channel of one series of an OME-TIFF.
+
+    Tiles are read from the page of the channel or from its SubIFD levels.
+    """
+
+    def __init__(self, path, series, channel, tileSize, overlap):
+        ome = OMETiff(path)
+        try:
+            info = ome.series[series]
+            ifd = info["ifds"][channel]
+        except IndexError:
+            raise ValueError("No channel %d in series %d of %s" % (channel, series, path))
+        if ifd is None:
+            raise ValueError("Channel %d of series %d is not in %s" % (channel, series, path))
+        self.path = path
+        self.levels = ome.levels(ifd)
+        PyramidSlide.__init__(
+            self,
+            [(level.width, level.height) for level in self.levels],
+            tileSize,
+            overlap,
+            self._window(),
+        )
+        self.mpp = info["mpp"]
+        self.properties = {
+            "Path": path,
+            "ome.series": info["name"],
+            "ome.channel": info["channels"][channel],
+        }
+
+    def _window(self):
+        if self.levels[0].format == "uchar":
+            return None
+        level = next(
+            (l for l in self.levels if max(l.width, l.height) <= WINDOW_LEVEL_SIZE),
+            None,
+        )
+        if level is None:
+            level = self.levels[-1]
+            scale = WINDOW_LEVEL_SIZE / max(level.width, level.height)
+            level = level.resize(scale)
+        return percentile_window(
+            np.frombuffer(level.write_to_memory(), dtype=VIPS_FORMATS[level.format])
+        )
+
+    def read_region(self, index, x, y, width, height):
+        return self.levels[index].crop(x, y, width, height)
@@ -0,0 +1,293 @@
+#
+# OME-Zarr (NGFF) multiscale images as tile sources for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+from concurrent.futures import ThreadPoolExecutor
+import os
+import re
+
+import numpy as np
+import pyvips
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+from tissuumaps.pyramid import (
+    VIPS_FORMATS,
+    WINDOW_LEVEL_SIZE,
+    PyramidSlide,
+    percentile_window,
+)
+from tissuumaps.parallel import WORKERS
+
+ZARR_EXTENSION = ".zarr"
+# Virtual layers: <image>.zarr/s<series>/c<channel>
+LAYER_PATTERN = re.compile(
+    r"^(?P<path>.+\.zarr)[/\\]s(?P<series>\d+)[/\\]c(?P<channel>\d+)$", re.IGNORECASE
+)
+# Axes of NGFF 0.1 and 0.2 images, which do not name them
+DEFAULT_AXES = ["t", "c", "z", "y", "x"]
+# Threads decoding chunks, shared by all Zarr layers
+READ_THREADS = max(4, 2 * WORKERS)
+# Metadata files of Zarr v2 and v3 groups and arrays
+METADATA_FILES = [".zattrs", ".zgroup", ".zarray", "zarr.json"]
+
+_readers = None
+
+_NUMPY_FORMATS = dict((np.dtype(v), k) for k, v in VIPS_FORMATS.items())
+
+
+def _get_readers():
+    global _readers
+    if _readers is None:
+        _readers = ThreadPoolExecutor(max_workers=READ_THREADS)
+    return _readers
+
+
+def is_zarr(path):
+    return path.lower().rstrip("/\\").endswith(ZARR_EXTENSION) and os.path.isdir(path)
+
+
+def split_layer_path(path):
+    """Return ``(zarrPath, series, channel)`` of a virtual layer path, or ``None``."""
+    match = LAYER_PATTERN.match(path)
+    if match is None:
+        return None
+    return match.group("path"), int(match.group("series")), int(match.group("channel"))
+
+
+def source_path(path):
+    """Path of the Zarr directory behind a layer path, virtual or not."""
+    layer = split_layer_path(path)
+    return layer[0] if layer else path
+
+
+def layer_path(path, series, channel):
+    return "%s/s%d/c%d" % (path, series, channel)
+
+
+def store_signature(paths):
+    """Modification times of Zarr group and array folders and of their metadata.
+
+    Rewriting a store rewrites its metadata, and replacing the chunks of
+    an array with flat chunk keys changes the time of its folder.
+    """
+    signature = []
+    for path in paths:
+        for name in [""] + METADATA_FILES:
+            try:
+                signature.append(os.stat(os.path.join(path, name)).st_mtime_ns)
+            except OSError:
+                signature.append(None)
+    return tuple(signature)
+
+
+def _multiscales(attrs):
+    # NGFF 0.5 nests its metadata under "ome"
+    return attrs.get("multiscales") or attrs.get("ome", {}).get("multiscales")
+
+
+def _omero(attrs):
+    return attrs.get("omero") or attrs.get("ome", {}).get("omero") or {}
+
+
+def _parse_image(group, name):
+    """Series description of a multiscales image group."""
+    attrs = group.attrs.asdict()
+    multiscale = _multiscales(attrs)[0]
+    axes = [
+        axis["name"] if isinstance(axis, dict) else axis
+        for axis in multiscale.get("axes", DEFAULT_AXES)
+    ]
+    datasets = [dataset["path"] for dataset in multiscale["datasets"]]
+    shape = group[datasets[0]].shape
+    channelCount = shape[axes.index("c")] if "c" in axes else 1
+    omeroChannels = _omero(attrs).get("channels", [])
+    channels, windows = [], []
+    for c in range(channelCount):
+        channel = omeroChannels[c] if c < len(omeroChannels) else {}
+        channels.append(channel.get("label") or "Channel %d" % c)
+        window = channel.get("window", {})
+        if "start" in window and "end" in window and window["end"] > window["start"]:
+            windows.append((float(window["start"]), float(window["end"])))
+        else:
+            windows.append(None)
+    mpp = 0.0
+    for transform in multiscale["datasets"][0].get("coordinateTransformations", []):
+        if transform.get("type") == "scale" and "x" in axes:
+            axis = multiscale["axes"][axes.index("x")]
+            if isinstance(axis, dict) and axis.get("unit") in ("micrometer", None):
+                mpp = float(transform["scale"][axes.index("x")])
+    return {
+        "name": multiscale.get("name") or name,
+        "width": shape[axes.index("x")],
+        "height": shape[axes.index("y")],
+        "axes": axes,
+        "datasets": datasets,
+        "channels": channels,
+        "windows": windows,
+        "mpp": mpp,
+    }
+
+
+class OMEZarr(object):
+    """Multiscale images of an OME-Zarr directory.
+
+    The directory is either one image or, as written by bioformats2raw,
+    a group of images ``0``, ``1``... each becoming a series.
+    """
+
+    def __init__(self, path):
+        if zarr is None:
+            raise ImportError("zarr is required to read OME-Zarr images")
+        self.path = path
+        self.root = zarr.open_group(path, mode="r")
+        self.groups = []
+        if _multiscales(self.root.attrs.asdict()):
+            self.groups.append(self.root)
+        else:
+            index = 0
+            while str(index) in self.root:
+                self.groups.append(self.root[str(index)])
+                index += 1
+        self.series = [
+            _parse_image(group, "Series %d" % index)
+            for index, group in enumerate(self.groups)
+        ]
+        if not self.series:
+            raise ValueError("No multiscale image in %s" % path)
+
+    def layers(self):
+        """Virtual layers, one per channel of every series."""
+        return [
+            {
+                "series": s,
+                "channel": c,
+                "name": "%s - %s" % (series["name"], name),
+                "width": series["width"],
+                "height": series["height"],
+            }
+            for s, series in enumerate(self.series)
+            for c, name in enumerate(series["channels"])
+        ]
+
+
+class ZarrSlide(PyramidSlide):
+    """DeepZoom tiles of one channel of an OME-Zarr image, at the first T and Z.
+
+    Every DeepZoom level is read from the closest multiscale dataset, and
+    only the chunks a tile intersects are decoded, concurrently. Decoded
+    chunks are kept in ``chunkCache``, a :class:`TileCache` of arrays,
+    under the :func:`store_signature` of the image.
+    """
+
+    def __init__(self, path, series, channel, tileSize, overlap, chunkCache=None):
+        image = OMEZarr(path)
+        try:
+            info = image.series[series]
+            group = image.groups[series]
+            window = info["windows"][channel]
+        except IndexError:
+            raise ValueError("No channel %d in series %d of %s" % (channel, series, path))
+        self.path = path
+        self.series = series
+        self.channel = channel
+        self.chunkCache = chunkCache
+        self.arrays = [group[dataset] for dataset in info["datasets"]]
+        groupPath = os.path.join(path, group.path)
+        self._storePaths = [path, groupPath] + [
+            os.path.join(groupPath, dataset) for dataset in info["datasets"]
+        ]
+        self.signature = store_signature(self._storePaths)
+        self.axes = info["axes"]
+        self.yAxis, self.xAxis = self.axes.index("y"), self.axes.index("x")
+        levelSizes = [
+            (array.shape[self.xAxis], array.shape[self.yAxis]) for array in self.arrays
+        ]
+        if self.arrays[0].dtype == np.uint8:
+            window = None
+        elif window is None:
+            window = self._window()
+        PyramidSlide.__init__(self, levelSizes, tileSize, overlap, window)
+        self.mpp = info["mpp"]
+        self.properties = {
+            "Path": path,
+            "zarr.series": info["name"],
+            "zarr.channel": info["channels"][channel],
+        }
+
+    def is_current(self):
+        return store_signature(self._storePaths) == self.signature
+
+    def _selection(self, y, x):
+        """Index of the plane of the layer, with slices ``y`` and ``x``."""
+        selection = []
+        for axis in self.axes:
+            if axis == "y":
+                selection.append(y)
+            elif axis == "x":
+                selection.append(x)
+            elif axis == "c":
+                selection.append(self.channel)
+            else:
+                selection.append(0)
+        return tuple(selection)
+
+    def _window(self):
+        array = self.arrays[-1]
+        step = int(
+            np.ceil(max(array.shape[self.yAxis], array.shape[self.xAxis]) / WINDOW_LEVEL_SIZE)
+        )
+        values = np.asarray(array[self._selection(slice(None), slice(None))])
+        return percentile_window(values[::step, ::step])
+
+    def _read_chunk(self, index, chunkY, chunkX):
+        key = (
+            "zarr", self.path, self.signature, self.series, self.channel, index, chunkY, chunkX
+        )
+        if self.chunkCache is not None:
+            chunk = self.chunkCache.get(key)
+            if chunk is not None:
+                return chunk
+        array = self.arrays[index]
+        height, width = array.chunks[self.yAxis], array.chunks[self.xAxis]
+        chunk = np.asarray(
+            array[
+                self._selection(
+                    slice(chunkY * height, (chunkY + 1) * height),
+                    slice(chunkX * width, (chunkX + 1) * width),
+                )
+            ]
+        )
+        if self.chunkCache is not None:
+            self.chunkCache.put(key, chunk)
+        return chunk
+
+    def read_region(self, index, x, y, width, height):
+        array = self.arrays[index]
+        chunkHeight, chunkWidth = array.chunks[self.yAxis], array.chunks[self.xAxis]
+        addresses = [
+            (chunkY, chunkX)
+            for chunkY in range(y // chunkHeight, (y + height - 1) // chunkHeight + 1)
+            for chunkX in range(x // chunkWidth, (x + width - 1) // chunkWidth + 1)
+        ]
+        chunks = _get_readers().map(
+            lambda address: self._read_chunk(index, *address), addresses
+        )
+        region = np.empty((height, width), dtype=array.dtype)
+        for (chunkY, chunkX), chunk in zip(addresses, chunks):
+            top, left = chunkY * chunkHeight, chunkX * chunkWidth
+            y0, x0 = max(y, top), max(x, left)
+            y1 = min(y + height, top + chunk.shape[0])
+            x1 = min(x + width, left + chunk.shape[1])
+            region[y0 - y : y1 - y, x0 - x : x1 - x] = chunk[y0 - top : y1 - top, x0 - left : x1 - left]
+        if region.dtype not in _NUMPY_FORMATS:
+            region = region.astype(np.float32)
+        return pyvips.Image.new_from_memory(
+            np.ascontiguousarray(region).tobytes(), width, height, 1, _NUMPY_FORMATS[region.dtype]
+        )
@@ -0,0 +1,52 @@
+#
+# Process pools for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+from threading import Lock
+
+WORKERS = os.cpu_count() or 1
+# Name prefix of the pool processes; the package skips the server in them
+WORKER_NAME = "TissUUmapsWorker-"
+
+_pool = None
+_poolLock = Lock()
+
+
+def is_worker():
+    """True in the processes of the pool."""
+    return multiprocessing.current_process().name.startswith(WORKER_NAME)
+
+
+class _WorkerContext(object):
+    """Spawn context naming the processes it starts after ``WORKER_NAME``."""
+
+    def __init__(self):
+        self._context = multiprocessing.get_context("spawn")
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+    def Process(self, *args, **kwargs):
+        process = self._context.Process(*args, **kwargs)
+        process.name = WORKER_NAME + process.name
+        return process
+
+
+def process_pool():
+    """Return the process pool shared by all computations, started on first use.
+
+    Workers are spawned rather than forked: the server process runs libvips
+    and OpenBLAS threads that do not survive a fork. Spawning is slow, so
+    the pool is kept for the life of the server; do not shut it down.
+    """
+    global _pool
+    with _poolLock:
+        if _pool is None or getattr(_pool, "_broken", False):
+            _pool = ProcessPoolExecutor(max_workers=WORKERS, mp_context=_WorkerContext())
+        return _pool
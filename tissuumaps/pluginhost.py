@@ -0,0 +1,170 @@
+#
+# Long-lived plugin instances, with shared jobs and caches, for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import sys
+from threading import Lock
+import time
+import uuid
+
+from tissuumaps.tilecache import TileCache
+
+# Finished jobs kept per plugin for their status to be queried
+MAX_FINISHED_JOBS = 100
+
+
+def _sizeof(value):
+    """Approximate size in bytes of a cached value."""
+    if hasattr(value, "nbytes"):
+        return value.nbytes
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    return sys.getsizeof(value)
+
+
+class Job(object):
+    """Background job of a plugin.
+
+    The job function gets the job as first argument and may report its
+    progress, between 0 and 1, with :meth:`set_progress`.
+    """
+
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.progress = 0.0
+        self.message = ""
+        self.created = time.time()
+        self.future = None
+
+    def set_progress(self, progress, message=None):
+        self.progress = min(max(float(progress), 0.0), 1.0)
+        if message is not None:
+            self.message = message
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+    def cancel(self):
+        """Cancel the job if it has not started yet."""
+        return self.future.cancel()
+
+    def status(self):
+        """JSON description of the job, with its result once done."""
+        status = {
+            "id": self.id,
+            "name": self.name,
+            "progress": self.progress,
+            "message": self.message,
+            "state": "running",
+        }
+        if self.future.cancelled():
+            status["state"] = "cancelled"
+        elif self.future.done():
+            error = self.future.exception()
+            if error is None:
+                status["state"] = "done"
+                status["progress"] = 1.0
+                status["result"] = self.future.result()
+            else:
+                status["state"] = "failed"
+                status["message"] = str(error)
+        return status
+
+
+class PluginContext(object):
+    """What the host shares with one plugin: background jobs and a cache.
+
+    ``cache`` is a :class:`TileCache` bounded in bytes, kept as long as
+    the worker runs.
+    """
+
+    def __init__(self, name, executor, cacheBytes):
+        self.name = name
+        self.cache = TileCache(cacheBytes, sizeof=_sizeof)
+        self._executor = executor
+        self._jobs = OrderedDict()
+        self._lock = Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        """Run ``fn(job, *args, **kwargs)`` in the background; return the job."""
+        job = Job(getattr(fn, "__name__", "job"))
+
+        def run():
+            try:
+                return fn(job, *args, **kwargs)
+            except Exception:
+                import traceback
+
+                logging.error(traceback.format_exc())
+                raise
+
+        with self._lock:
+            job.future = self._executor.submit(run)
+            self._jobs[job.id] = job
+            finished = [j for j in self._jobs.values() if j.done()]
+            for j in finished[: max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+                del self._jobs[j.id]
+        return job
+
+    def job(self, jobId):
+        with self._lock:
+            return self._jobs.get(jobId)
+
+    def jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+
+class PluginHost(object):
+    """Plugins loaded once per worker, their instance kept between requests.
+
+    ``load(name)`` returns the module of a plugin, whose ``Plugin(app)``
+    class is instantiated on first use. The instance gets its
+    :class:`PluginContext` as ``host`` attribute. As instances serve
+    concurrent requests, they must not keep per-request state.
+    """
+
+    def __init__(self, app, load, jobThreads, cacheBytes):
+        self.app = app
+        self.load = load
+        self.cacheBytes = cacheBytes
+        self._executor = ThreadPoolExecutor(max_workers=jobThreads)
+        self._instances = {}
+        self._contexts = {}
+        self._lock = Lock()
+
+    def context(self, name, create=True):
+        """Context of plugin ``name``; ``None`` if it has none and not ``create``."""
+        with self._lock:
+            if name not in self._contexts:
+                if not create:
+                    return None
+                self._contexts[name] = PluginContext(name, self._executor, self.cacheBytes)
+            return self._contexts[name]
+
+    def get(self, name):
+        """Instance of plugin ``name``, loaded on first call."""
+        instance = self._instances.get(name)
+        if instance is not None:
+            return instance
+        # Loaded first, so that unknown plugins get no context
+        module = self.load(name)
+        context = self.context(name)
+        with self._lock:
+            instance = self._instances.get(name)
+            if instance is None:
+                instance = module.Plugin(self.app)
+                instance.host = context
+                self._instances[name] = instance
+                logging.info("Plugin %s loaded" % name)
+            return instance
@@ -168,6 +168,8 @@ Spot_Inspector.loadImages = function (pathFormat) {
                     projectUtils.loadLayers(data);
                 else
                     projectUtils.loadProject(data);
+                if (data.pendingLayers && data.pendingLayers.length > 0)
+                    Spot_Inspector.addPendingLayers(data.pendingLayers, path);
                 setTimeout(function() {
                     Spot_Inspector.changeOrder(false);
                     $("#Spot_Inspector_order_rounds")[0].value = JSON.stringify(Spot_Inspector._order_rounds);
@@ -186,6 +188,54 @@ Spot_Inspector.loadImages = function (pathFormat) {
     );
 }
 
+/**
+ * Add the layers of importFolder still being converted on the server,
+ * each one as soon as its conversion is done */
+Spot_Inspector.addPendingLayers = function (pendingLayers, path) {
+    $.ajax(
+        {
+            type : 'post',
+            url : '/plugins/Spot_Inspector/importStatus',
+            contentType: 'application/json; charset=utf-8',
+            data : JSON.stringify({
+                    'path' : path,
+                    'tileSources': pendingLayers.map(function(layer) {return layer.tileSource;})
+            }),
+            success : function(data)
+            {
+                var stillPending = [];
+                pendingLayers.forEach(function(layer) {
+                    if (data.failed.includes(layer.tileSource)) {
+                        console.log("Impossible to convert", layer.name);
+                    }
+                    else if (data.ready.includes(layer.tileSource)) {
+                        tmapp.layers.push({name: layer.name, tileSource: layer.tileSource});
+                        var i = tmapp.layers.length - 1;
+                        filterUtils._filterItems[i] = layer.layerFilter;
+                        overlayUtils.addLayer(layer.name, layer.tileSource, i-1);
+                    }
+                    else {
+                        stillPending.push(layer);
+                    }
+                });
+                if (stillPending.length < pendingLayers.length) {
+                    overlayUtils.addAllLayersSettings();
+                    filterUtils.setCompositeOperation();
+                }
+                if (stillPending.length > 0) {
+                    setTimeout(function() {
+                        Spot_Inspector.addPendingLayers(stillPending, path);
+                    }, 2000);
+                }
+            },
+            error:function (data)
+            {
+                console.log("Error:", data);
+            }
+        }
+    );
+}
+
 Spot_Inspector.run = function () {
     if (Spot_Inspector._started)
         return;
@@ -328,49 +378,44 @@ Spot_Inspector.getMatrix = function (bbox, layers, markers, order) {
     const queryString = window.location.search;
     const urlParams = new URLSearchParams(queryString);
     const path = urlParams.get('path')
-    $.ajax(
-        {
-            // Post select to url.
-            type : 'post',
-            url : '/plugins/Spot_Inspector/getMatrix',
-            contentType: 'application/json; charset=utf-8',
-            data : JSON.stringify({
-                    'bbox' : bbox,
-                    'figureSize' : Spot_Inspector._figureSize,
-                    'layers' : layers,
-                    'path' : path,
-                    'markers' : markers,
-                    'order_rounds': Spot_Inspector._order_rounds,
-                    'order_channels': Spot_Inspector._order_channels,
-                    'cmap': Spot_Inspector._cmap
-            }),
-            success : function(data)
-            {
-                img = document.getElementById("ISS_Spot_Inspector_img");
-                console.log("img", img)
-                if (!img) {
-                    var img = document.createElement("img");
-                    img.id = "ISS_Spot_Inspector_img";
-                    var elt = document.createElement("div");
-                    elt.classList.add("viewer-layer")
-                    elt.classList.add("px-1")
-                    elt.classList.add("mx-1")
-                    elt.appendChild(img);
-                    tmapp[vname].addControl(elt,{anchor: OpenSeadragon.ControlAnchor.BOTTOM_RIGHT});
-                    elt.parentElement.parentElement.style.zIndex = "100";
-                    elt.style.display = "table";
-                }
-                img.setAttribute("src", "data:image/png;base64," + data);
-                img.style.filter = "none";
-            },
-            complete : function(data)
-            {
-                // do something, not critical.
-            },
-            error:function (data)
-            {
-                console.log("Error:", data);
-            }
+    fetch('/plugins/Spot_Inspector/getMatrix', {
+        // Post select to url.
+        method: 'POST',
+        headers: {'Content-Type': 'application/json; charset=utf-8'},
+        body: JSON.stringify({
+                'bbox' : bbox,
+                'figureSize' : Spot_Inspector._figureSize,
+                'layers' : layers,
+                'path' : path,
+                'markers' : markers,
+                'order_rounds': Spot_Inspector._order_rounds,
+                'order_channels': Spot_Inspector._order_channels,
+                'cmap': Spot_Inspector._cmap
+        })
+    }).then(function (response) {
+        if (!response.ok) throw new Error(response.statusText);
+        // The matrix is sent as a binary PNG
+        return response.blob();
+    }).then(function (blob) {
+        img = document.getElementById("ISS_Spot_Inspector_img");
+        console.log("img", img)
+        if (!img) {
+            var img = document.createElement("img");
+            img.id = "ISS_Spot_Inspector_img";
+            var elt = document.createElement("div");
+            elt.classList.add("viewer-layer")
+            elt.classList.add("px-1")
+            elt.classList.add("mx-1")
+            elt.appendChild(img);
+            tmapp[vname].addControl(elt,{anchor: OpenSeadragon.ControlAnchor.BOTTOM_RIGHT});
+            elt.parentElement.parentElement.style.zIndex = "100";
+            elt.style.display = "table";
         }
-    );
+        var previous = img.getAttribute("src");
+        img.setAttribute("src", URL.createObjectURL(blob));
+        if (previous && previous.startsWith("blob:")) URL.revokeObjectURL(previous);
+        img.style.filter = "none";
+    }).catch(function (error) {
+        console.log("Error:", error);
+    });
 }
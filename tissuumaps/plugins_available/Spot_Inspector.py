@@ -1,8 +1,12 @@
 from flask import Flask, abort, make_response, render_template
 from openslide import OpenSlideError
 import os, glob
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import BytesIO
-from PIL import Image
+import json
+from threading import Lock
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
 
 import matplotlib
 matplotlib.use('Agg')
@@ -15,7 +19,86 @@ import logging
 #from mpl_toolkits.axes_grid1 import make_axes_locatable
 #import importlib
 #importlib.import_module('mpl_toolkits.axes_grid1').make_axes_locatable
-import base64
+
+# Threads reading the regions of all layers of a matrix
+READ_THREADS = 8
+# Pixels per inch of figureSize, as in the matplotlib figure
+FIGURE_DPI = 80
+# Background conversions of images OpenSlide cannot read
+CONVERT_THREADS = 2
+
+_readers = None
+_converters = None
+_colormaps = {}
+# path -> (mtime, Future) of the running and failed conversions
+_conversions = {}
+_conversionLock = Lock()
+
+
+def _get_readers():
+    global _readers
+    if _readers is None:
+        _readers = ThreadPoolExecutor(max_workers=READ_THREADS)
+    return _readers
+
+
+def _get_converters():
+    global _converters
+    if _converters is None:
+        _converters = ThreadPoolExecutor(max_workers=CONVERT_THREADS)
+    return _converters
+
+
+def _converted_path(path):
+    """Pyramidal TIFF of an image, where the viewer also looks for it."""
+    return (
+        os.path.dirname(path) + "/.tissuumaps/"
+        + os.path.splitext(os.path.basename(path))[0] + ".tif"
+    )
+
+
+def _convert(path, newpath):
+    newpath = ImageConverter(path, newpath).convert()
+    if not os.path.isfile(newpath):
+        raise OSError("Impossible to convert %s" % path)
+    return newpath
+
+
+def _schedule_conversion(path):
+    """Future of the conversion of ``path``, started if not already done or running.
+
+    Failed conversions are retried only once the image is modified.
+    """
+    mtime = os.path.getmtime(path)
+    newpath = _converted_path(path)
+    with _conversionLock:
+        # Finished conversions are known from their output
+        for done in [
+            p for p, (_, f) in _conversions.items() if f.done() and f.exception() is None
+        ]:
+            del _conversions[done]
+        convertedMtime, future = _conversions.get(path, (None, None))
+        if future is None or convertedMtime != mtime:
+            if os.path.isfile(newpath):
+                future = Future()
+                future.set_result(newpath)
+                return future
+            os.makedirs(os.path.dirname(newpath), exist_ok=True)
+            future = _get_converters().submit(_convert, path, newpath)
+            _conversions[path] = (mtime, future)
+        return future
+
+
+def _colormap_lut(name):
+    """``(256, 3)`` uint8 lookup table of a matplotlib colormap."""
+    if name not in _colormaps:
+        try:
+            cmap = plt.get_cmap(name)
+        except ValueError:
+            cmap = plt.get_cmap("Greys_r")
+        _colormaps[name] = np.round(cmap(np.arange(256))[:, :3] * 255).astype(np.uint8)
+    return _colormaps[name]
+
 
 class PILBytesIO(BytesIO):
     def fileno(self):
@@ -29,6 +112,8 @@ class ImageConverter():
     
     def convert (self):
         if not os.path.isfile(self.outputImage):
+            # Written aside and moved, so that no one reads a partial pyramid
+            partImage = self.outputImage + ".part"
             try:
                 imgVips = pyvips.Image.new_from_file(self.inputImage)
                 minVal = imgVips.percent(10)
@@ -42,11 +127,14 @@ class ImageConverter():
                 imgVips = (imgVips > 255).ifthenelse(255, imgVips)
                 logging.debug ("minVal, maxVal", imgVips.min(), imgVips.max())
                 imgVips = imgVips.scaleimage()
-                imgVips.tiffsave(self.outputImage, pyramid=True, tile=True, tile_width=256, tile_height=256, properties=True, bitdepth=8)
+                imgVips.tiffsave(partImage, pyramid=True, tile=True, tile_width=256, tile_height=256, properties=True, bitdepth=8)
+                os.replace(partImage, self.outputImage)
             except: 
                 logging.error ("Impossible to convert image using VIPS:")
                 import traceback
                 logging.error (traceback.format_exc())
+                if os.path.isfile(partImage):
+                    os.remove(partImage)
             self.convertDone = True
         return self.outputImage
 
@@ -71,10 +159,8 @@ class Plugin ():
             if ".tissuumaps" in path:
                 abort(500)
             try:
-                newpath = os.path.dirname(path) + "/.tissuumaps/" + os.path.basename(path)
-                if not os.path.isdir(os.path.dirname(path) + "/.tissuumaps/"):
-                    os.makedirs(os.path.dirname(path) + "/.tissuumaps/")
-                path = ImageConverter(path,newpath).convert()
+                # Waits for the conversion if importFolder already started it
+                path = _schedule_conversion(path).result()
                 #imgPath = imgPath.replace("\\","/")
                 return self._get_slide(path)
             except:
@@ -83,11 +169,14 @@ class Plugin ():
                 logging.error ("OpenSlideError, aborting.")
                 abort(500)
     
-    def getTile (self, path, bbox):
+    def _layer_file(self, path):
         path = path.replace(".dzi","")
         if path[0] == "\\" or path[0] == "/":
             path = path[1:]
-        slide = self._get_slide(path)
+        return os.path.abspath(os.path.join(self.app.basedir, path))
+
+    def getTile (self, path, bbox):
+        slide = self._get_slide(self._layer_file(path))
         try:
             with slide.tileLock:
                 tile = slide.osr.read_region((bbox[0],bbox[1]), 0, (bbox[2], bbox[3]))
@@ -113,28 +202,14 @@ class Plugin ():
                     pass
         return dst
         
-    def getPlot (self, tiles, rounds, channels, markers, bbox):
+    def getTraces (self, tiles, rounds, channels, markers, bbox):
+        """Points of every marker in the matrix, as ``(x, y, color, label)``.
+
+        Points are in matrix pixels, with pixel centres at integers.
+        """
         singleWidth = tiles[rounds[0]][channels[0]].width
         singleHeight = tiles[rounds[0]][channels[0]].height
-        
-        im = self.getConcat(tiles, rounds, channels).convert("L")
-        fig = plt.figure(figsize=(self.figureSize, self.figureSize*4/5), dpi=80)
-        ax = fig.add_subplot(111)
-        #plt.axis('off')
-        imcolor = plt.imshow(im, cmap=plt.get_cmap(self.cmap), vmin=0, vmax=255)
-        
-        # create an axes on the right side of ax. The width of cax will be 5%
-        # of ax and the padding between cax and ax will be fixed at 0.05 inch.
-        #divider = make_axes_locatable(ax)
-        #cax = divider.append_axes("right", size="5%", pad=0.05)
-
-        plt.colorbar(imcolor, fraction=0.036, pad=0.05)#, cax=cax)
-
-        for xIndex in range(len(channels)+1):
-            ax.axvline(x=singleWidth * xIndex - 0.5, color="red", linewidth=1)
-        for yIndex in range(len(rounds)+1):
-            ax.axhline(y=singleHeight * yIndex - 0.5, color="red", linewidth=1)
-        
+        traces = []
         for marker in markers:
             try:
                 x, y = [], []
@@ -148,19 +223,43 @@ class Plugin ():
                     markerchannels = [channels[int(m)] for m in markerchannels]
                 else:
                     markerchannels = marker["letters"]
-                
+
                 offset = marker["global_X_pos"] - bbox[0]-0.5, marker["global_Y_pos"] - bbox[1]-0.5
                 for yIndex, (markerchannel, markerRound) in enumerate(zip(markerchannels, markerRounds)):
                     xIndex = channels.index(markerchannel)
                     x.append(offset[0] + singleWidth * xIndex)
-                    y.append(offset[1] + singleWidth * yIndex)
-                ax.plot(x, y, 'o-', label=markerchannels, color=marker["color"], markersize=5, marker="x")
+                    y.append(offset[1] + singleHeight * yIndex)
+                traces.append((x, y, marker["color"], markerchannels))
             except:
-                import traceback
                 import traceback
                 logging.error (traceback.format_exc())
-                pass
-        
+        return traces
+
+    def getPlot (self, tiles, rounds, channels, markers, bbox, cmap, figureSize):
+        singleWidth = tiles[rounds[0]][channels[0]].width
+        singleHeight = tiles[rounds[0]][channels[0]].height
+
+        im = self.getConcat(tiles, rounds, channels).convert("L")
+        fig = plt.figure(figsize=(figureSize, figureSize*4/5), dpi=FIGURE_DPI)
+        ax = fig.add_subplot(111)
+        #plt.axis('off')
+        imcolor = plt.imshow(im, cmap=plt.get_cmap(cmap), vmin=0, vmax=255)
+
+        # create an axes on the right side of ax. The width of cax will be 5%
+        # of ax and the padding between cax and ax will be fixed at 0.05 inch.
+        #divider = make_axes_locatable(ax)
+        #cax = divider.append_axes("right", size="5%", pad=0.05)
+
+        plt.colorbar(imcolor, fraction=0.036, pad=0.05)#, cax=cax)
+
+        for xIndex in range(len(channels)+1):
+            ax.axvline(x=singleWidth * xIndex - 0.5, color="red", linewidth=1)
+        for yIndex in range(len(rounds)+1):
+            ax.axhline(y=singleHeight * yIndex - 0.5, color="red", linewidth=1)
+
+        for x, y, color, label in self.getTraces(tiles, rounds, channels, markers, bbox):
+            ax.plot(x, y, 'o-', label=label, color=color, markersize=5, marker="x")
+
         ax.set_xticks([i*singleWidth + singleWidth/2-0.5 for i,_ in enumerate(channels)])
         ax.set_xticklabels([c.replace(".tif","") for c in channels])
         ax.set_yticks([i*singleHeight + singleHeight/2-0.5 for i,_ in enumerate(rounds)])
@@ -174,21 +273,84 @@ class Plugin ():
         plt.close()
         #plt.close(fig)
         return buf
-        
+
+    def getGrid (self, tiles, rounds, channels, markers, bbox, cmap, figureSize):
+        """Same matrix as getPlot, drawn with NumPy and PIL instead of matplotlib."""
+        singleWidth = tiles[rounds[0]][channels[0]].width
+        singleHeight = tiles[rounds[0]][channels[0]].height
+        grey = np.asarray(self.getConcat(tiles, rounds, channels).convert("L"))
+        lut = _colormap_lut(cmap)
+        # Integer zoom filling about the image area of the matplotlib figure
+        zoom = max(1, int(figureSize * FIGURE_DPI * 0.7 // max(grey.shape[1], 1)))
+        matrix = Image.fromarray(lut[grey], "RGB").resize(
+            (grey.shape[1] * zoom, grey.shape[0] * zoom), Image.NEAREST
+        )
+        left, top, bottom, right = 20, 5, 20, 45
+        canvas = Image.new(
+            "RGB", (left + matrix.width + right, top + matrix.height + bottom), "white"
+        )
+        canvas.paste(matrix, (left, top))
+        draw = ImageDraw.Draw(canvas)
+        for xIndex in range(len(channels)+1):
+            x = left + xIndex * singleWidth * zoom
+            draw.line([(x, top), (x, top + matrix.height)], fill="red")
+        for yIndex in range(len(rounds)+1):
+            y = top + yIndex * singleHeight * zoom
+            draw.line([(left, y), (left + matrix.width, y)], fill="red")
+        for x, y, color, _ in self.getTraces(tiles, rounds, channels, markers, bbox):
+            try:
+                color = ImageColor.getrgb(color)
+            except (AttributeError, ValueError):
+                color = (255, 0, 0)
+            points = [
+                (left + (px + 0.5) * zoom, top + (py + 0.5) * zoom) for px, py in zip(x, y)
+            ]
+            if len(points) > 1:
+                draw.line(points, fill=color, width=2)
+            for px, py in points:
+                draw.line([(px - 4, py - 4), (px + 4, py + 4)], fill=color, width=2)
+                draw.line([(px - 4, py + 4), (px + 4, py - 4)], fill=color, width=2)
+        for index, channel in enumerate(channels):
+            draw.text(
+                (left + (index + 0.5) * singleWidth * zoom - 3 * len(channel), top + matrix.height + 4),
+                channel.replace(".tif", ""), fill="black",
+            )
+        for index, round in enumerate(rounds):
+            draw.text((2, top + (index + 0.5) * singleHeight * zoom - 5), str(round), fill="black")
+        # Colour bar
+        barLeft = left + matrix.width + 10
+        bar = lut[np.linspace(255, 0, matrix.height).astype(np.uint8)]
+        canvas.paste(
+            Image.fromarray(np.ascontiguousarray(np.repeat(bar[:, None], 10, axis=1)), "RGB"),
+            (barLeft, top),
+        )
+        draw.text((barLeft + 13, top), "255", fill="black")
+        draw.text((barLeft + 13, top + matrix.height - 10), "0", fill="black")
+        buf = PILBytesIO()
+        canvas.save(buf, "png", compress_level=1)
+        return buf
+
     def getMatrix (self, jsonParam):
+        """PNG matrix of the regions of every round and channel around a spot.
+
+        Regions are read concurrently. The matrix is drawn with NumPy and
+        PIL unless ``renderer`` is ``"matplotlib"``, and kept in the plugin
+        cache of the host, by request and source files.
+        """
         if (not jsonParam):
             logging.error ("No arguments, aborting.")
             abort(500)
-        print (jsonParam)
         bbox = jsonParam["bbox"]
         layers = jsonParam["layers"]
         path = jsonParam["path"]
         markers = jsonParam["markers"]
-        self.figureSize = jsonParam["figureSize"]
+        # The plugin instance serves concurrent requests: no state on self
+        figureSize = jsonParam["figureSize"]
         if "cmap" in jsonParam.keys():
-            self.cmap = jsonParam["cmap"]
+            cmap = jsonParam["cmap"]
         else:
-            self.cmap = 'Greys_r'
+            cmap = 'Greys_r'
+        renderer = jsonParam.get("renderer", "grid")
         logging.debug ("getMatrix", bbox, layers, markers)
         tiles = {}
         rounds = jsonParam["order_rounds"]
@@ -202,21 +364,95 @@ class Plugin ():
                     rounds.append(round)
                 if channel not in channels:
                     channels.append(channel)
-        for layer in layers:
-            round, channel = layer["name"].split("_")
-            if round not in tiles.keys():
-                tiles[round] = {}
-            tiles[round][channel] = self.getTile(path + "/" + layer["tileSource"], bbox)
-
-        plot = self.getPlot(tiles, rounds, channels, markers, bbox)
-        format = "png"
-        img_str = base64.b64encode(plot.getvalue())
-        resp = make_response(img_str)
-        #resp.mimetype = 'image/%s' % format
-        #resp.cache_control.max_age = 0
-        #resp.cache_control.public = True
+        layerPaths = [(path or "") + "/" + layer["tileSource"] for layer in layers]
+        mtimes = []
+        for layerPath in layerPaths:
+            try:
+                mtimes.append(os.path.getmtime(self._layer_file(layerPath)))
+            except OSError:
+                mtimes.append(None)
+        cacheKey = json.dumps(
+            ["matrix", bbox, layers, layerPaths, mtimes, markers, cmap, rounds, channels,
+             figureSize, renderer],
+            sort_keys=True,
+        )
+        data = self.host.cache.get(cacheKey)
+        if data is None:
+            regions = list(_get_readers().map(
+                lambda layerPath: self.getTile(layerPath, bbox), layerPaths
+            ))
+            for layer, region in zip(layers, regions):
+                round, channel = layer["name"].split("_")
+                if round not in tiles.keys():
+                    tiles[round] = {}
+                tiles[round][channel] = region
+            if renderer == "matplotlib":
+                data = self.getPlot(tiles, rounds, channels, markers, bbox, cmap, figureSize).getvalue()
+            else:
+                data = self.getGrid(tiles, rounds, channels, markers, bbox, cmap, figureSize).getvalue()
+            self.host.cache.put(cacheKey, data)
+        resp = make_response(data)
+        resp.mimetype = "image/png"
+        resp.cache_control.max_age = 0
         return resp
 
+    def _file_format(self, path):
+        """"slide" if the viewer reads ``path`` directly, "convert" if it must be
+        converted first, ``None`` if unreadable. Cached per file version."""
+        try:
+            key = ("format", path, os.path.getmtime(path))
+        except OSError:
+            return None
+        fileFormat = self.host.cache.get(key)
+        if fileFormat is not None:
+            return fileFormat or None
+        try:
+            self.app.cache.get(path)
+            fileFormat = "slide"
+        except OpenSlideError:
+            try:
+                # Only reads the header
+                pyvips.Image.new_from_file(path)
+                fileFormat = "convert"
+            except pyvips.Error:
+                fileFormat = None
+        except:
+            fileFormat = None
+        # Unreadable files are cached as ""
+        self.host.cache.put(key, fileFormat or "")
+        return fileFormat
+
+    def _is_ready(self, path):
+        """Schedule the conversion ``path`` needs, if any; True once readable."""
+        fileFormat = self._file_format(path)
+        if fileFormat != "convert":
+            return fileFormat == "slide"
+        future = _schedule_conversion(path)
+        if not future.done():
+            return False
+        if future.exception() is not None:
+            raise future.exception()
+        return True
+
+    def importStatus (self, jsonParam):
+        """Layers of importFolder whose conversion finished, or failed."""
+        if (not jsonParam):
+            logging.error ("No arguments, aborting.")
+            abort(500)
+        ready, failed = [], []
+        for tileSource in jsonParam["tileSources"]:
+            filename = self._layer_file((jsonParam["path"] or "") + "/" + tileSource)
+            if not filename.startswith(self.app.basedir):
+                # Directory traversal
+                failed.append(tileSource)
+                continue
+            try:
+                if self._is_ready(filename):
+                    ready.append(tileSource)
+            except Exception:
+                failed.append(tileSource)
+        return {"ready": ready, "failed": failed}
+
     def importFolder (self, jsonParam):
         if (not jsonParam):
             logging.error ("No arguments, aborting.")
@@ -230,17 +466,22 @@ class Plugin ():
         path = os.path.abspath(os.path.join(self.app.basedir, relativepath))
         absoluteRoot = os.path.abspath(self.app.basedir)
         logging.debug ("path",relativepath, path, absoluteRoot)
-        tifFiles_ = glob.glob(path + "/" + pathFormat)
+        tifFiles_ = sorted(set(
+            tifFile for tifFile in glob.glob(path + "/" + pathFormat)
+            if os.path.isfile(tifFile) and os.path.abspath(tifFile).startswith(absoluteRoot)
+        ))
+        # Files are checked concurrently; the ones to convert are converted in
+        # the background and listed as pending, for the client to add them later.
         tifFiles = []
-        for tifFile in tifFiles_:
-            if tifFile in tifFiles:
-                continue
-            try:
-                self._get_slide(tifFile)
-                tifFiles.append(tifFile)
-            except:
-                logging.error ("impossible to read", tifFile,". Abort this file.")
+        pendingFiles = []
+        for tifFile, fileFormat in zip(tifFiles_, _get_readers().map(self._file_format, tifFiles_)):
+            if fileFormat is None:
+                logging.error ("impossible to read %s. Abort this file." % tifFile)
                 continue
+            tifFiles.append(tifFile)
+            if (fileFormat == "convert" and not os.path.isfile(_converted_path(tifFile))
+                    and not _schedule_conversion(tifFile).done()):
+                pendingFiles.append(tifFile)
         logging.debug (tifFiles)
         # csvFiles = glob.glob(path + "/*.csv")
         csvFilesDesc = []
@@ -255,6 +496,7 @@ class Plugin ():
         #    })
         
         layers = []
+        pendingLayers = []
         layerFilters = {}
         rounds = []
         channels = []
@@ -283,13 +525,18 @@ class Plugin ():
             logging.debug (channels, channel)
             logging.debug (channels.index(channel)%len(colors))
             layerFilter = [{"value": colors[channels.index(channel)%len(colors)],"name": "Color"}]
-            layerFilters[fileIndex] = layerFilter
+            if filename in pendingFiles:
+                layer["layerFilter"] = layerFilter
+                pendingLayers.append(layer)
+                continue
+            layerFilters[len(layers)] = layerFilter
             layers.append(layer)
         jsonFile = {
             "markerFiles": csvFilesDesc,
             "CPFiles": [],
             "filters": ["Color"],
             "layers": layers,
+            "pendingLayers": pendingLayers,
             "layerFilters": layerFilters,
             "slideFilename": os.path.basename(path),
             "compositeMode": "lighter"
@@ -18,6 +18,14 @@ transform = {
             name:"Resize image",
             function:"resizeImage"
         },
+        {
+            name:"Register image",
+            function:"registerImage"
+        },
+        {
+            name:"Bake transformed image",
+            function:"bakeImage"
+        },
         /*{
             name:"Transform markers",
             function:"transformMarkers"
@@ -68,32 +76,118 @@ transform.transformImage = function () {
     }
     console.log("selectedLayer", selectedLayer, tmapp.layers[selectedLayer].tileSource);
     matrixString=prompt("Please paste your transformation matrix here, as six comma separated numbers:","1,0,0,1,0,0");
-    matrix = matrixString.match(/\d+(?:\.\d+)?/g).map(Number)
+    matrix = transform.parseMatrix(matrixString);
     console.log(matrix);
-    console.log(tmapp.fixed_file);
+    transform.addVirtualLayer(tmapp.layers[selectedLayer].tileSource, matrix, "Transformed layer");
+}
+
+/**
+ * Numbers of a matrix typed by the user, negative ones included */
+transform.parseMatrix = function (matrixString) {
+    return matrixString.match(/-?\d+(?:\.\d+)?(?:e[-+]?\d+)?/gi).map(Number);
+}
+
+/**
+ * Add a layer computed on the fly from tileSource through an affine matrix.
+ * Only the source and the matrix are kept, in the tile source of the layer. */
+transform.addVirtualLayer = function (tileSource, matrix, layerName) {
+    var source = tileSource.replace(/\.dzi$/,"");
+    transform.loadState({"image": source + "/affine/" + matrix.join(",")}, layerName);
+}
+
+/**
+ * Estimate on the server the matrix mapping a layer onto another one,
+ * and add the transformed layer */
+transform.registerImage = function () {
+    layers = tmapp.layers.map(({ name }, index) => (index - -1) + ". "+ name).join("\n");
+    fixedLayer = parseInt(prompt("Which layer is the reference (1 - " + tmapp.layers.length + ") ?\n" + layers,"1"))-1;
+    movingLayer = parseInt(prompt("Which layer do you want to register onto it (1 - " + tmapp.layers.length + ") ?\n" + layers,"2"))-1;
     $("#loadingModal").show();
     $.ajax(
         {
-            // Post select to url.
             type : 'post',
-            url : '/plugin/transform/transform',
+            url : '/register',
             contentType: 'application/json; charset=utf-8',
             data : JSON.stringify({
-                    'path' : tmapp.layers[selectedLayer].tileSource,
-                    'outputSuffix':"_transformed",
-                    'matrix': matrix //[2.0072846463943876, -0.03895444531413667, -0.05744089589832094, -1.9617630620838924, -137.7703410591635*8, 6284.0522698317745*8]//[0.4978627682471971, -0.009762949861712243, -0.014492830616151765, -0.5089427682566419, 159.98505755852736*8., 3198.1725416545833*8.  ]
+                    'fixed' : tmapp.layers[fixedLayer].tileSource,
+                    'moving' : tmapp.layers[movingLayer].tileSource
             }),
             success : function(data)
             {
                 $("#loadingModal").hide();
-                transform.loadState(data);
+                console.log("Registration matrix:", data["matrix"].join(","));
+                transform.addVirtualLayer(tmapp.layers[movingLayer].tileSource, data["matrix"], "Registered layer");
             },
-            complete : function(data)
+            error:function (data)
+            {
+                $("#loadingModal").hide();
+                interfaceUtils.alert("Impossible to register these layers.");
+            }
+        }
+    );
+}
+
+/**
+ * Write a transformed layer to a new image file, on the server */
+transform.bakeImage = function () {
+    layers = tmapp.layers.map(({ name }, index) => (index - -1) + ". "+ name).join("\n");
+    selectedLayer = parseInt(prompt("Which transformed layer do you want to bake (1 - " + tmapp.layers.length + ") ?\n" + layers,"1"))-1;
+    var tileSource = tmapp.layers[selectedLayer].tileSource;
+    if (tileSource.indexOf("/affine/") == -1) {
+        interfaceUtils.alert("This layer is not transformed.");
+        return;
+    }
+    $("#loadingModal").show();
+    $.ajax(
+        {
+            type : 'post',
+            url : '/plugins/transform/bake',
+            contentType: 'application/json; charset=utf-8',
+            data : JSON.stringify({
+                    'path' : tileSource,
+                    'outputSuffix':"_transformed"
+            }),
+            success : function(data)
             {
-                // do something, not critical.
+                // The file is written by a background job on the server
+                transform.waitForJob(data.job, function(result) {
+                    $("#loadingModal").hide();
+                    transform.loadState(result, "Baked layer");
+                });
             },
             error:function (data)
             {
+                $("#loadingModal").hide();
+                console.log("Error:", data);
+            }
+        }
+    );
+}
+
+/**
+ * Poll a background job of the plugin, and call done with its result */
+transform.waitForJob = function (jobId, done) {
+    $.ajax(
+        {
+            type : 'get',
+            url : '/plugins/transform/jobs/' + jobId,
+            success : function(status)
+            {
+                if (status.state == "done") {
+                    done(status.result);
+                }
+                else if (status.state == "running") {
+                    console.log("Baking:", Math.round(status.progress * 100) + "%");
+                    setTimeout(function() {transform.waitForJob(jobId, done);}, 1000);
+                }
+                else {
+                    $("#loadingModal").hide();
+                    interfaceUtils.alert("Impossible to bake this layer: " + status.message);
+                }
+            },
+            error:function (data)
+            {
+                $("#loadingModal").hide();
                 console.log("Error:", data);
             }
         }
@@ -142,46 +236,20 @@ transform.resizeImage = function () {
     console.log("Transform Image");
     var op = transform.tmapp["object_prefix"];
     var vname = op + "_viewer";
-    console.log(tmapp.fixed_file);
     factorString =prompt("Please write your scaling factor:","8");
     factor = parseFloat(factorString);
-    $("#loadingModal").show();
-    $.ajax(
-        {
-            // Post select to url.
-            type : 'post',
-            url : '/plugin/transform/transform',
-            contentType: 'application/json; charset=utf-8',
-            data : JSON.stringify({
-                    'path' : tmapp.fixed_file,
-                    'outputSuffix':"_resized",
-                    'matrix': [1./factor, 0, 0, 1./factor, 0, 0],
-            }),
-            success : function(data)
-            {
-                $("#loadingModal").hide();
-                transform.loadState(data);
-            },
-            complete : function(data)
-            {
-                // do something, not critical.
-            },
-            error:function (data)
-            {
-                console.log("Error:", data);
-            }
-        }
-    );
+    transform.addVirtualLayer(tmapp.layers[0].tileSource, [1./factor, 0, 0, 1./factor, 0, 0], "Resized layer");
 }
 
 /**
  * This method is used to load the TissUUmaps state (gene expression, cell morphology, regions) */
-transform.loadState = function(state) {
+transform.loadState = function(state, layerName) {
+    if (layerName === undefined) layerName = "Transformed layer";
     tmapp.layers.push({
-        name: "Transformed layer",
+        name: layerName,
         tileSource: state["image"] + ".dzi"
     });
     i = tmapp.layers.length - 1;
-    overlayUtils.addLayer("Transformed layer", state["image"] + ".dzi", i);
+    overlayUtils.addLayer(layerName, state["image"] + ".dzi", i);
     overlayUtils.addAllLayersSettings();
 }
@@ -1,10 +1,13 @@
 from flask import Flask, abort, make_response, render_template
 from openslide import OpenSlideError
 import os, glob
+import logging
 from io import BytesIO
 from PIL import Image
 import pyvips
 
+from tissuumaps import affinetiles
+
 #from mpl_toolkits.axes_grid1 import make_axes_locatable
 #import importlib
 #importlib.import_module('mpl_toolkits.axes_grid1').make_axes_locatable
@@ -32,42 +35,36 @@ class ImageConverter():
                 )
                 vips_image.tiffsave(self.outputImage, pyramid=True, tile=True, tile_width=256, tile_height=256, properties=True, bitdepth=8)
             except: 
-                print ("Impossible to convert image using VIPS:")
+                logging.error ("Impossible to convert image using VIPS:")
                 import traceback
-                print (traceback.format_exc())
+                logging.error (traceback.format_exc())
             self.convertDone = True
             return self.outputImage
 
-    def transform (self, T):
-        #if not os.path.isfile(self.outputImage):
-            try:
-                imgVips = pyvips.Image.new_from_file(self.inputImage)
-                computedWidth, computedHeight = 0, 0
-                for (x, y) in [(0,0),(imgVips.width,0),(imgVips.width,imgVips.height),(0,imgVips.height)]:
-                    print (x,y, int(x*T[0]+y*T[1]+T[4]), int(x*T[2]+y*T[3]+T[5]), int(x*T[0]+y*T[1]), int(x*T[2]+y*T[3]))
-                    computedWidth = max(computedWidth, int(x*T[0]+y*T[1]+T[4]))
-                    computedHeight = max(computedHeight, int(x*T[2]+y*T[3]+T[5]))
-
-                print ("computedWidth, computedHeight, imgVips.width, imgVips.height, matrix:", computedWidth, computedHeight, imgVips.width, imgVips.height, T)
-                vips_image = imgVips.affine((T[0],T[1],T[2],T[3]),
-                                      odx = T[4],
-                                      ody = T[5], 
-                                      extend="black",
-                                      oarea=[0, 0, computedWidth, computedHeight]
-                                     )
-                #vips_image = vips_image.affine((1,0,0,1),
-                #                      odx = T[4],
-                #                      ody = T[5], 
-                #                      extend="black",
-                #                      oarea=[0, 0, int(vips_image.width+T[4]), int(vips_image.height+T[5])]
-                #                     )
-                vips_image.tiffsave(self.outputImage, pyramid=True, tile=True, tile_width=256, tile_height=256, properties=True, bitdepth=8)
-            except: 
-                print ("Impossible to convert image using VIPS:")
-                import traceback
-                print (traceback.format_exc())
-            self.convertDone = True
-            return self.outputImage
+    def transform (self, T, progress=None):
+        """Write the image transformed by ``T``; ``progress(fraction)`` follows the write."""
+        imgVips = pyvips.Image.new_from_file(self.inputImage)
+        computedWidth, computedHeight = affinetiles.output_size(imgVips.width, imgVips.height, T)
+        logging.debug ("computedWidth, computedHeight, imgVips.width, imgVips.height, matrix: %s %s %s %s %s" % (computedWidth, computedHeight, imgVips.width, imgVips.height, T))
+        vips_image = imgVips.affine((T[0],T[1],T[2],T[3]),
+                              odx = T[4],
+                              ody = T[5], 
+                              extend="black",
+                              oarea=[0, 0, computedWidth, computedHeight]
+                             )
+        if progress is not None:
+            vips_image.set_progress(True)
+            vips_image.signal_connect("eval", lambda image, p: progress(p.percent / 100.))
+        # Written aside and moved, so that no one reads a partial pyramid
+        partImage = self.outputImage + ".part"
+        try:
+            vips_image.tiffsave(partImage, pyramid=True, tile=True, tile_width=256, tile_height=256, properties=True, bitdepth=8)
+            os.replace(partImage, self.outputImage)
+        finally:
+            if os.path.isfile(partImage):
+                os.remove(partImage)
+        self.convertDone = True
+        return self.outputImage
 
 class Plugin ():
     def __init__(self, app):
@@ -75,45 +72,69 @@ class Plugin ():
 
     def _get_slide(self, path):
         path = os.path.abspath(os.path.join(self.app.basedir, path))
-        print (path)
+        logging.debug (path)
         if not path.startswith(self.app.basedir):
             # Directory traversal
-            print ("Directory traversal, aborting.")
+            logging.error ("Directory traversal, aborting.")
             abort(500)
         if not os.path.exists(path):
-            print ("not os.path.exists, aborting.")
+            logging.error ("not os.path.exists, aborting.")
             abort(500)
         try:
             slide = self.app.cache.get(path)
             return slide
         except OpenSlideError:
-            print ("OpenSlideError, aborting.")
+            logging.error ("OpenSlideError, aborting.")
             abort(500)
     
-    def transform (self, jsonParam):
+    def bake (self, jsonParam):
+        """Start writing a transformed image to a new pyramidal TIFF.
+
+        Transformed layers are virtual (``<layer>/affine/<matrix>.dzi``);
+        baking is only needed to share or export them as files. The file is
+        written by a background job: returns ``{"job", "image"}``, and the
+        job status at ``/plugins/transform/jobs/<job>`` has ``{"image"}`` as
+        result once done.
+        """
         if (not jsonParam):
-            print ("No arguments, aborting.")
-            abort(500)
-        print (jsonParam, self.app.basedir)
+            logging.error ("No arguments, aborting.")
+            abort(400)
         tifFile = jsonParam["path"].replace(".dzi","")
-        transMatrix = jsonParam["matrix"]
-        outputSuffix = jsonParam["outputSuffix"]
+        transMatrix = jsonParam.get("matrix")
+        outputSuffix = jsonParam.get("outputSuffix", "_transformed")
+        layer = affinetiles.split_layer_path(tifFile)
+        if layer is not None:
+            tifFile, transMatrix = layer
+        if transMatrix is None:
+            abort(400)
+        try:
+            transMatrix = affinetiles.parse_matrix(transMatrix)
+        except (TypeError, ValueError):
+            abort(400)
         if tifFile[0] == "/" or tifFile[0] == "\\":
             tifFile = tifFile[1:]
         tifFile = os.path.abspath(os.path.join(self.app.basedir, tifFile))
-        print ("impossible to read", tifFile,". Trying to convert using VIPS.")
-        newpath = os.path.splitext(tifFile)[0] + outputSuffix + ".tif"
-        newTifFile = ImageConverter(tifFile,newpath).transform(transMatrix)
-        image = self._get_slide(newTifFile)
-        
         absoluteRoot = os.path.abspath(self.app.basedir)
-        filePath = newTifFile.replace(absoluteRoot,"")
+        if not tifFile.startswith(absoluteRoot):
+            # Directory traversal
+            abort(404)
+        if not os.path.isfile(tifFile):
+            abort(404)
+        newpath = os.path.splitext(tifFile)[0] + outputSuffix + ".tif"
+        if not os.path.abspath(newpath).startswith(absoluteRoot):
+            abort(400)
+        filePath = newpath.replace(absoluteRoot,"")
         filePath = filePath.replace("\\","/")
         if (filePath[0] != "/"):
             filePath = "/" + filePath
-        
-        jsonFile = {
-            "image": filePath
-        }
-        return jsonFile
-    
\ No newline at end of file
+
+        def bakeJob(job):
+            logging.info ("Baking %s to %s" % (tifFile, newpath))
+            ImageConverter(tifFile,newpath).transform(transMatrix, job.set_progress)
+            return {"image": filePath}
+
+        job = self.host.submit(bakeJob)
+        return {"job": job.id, "image": filePath}
+
+    # Former name of bake
+    transform = bake
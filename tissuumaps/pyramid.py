@@ -0,0 +1,152 @@
+#
+# Lazily read DeepZoom pyramids for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+import math
+from threading import Lock
+
+import numpy as np
+from PIL import Image
+
+DZI_TEMPLATE = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+    'Format="%s" Overlap="%d" TileSize="%d"><Size Height="%d" Width="%d"/></Image>'
+)
+# Formats of pyvips images as NumPy types
+VIPS_FORMATS = {
+    "uchar": np.uint8,
+    "char": np.int8,
+    "ushort": np.uint16,
+    "short": np.int16,
+    "uint": np.uint32,
+    "int": np.int32,
+    "float": np.float32,
+    "double": np.float64,
+}
+# Percentiles of the default display window
+WINDOW_PERCENTILES = (0.5, 99.5)
+# Largest side of the level used to compute the display window
+WINDOW_LEVEL_SIZE = 2048
+
+
+def deepzoom_bounds(width, height, tileSize, overlap, level, col, row):
+    """Return ``((x, width), (y, height))`` of a DeepZoom tile in its level.
+
+    Levels, tile size and overlap follow ``DeepZoomGenerator``: the top
+    level is the full image and every level below halves it, rounding
+    up. Raises ``ValueError`` for invalid addresses.
+    """
+    levelCount = int(math.ceil(math.log2(max(width, height, 1)))) + 1
+    if not (0 <= level < levelCount):
+        raise ValueError("Invalid level")
+    shrink = levelCount - 1 - level
+    bounds = []
+    for index, size in ((col, width), (row, height)):
+        size = int(math.ceil(size / 2**shrink))
+        count = int(math.ceil(size / tileSize))
+        if not (0 <= index < count):
+            raise ValueError("Invalid address")
+        start = index * tileSize - (overlap if index > 0 else 0)
+        end = min(size, (index + 1) * tileSize + (overlap if index < count - 1 else 0))
+        bounds.append((start, end - start))
+    return bounds
+
+
+def percentile_window(values):
+    """Display window of an array: its 0.5-99.5 percentiles, never empty."""
+    low, high = np.percentile(np.asarray(values, dtype=np.float64), WINDOW_PERCENTILES)
+    if low == high:
+        return 0.0, max(float(high), 1.0)
+    return float(low), float(high)
+
+
+class PyramidSlide(object):
+    """DeepZoom tiles of a multi-resolution image, read lazily.
+
+    Implements what the views use of ``DeepZoomGenerator``. Subclasses
+    set ``levelSizes``, the ``(width, height)`` of every stored level,
+    largest first, and implement ``read_region``. Tiles are read from the
+    smallest stored level with at least their resolution and scaled to 8
+    bits with ``window`` unless the image is already 8-bit.
+    """
+
+    def __init__(self, levelSizes, tileSize, overlap, window=None):
+        self.levelSizes = levelSizes
+        self.width, self.height = levelSizes[0]
+        self.tileSize = tileSize
+        self.overlap = overlap
+        self.window = window
+        self.downsamples = [self.width / width for width, _ in levelSizes]
+        self.level_count = int(math.ceil(math.log2(max(self.width, self.height, 1)))) + 1
+        self.level_dimensions = tuple(
+            (
+                int(math.ceil(self.width / 2 ** (self.level_count - 1 - level))),
+                int(math.ceil(self.height / 2 ** (self.level_count - 1 - level))),
+            )
+            for level in range(self.level_count)
+        )
+        self.level_tiles = tuple(
+            (int(math.ceil(w / tileSize)), int(math.ceil(h / tileSize)))
+            for w, h in self.level_dimensions
+        )
+        self.tile_count = sum(c * r for c, r in self.level_tiles)
+        self.properties = {}
+        self.associated_images = {}
+        self.mpp = 0
+        self.tileLock = Lock()
+
+    def read_region(self, index, x, y, width, height):
+        """Return a region of stored level ``index`` as a ``pyvips.Image``.
+
+        Hook of :meth:`get_tile`, for subclasses to implement unless they
+        override :meth:`get_tile` itself.
+        """
+        raise NotImplementedError
+
+    def get_dzi(self, format):
+        return DZI_TEMPLATE % (format, self.overlap, self.tileSize, self.height, self.width)
+
+    def get_tile_dimensions(self, level, address):
+        (_, width), (_, height) = deepzoom_bounds(
+            self.width, self.height, self.tileSize, self.overlap, level, *address
+        )
+        return width, height
+
+    def get_tile_coordinates(self, level, address):
+        """Return ``((x, y), 0, (width, height))`` of a tile in full resolution pixels."""
+        (x, width), (y, height) = deepzoom_bounds(
+            self.width, self.height, self.tileSize, self.overlap, level, *address
+        )
+        scale = 2 ** (self.level_count - 1 - level)
+        return (x * scale, y * scale), 0, (width * scale, height * scale)
+
+    def get_tile(self, level, address):
+        (x, width), (y, height) = deepzoom_bounds(
+            self.width, self.height, self.tileSize, self.overlap, level, *address
+        )
+        scale = 2 ** (self.level_count - 1 - level)
+        # Closest stored level with at least the resolution of the tile
+        index = max(i for i, d in enumerate(self.downsamples) if d <= scale * 1.01)
+        levelWidth, levelHeight = self.levelSizes[index]
+        factor = scale / self.downsamples[index]
+        x0, y0 = int(math.floor(x * factor)), int(math.floor(y * factor))
+        x1 = min(levelWidth, int(math.ceil((x + width) * factor)))
+        y1 = min(levelHeight, int(math.ceil((y + height) * factor)))
+        region = self.read_region(index, x0, y0, max(x1 - x0, 1), max(y1 - y0, 1))
+        if region.width != width or region.height != height:
+            region = region.resize(width / region.width, vscale=height / region.height)
+            region = region.embed(0, 0, width, height, extend="copy")
+        if self.window is not None:
+            low, high = self.window
+            region = (region - low) * (255.0 / (high - low))
+        region = region.cast("uchar")
+        tile = np.frombuffer(region.write_to_memory(), dtype=np.uint8).reshape(
+            height, width, region.bands
+        )
+        if region.bands >= 3:
+            return Image.fromarray(np.ascontiguousarray(tile[:, :, :3]), "RGB")
+        return Image.fromarray(np.ascontiguousarray(tile[:, :, 0]), "L").convert("RGB")
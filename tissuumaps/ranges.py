@@ -0,0 +1,222 @@
+#
+# HTTP byte-range support for the TissUUmaps data file routes
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+import mimetypes
+import os
+import uuid
+
+from flask import Response, request
+from werkzeug.http import http_date, parse_date
+
+CHUNK_SIZE = 256 * 1024
+# Above this many ranges in one request, overlapping or adjacent ranges are
+# coalesced so a client cannot make us emit the same bytes over and over.
+MAX_RANGES = 64
+
+PRECOMPRESSED_SUFFIXES = [".gz", ".cgz"]
+
+
+def _parse_range(header, size):
+    """Parse a ``Range`` header against a representation of ``size`` bytes.
+
+    Returns ``None`` when the header is absent or malformed (the full body
+    must then be sent), otherwise the list of satisfiable ``(start, end)``
+    inclusive byte ranges, which is empty when nothing can be satisfied.
+    """
+    if not header:
+        return None
+    units, _, spec = header.partition("=")
+    if units.strip().lower() != "bytes" or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        start, sep, end = part.partition("-")
+        if not sep:
+            return None
+        start, end = start.strip(), end.strip()
+        try:
+            if start == "":
+                # Suffix range: the last N bytes
+                length = int(end)
+                if length < 0:
+                    return None
+                if length > 0 and size > 0:
+                    ranges.append((max(size - length, 0), size - 1))
+                continue
+            start = int(start)
+            end = int(end) if end else None
+        except ValueError:
+            return None
+        if start < 0 or (end is not None and start > end):
+            return None
+        if start < size:
+            ranges.append((start, size - 1 if end is None else min(end, size - 1)))
+    return ranges
+
+
+def _coalesce(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _accepts_gzip(req):
+    for coding in req.headers.get("Accept-Encoding", "").split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def _precompressed_variant(path):
+    """Return the freshest gzip variant of ``path`` or None if it is stale."""
+    for suffix in PRECOMPRESSED_SUFFIXES:
+        variant = path + suffix
+        if os.path.isfile(variant) and os.path.getmtime(variant) >= os.path.getmtime(path):
+            return variant
+    return None
+
+
+def _if_range_matches(req, etag, mtime):
+    condition = req.headers.get("If-Range")
+    if not condition:
+        return True
+    condition = condition.strip()
+    if condition.startswith('"') or condition.startswith("W/"):
+        # Weak validators never match for range requests
+        return condition == etag
+    date = parse_date(condition)
+    return date is not None and int(mtime) <= date.timestamp()
+
+
+def _read_ranges(path, ranges):
+    with open(path, "rb") as f:
+        for start, end in ranges:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    return
+                remaining -= len(data)
+                yield data
+
+
+def _read_multipart(path, parts, boundary):
+    with open(path, "rb") as f:
+        for header, (start, end) in parts:
+            yield header
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    return
+                remaining -= len(data)
+                yield data
+            yield b"\r\n"
+    yield b"--" + boundary + b"--\r\n"
+
+
+def send_file_range(path, mimetype=None, precompressed=True, max_age=None):
+    """Send ``path`` honouring single and multiple byte ranges.
+
+    Responds ``200`` with ``Accept-Ranges: bytes`` for plain requests,
+    ``206`` with a ``Content-Range`` (or a ``multipart/byteranges`` body)
+    for range requests, ``416`` when no requested range is satisfiable and
+    ``304`` when the client already holds the current version. When the
+    client accepts gzip and a fresh ``.gz``/``.cgz`` sibling exists, that
+    variant is sent instead and ranges address its compressed bytes.
+    """
+    if mimetype is None:
+        mimetype = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers = {"Accept-Ranges": "bytes"}
+    sentPath = path
+    if precompressed:
+        headers["Vary"] = "Accept-Encoding"
+        variant = _precompressed_variant(path)
+        if variant is not None and _accepts_gzip(request):
+            sentPath = variant
+            headers["Content-Encoding"] = "gzip"
+
+    stat = os.stat(sentPath)
+    size = stat.st_size
+    etag = '"%x-%x%s"' % (stat.st_mtime_ns, size, "-gz" if sentPath != path else "")
+    headers["ETag"] = etag
+    headers["Last-Modified"] = http_date(stat.st_mtime)
+    if max_age is not None:
+        headers["Cache-Control"] = "public, max-age=%d" % max_age
+
+    ifNoneMatch = request.headers.get("If-None-Match")
+    if ifNoneMatch is not None:
+        if ifNoneMatch.strip() == "*" or etag in [
+            e.strip().replace("W/", "") for e in ifNoneMatch.split(",")
+        ]:
+            return Response(status=304, headers=headers)
+    else:
+        since = parse_date(request.headers.get("If-Modified-Since"))
+        if since is not None and int(stat.st_mtime) <= since.timestamp():
+            return Response(status=304, headers=headers)
+
+    ranges = _parse_range(request.headers.get("Range"), size)
+    if ranges is not None and not _if_range_matches(request, etag, stat.st_mtime):
+        ranges = None
+
+    if ranges is None:
+        headers["Content-Length"] = str(size)
+        return Response(
+            _read_ranges(sentPath, [(0, size - 1)]) if size else b"",
+            status=200,
+            headers=headers,
+            mimetype=mimetype,
+            direct_passthrough=True,
+        )
+    if not ranges:
+        headers["Content-Range"] = "bytes */%d" % size
+        return Response(status=416, headers=headers)
+    if len(ranges) > MAX_RANGES:
+        ranges = _coalesce(ranges)
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+        headers["Content-Length"] = str(end - start + 1)
+        return Response(
+            _read_ranges(sentPath, ranges),
+            status=206,
+            headers=headers,
+            mimetype=mimetype,
+            direct_passthrough=True,
+        )
+
+    boundary = uuid.uuid4().hex.encode()
+    parts = []
+    length = 0
+    for start, end in ranges:
+        partHeader = (
+            b"--" + boundary + b"\r\n"
+            + b"Content-Type: " + mimetype.encode() + b"\r\n"
+            + b"Content-Range: " + ("bytes %d-%d/%d" % (start, end, size)).encode()
+            + b"\r\n\r\n"
+        )
+        parts.append((partHeader, (start, end)))
+        length += len(partHeader) + (end - start + 1) + 2
+    length += len(boundary) + 6
+    headers["Content-Length"] = str(length)
+    return Response(
+        _read_multipart(sentPath, parts, boundary),
+        status=206,
+        headers=headers,
+        content_type="multipart/byteranges; boundary=" + boundary.decode(),
+        direct_passthrough=True,
+    )
@@ -0,0 +1,214 @@
+#
+# Native bit depth image pyramids and raw tiles for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+from collections import OrderedDict
+import json
+import logging
+import math
+import os
+from threading import Lock
+import uuid
+
+import numpy as np
+import pyvips
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from tissuumaps.markers import _signature, cache_path
+from tissuumaps.pyramid import VIPS_FORMATS, WINDOW_PERCENTILES, deepzoom_bounds
+
+PYRAMID_VERSION = 1
+RAW_FORMATS = ["png", "zst"]
+ZSTD_LEVEL = 3
+
+
+def _to_array(image):
+    data = np.frombuffer(image.write_to_memory(), dtype=VIPS_FORMATS[image.format])
+    return data.reshape(image.height, image.width, image.bands)
+
+
+def build_pyramid(path, outputPath):
+    """Write a tiled pyramid TIFF of ``path`` keeping its pixel format.
+
+    Levels are mean-reduced; returns the image description stored next to it.
+    """
+    image = pyvips.Image.new_from_file(path)
+    if image.format not in VIPS_FORMATS:
+        image = image.cast("float")
+    tmpPath = outputPath + ".tmp-" + uuid.uuid4().hex[:8] + ".tif"
+    try:
+        image.tiffsave(
+            tmpPath,
+            pyramid=True,
+            tile=True,
+            tile_width=256,
+            tile_height=256,
+            compression="deflate",
+            predictor="float" if image.format in ("float", "double") else "horizontal",
+            bigtiff=True,
+            region_shrink="mean",
+        )
+        os.replace(tmpPath, outputPath)
+    except:
+        if os.path.isfile(tmpPath):
+            os.remove(tmpPath)
+        raise
+    pages = pyvips.Image.new_from_file(outputPath).get("n-pages")
+    smallest = _to_array(pyvips.Image.new_from_file(outputPath, page=pages - 1))
+    values = smallest.reshape(-1, image.bands).astype(np.float64)
+    return {
+        "version": PYRAMID_VERSION,
+        "width": image.width,
+        "height": image.height,
+        "bands": image.bands,
+        "dtype": np.dtype(VIPS_FORMATS[image.format]).name,
+        "pages": pages,
+        "min": values.min(axis=0).tolist(),
+        "max": values.max(axis=0).tolist(),
+        "window": np.percentile(values, WINDOW_PERCENTILES, axis=0).T.tolist(),
+    }
+
+
+def get_pyramid(path):
+    """Return ``(pyramidPath, description)``, building the pyramid if needed.
+
+    The pyramid is kept in the ``.tissuumaps`` folder of the image until
+    the image changes.
+    """
+    outputPath = cache_path(path, ".raw.tif")
+    source = _signature(path)
+    try:
+        with open(outputPath + ".json") as f:
+            meta = json.load(f)
+        if (
+            meta.get("source") == source
+            and meta.get("version") == PYRAMID_VERSION
+            and os.path.isfile(outputPath)
+        ):
+            return outputPath, meta
+    except (OSError, ValueError):
+        pass
+    logging.info("Building native bit depth pyramid of %s" % path)
+    os.makedirs(os.path.dirname(outputPath), exist_ok=True)
+    meta = build_pyramid(path, outputPath)
+    meta["source"] = source
+    with open(outputPath + ".json", "w") as f:
+        json.dump(meta, f)
+    return outputPath, meta
+
+
+class RawPyramid(object):
+    """Native bit depth tiles of an image, on the DeepZoom grid of its slide."""
+
+    def __init__(self, path, tileSize, overlap):
+        self.path = path
+        self.signature = _signature(path)
+        self.tileSize = tileSize
+        self.overlap = overlap
+        self.pyramidPath, self.meta = get_pyramid(path)
+        self.pages = [
+            pyvips.Image.new_from_file(self.pyramidPath, page=page, access="random")
+            for page in range(self.meta["pages"])
+        ]
+        self.width, self.height = self.meta["width"], self.meta["height"]
+        self.levelCount = int(math.ceil(math.log2(max(self.width, self.height, 1)))) + 1
+
+    def is_current(self):
+        try:
+            return _signature(self.path) == self.signature
+        except OSError:
+            return False
+
+    def info(self):
+        return {
+            "width": self.width,
+            "height": self.height,
+            "tileSize": self.tileSize,
+            "overlap": self.overlap,
+            "levels": self.levelCount,
+            "bands": self.meta["bands"],
+            "dtype": self.meta["dtype"],
+            "min": self.meta["min"],
+            "max": self.meta["max"],
+            "window": self.meta["window"],
+            "formats": [f for f in RAW_FORMATS if f != "zst" or zstandard is not None],
+        }
+
+    def tile_bounds(self, level, col, row):
+        return deepzoom_bounds(
+            self.width, self.height, self.tileSize, self.overlap, level, col, row
+        )
+
+    def read_tile(self, level, col, row):
+        """Return one tile as a ``(height, width, bands)`` array of the native type."""
+        (x, width), (y, height) = self.tile_bounds(level, col, row)
+        shrink = self.levelCount - 1 - level
+        page = min(shrink, len(self.pages) - 1)
+        image = self.pages[page]
+        if shrink > page:
+            factor = 2 ** (shrink - page)
+            image = image.shrink(factor, factor, ceil=True)
+        if x + width > image.width or y + height > image.height:
+            # Pyramid pages round their size down, DeepZoom levels up
+            image = image.embed(
+                0, 0, max(image.width, x + width), max(image.height, y + height),
+                extend="copy",
+            )
+        tile = image.crop(x, y, width, height)
+        return _to_array(tile.cast(self.pages[0].format))
+
+
+def encode_tile(tile, format):
+    """Encode a raw tile as a 8/16-bit PNG or as zstd-compressed little-endian values."""
+    if format == "png":
+        if tile.dtype not in (np.uint8, np.uint16):
+            raise ValueError("PNG tiles need 8 or 16-bit images")
+        height, width, bands = tile.shape
+        if tile.dtype == np.uint8:
+            format, interpretation = "uchar", "b-w" if bands < 3 else "srgb"
+        else:
+            format, interpretation = "ushort", "grey16" if bands < 3 else "rgb16"
+        image = pyvips.Image.new_from_memory(
+            np.ascontiguousarray(tile).tobytes(), width, height, bands, format
+        ).copy(interpretation=interpretation)
+        return image.pngsave_buffer(compression=1)
+    if format == "zst":
+        if zstandard is None:
+            raise ImportError("zstandard is required for zstd raw tiles")
+        data = np.ascontiguousarray(tile, dtype=tile.dtype.newbyteorder("<")).tobytes()
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    raise ValueError("Unknown raw tile format: %s" % format)
+
+
+class RawPyramidCache(object):
+    """LRU cache of :class:`RawPyramid`, refreshed when images change."""
+
+    def __init__(self, cache_size, tileSize, overlap):
+        self.cache_size = cache_size
+        self.tileSize = tileSize
+        self.overlap = overlap
+        self._lock = Lock()
+        self._buildLock = Lock()
+        self._cache = OrderedDict()
+
+    def get(self, path):
+        with self._lock:
+            pyramid = self._cache.pop(path, None)
+            if pyramid is not None and pyramid.is_current():
+                # Move to end of LRU
+                self._cache[path] = pyramid
+                return pyramid
+        with self._buildLock:
+            pyramid = RawPyramid(path, self.tileSize, self.overlap)
+        with self._lock:
+            while len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+            self._cache[path] = pyramid
+        return pyramid
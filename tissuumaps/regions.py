@@ -0,0 +1,187 @@
+#
+# Region (GeoJSON polygon) analysis for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+import io
+
+import numpy as np
+import pandas as pd
+
+# Size of the (points x edges) blocks used by the winding number test
+POINT_BLOCK = 16384
+EDGE_BLOCK = 256
+
+
+class Region(object):
+    """One region: a name, a class and the rings of its (multi)polygon."""
+
+    def __init__(self, name, regionClass, rings, properties=None):
+        self.name = name
+        self.regionClass = regionClass
+        self.properties = properties or {}
+        self.rings = [np.asarray(r, dtype=np.float64)[:, :2] for r in rings if len(r) > 2]
+        if self.rings:
+            allPoints = np.concatenate(self.rings)
+            self.bbox = (
+                float(allPoints[:, 0].min()),
+                float(allPoints[:, 1].min()),
+                float(allPoints[:, 0].max()),
+                float(allPoints[:, 1].max()),
+            )
+        else:
+            self.bbox = None
+        self._edges = None
+
+    def edges(self):
+        """Return the ``(x1, y1, x2, y2)`` arrays of all ring edges."""
+        if self._edges is None:
+            starts = []
+            ends = []
+            for ring in self.rings:
+                starts.append(ring)
+                ends.append(np.roll(ring, -1, axis=0))
+            starts = np.concatenate(starts)
+            ends = np.concatenate(ends)
+            self._edges = (starts[:, 0], starts[:, 1], ends[:, 0], ends[:, 1])
+        return self._edges
+
+    def contains(self, x, y):
+        """Vectorized point-in-region test with the non-zero winding rule.
+
+        All rings are wound together, as the browser fills the region path,
+        so holes follow from the ring orientation.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        inside = np.zeros(len(x), dtype=bool)
+        if self.bbox is None or len(x) == 0:
+            return inside
+        ex1, ey1, ex2, ey2 = self.edges()
+        for p in range(0, len(x), POINT_BLOCK):
+            px = x[p : p + POINT_BLOCK, None]
+            py = y[p : p + POINT_BLOCK, None]
+            winding = np.zeros(len(px), dtype=np.int64)
+            for e in range(0, len(ex1), EDGE_BLOCK):
+                x1 = ex1[e : e + EDGE_BLOCK]
+                y1 = ey1[e : e + EDGE_BLOCK]
+                x2 = ex2[e : e + EDGE_BLOCK]
+                y2 = ey2[e : e + EDGE_BLOCK]
+                # > 0 when the point is left of the edge
+                side = (x2 - x1) * (py - y1) - (px - x1) * (y2 - y1)
+                upward = (y1 <= py) & (y2 > py) & (side > 0)
+                downward = (y1 > py) & (y2 <= py) & (side < 0)
+                winding += upward.sum(axis=1) - downward.sum(axis=1)
+            inside[p : p + POINT_BLOCK] = winding != 0
+        return inside
+
+
+def _geometry_rings(geometry):
+    if not geometry:
+        return []
+    geometryType = geometry.get("type")
+    if geometryType == "Polygon":
+        return list(geometry["coordinates"])
+    if geometryType == "MultiPolygon":
+        return [ring for polygon in geometry["coordinates"] for ring in polygon]
+    if geometryType == "GeometryCollection":
+        return [r for g in geometry.get("geometries", []) for r in _geometry_rings(g)]
+    return []
+
+
+def load_regions(geoJSON):
+    """Return the list of :class:`Region` described by a GeoJSON object.
+
+    Accepts what ``regionUtils.regions2GeoJSON`` writes (a FeatureCollection
+    of MultiPolygons with ``name`` and ``classification`` properties) as
+    well as bare features, geometries and lists of them.
+    """
+    regions = []
+
+    def visit(obj):
+        if isinstance(obj, list):
+            for item in obj:
+                visit(item)
+            return
+        if not isinstance(obj, dict):
+            return
+        if obj.get("type") == "FeatureCollection":
+            visit(obj.get("features", []))
+            return
+        geometry = obj.get("geometry", obj) if obj.get("type") == "Feature" else obj
+        properties = obj.get("properties") or {}
+        name = properties.get("name") or "Region_%d" % (len(regions) + 1)
+        classification = properties.get("classification") or {}
+        regionClass = classification.get("name", "") if isinstance(classification, dict) else ""
+        if not regionClass:
+            regionClass = properties.get("object_type", "") or ""
+        regions.append(Region(name, regionClass, _geometry_rings(geometry), properties))
+
+    visit(geoJSON)
+    return regions
+
+
+def points_in_region(markerFile, region, x, y):
+    """Return the sorted row indices of ``markerFile`` inside ``region``."""
+    if region.bbox is None:
+        return np.zeros(0, dtype=np.int64)
+    index = markerFile.spatial_index(x, y)
+    candidates = index.query_bbox(*region.bbox)
+    inside = region.contains(index.x[candidates], index.y[candidates])
+    return candidates[inside]
+
+
+def region_counts(markerFile, regions, x, y, key):
+    """Count the markers of every key inside every region.
+
+    Returns ``(keys, results)`` where each result holds the region name,
+    class, total count and a ``{key: count}`` dictionary of non-zero counts.
+    """
+    if key:
+        keys, codes = markerFile.key_codes(key)
+    else:
+        keys, codes = ["All"], None
+    results = []
+    for region in regions:
+        rows = points_in_region(markerFile, region, x, y)
+        if codes is None:
+            counts = np.array([len(rows)])
+        else:
+            counts = np.bincount(codes[rows], minlength=len(keys))
+        results.append(
+            {
+                "name": region.name,
+                "class": region.regionClass,
+                "total": int(len(rows)),
+                "counts": dict(
+                    (keys[i], int(counts[i])) for i in np.flatnonzero(counts)
+                ),
+            }
+        )
+    return keys, results
+
+
+def points_in_regions_csv(markerFile, regions, x, y, columns=None):
+    """Yield, as CSV, every marker inside each region with its region name and class.
+
+    This is the server-side equivalent of ``regionUtils.pointsInRegionsToCSV``.
+    """
+    table = markerFile.table
+    if columns is None:
+        columns = table.columns
+    buf = io.StringIO()
+    pd.DataFrame(columns=list(columns) + ["regionName", "regionClass"]).to_csv(
+        buf, index=False
+    )
+    yield buf.getvalue()
+    for region in regions:
+        rows = points_in_region(markerFile, region, x, y)
+        for start in range(0, len(rows), POINT_BLOCK * 4):
+            frame = table.frame(columns, rows[start : start + POINT_BLOCK * 4])
+            frame["regionName"] = region.name
+            frame["regionClass"] = region.regionClass
+            buf = io.StringIO()
+            frame.to_csv(buf, index=False, header=False)
+            yield buf.getvalue()
@@ -0,0 +1,229 @@
+#
+# Zoom-dependent vector tiles of region files for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+from collections import OrderedDict
+import json
+import logging
+import math
+import os
+import shutil
+from threading import Lock
+import uuid
+
+import numpy as np
+
+from tissuumaps.labelregions import simplify_ring
+from tissuumaps.markers import _signature, cache_path
+from tissuumaps.regions import load_regions
+from tissuumaps.spatial import STRTree
+
+TILE_SIZE = 256
+# Tile coordinates are stored in 1/QUANTIZATION level pixels
+QUANTIZATION = 16
+# Margin of the clipping box around a tile, in level pixels
+CLIP_BUFFER = 4
+# Simplification tolerance, in level pixels
+TOLERANCE = 0.5
+
+
+def _clip_ring(ring, x0, y0, x1, y1):
+    """Sutherland-Hodgman clipping of a closed ring by a rectangle."""
+    points = ring[:-1]
+    for axis, bound, lower in ((0, x0, True), (0, x1, False), (1, y0, True), (1, y1, False)):
+        inside = points[:, axis] >= bound if lower else points[:, axis] <= bound
+        if inside.all():
+            continue
+        if not inside.any():
+            return None
+        previous = np.roll(points, 1, axis=0)
+        crossing = inside != np.roll(inside, 1)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            t = (bound - previous[:, axis]) / (points[:, axis] - previous[:, axis])
+            intersections = previous + t[:, None] * (points - previous)
+        # For every edge: its intersection with the bound, then its end if inside
+        points = np.stack([intersections, points], axis=1)[
+            np.stack([crossing, inside], axis=1)
+        ]
+    return np.concatenate([points, points[:1]])
+
+
+def encode_tile(features):
+    """Encode ``[(featureIndex, [rings])]`` with int16 ring coordinates.
+
+    Little-endian layout: ``uint32`` feature, ring and point counts; the
+    ``uint32`` feature indices; the ``uint32`` offsets of the first ring of
+    every feature (plus the total); the ``uint32`` offsets of the first
+    point of every ring (plus the total); then the ``int16`` x, y pairs.
+    """
+    ids = [index for index, _ in features]
+    rings = [ring for _, featureRings in features for ring in featureRings]
+    ringOffsets = np.cumsum([0] + [len(r) for _, r in features])
+    pointOffsets = np.cumsum([0] + [len(r) for r in rings])
+    coordinates = np.concatenate(rings) if rings else np.zeros((0, 2))
+    return b"".join(
+        [
+            np.array([len(ids), len(rings), len(coordinates)], dtype="<u4").tobytes(),
+            np.array(ids, dtype="<u4").tobytes(),
+            ringOffsets.astype("<u4").tobytes(),
+            pointOffsets.astype("<u4").tobytes(),
+            coordinates.astype("<i2").tobytes(),
+        ]
+    )
+
+
+class RegionTiles(object):
+    """Pyramid of vector tiles over the regions of a GeoJSON file.
+
+    Levels follow the Deep Zoom convention over the region bounds: the top
+    level is in image pixels and every level below halves the resolution.
+    Tiles hold the regions crossing them, simplified to the level
+    resolution and clipped to the tile; they are cached in
+    ``.tissuumaps/<name>.vtiles/`` until the GeoJSON file changes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.signature = _signature(path)
+        with open(path) as f:
+            self.regions = load_regions(json.load(f))
+        boxes = [r.bbox for r in self.regions if r.bbox is not None]
+        self.width = int(math.ceil(max([b[2] for b in boxes] + [1])))
+        self.height = int(math.ceil(max([b[3] for b in boxes] + [1])))
+        self.maxLevel = int(math.ceil(math.log2(max(self.width, self.height, 1))))
+        self.tree = STRTree(
+            [r.bbox if r.bbox is not None else (np.inf,) * 4 for r in self.regions]
+        )
+        self.tilePath = cache_path(path, ".vtiles")
+        self._prepare_cache()
+
+    def _prepare_cache(self):
+        metaPath = os.path.join(self.tilePath, "meta.json")
+        try:
+            with open(metaPath) as f:
+                if json.load(f).get("source") == self.signature:
+                    return
+        except (OSError, ValueError):
+            pass
+        if os.path.isdir(self.tilePath):
+            shutil.rmtree(self.tilePath, ignore_errors=True)
+        os.makedirs(self.tilePath, exist_ok=True)
+        with open(metaPath, "w") as f:
+            json.dump({"source": self.signature}, f)
+
+    def is_current(self):
+        try:
+            return _signature(self.path) == self.signature
+        except OSError:
+            return False
+
+    def info(self):
+        """Pyramid geometry and the properties of every feature, by feature index."""
+        return {
+            "width": self.width,
+            "height": self.height,
+            "tileSize": TILE_SIZE,
+            "maxLevel": self.maxLevel,
+            "quantization": QUANTIZATION,
+            "features": [
+                {
+                    "name": r.name,
+                    "class": r.regionClass,
+                    "color": r.properties.get("color"),
+                }
+                for r in self.regions
+            ],
+        }
+
+    def _build(self, level, col, row):
+        scale = 2.0 ** (self.maxLevel - level)
+        extent = TILE_SIZE * scale
+        x0, y0 = col * extent, row * extent
+        buffer = CLIP_BUFFER * scale
+        clip = (x0 - buffer, y0 - buffer, x0 + extent + buffer, y0 + extent + buffer)
+        features = []
+        for index in self.tree.query(*clip):
+            region = self.regions[index]
+            bx0, by0, bx1, by1 = region.bbox
+            if max(bx1 - bx0, by1 - by0) < scale:
+                # Smaller than a pixel at this level
+                continue
+            rings = []
+            for ring in region.rings:
+                if len(ring) and not np.array_equal(ring[0], ring[-1]):
+                    ring = np.concatenate([ring, ring[:1]])
+                ring = simplify_ring(ring, TOLERANCE * scale)
+                if ring is None:
+                    continue
+                ring = _clip_ring(ring, *clip)
+                if ring is None:
+                    continue
+                quantized = np.round(
+                    (ring - (x0, y0)) * (QUANTIZATION / scale)
+                ).astype(np.int64)
+                distinct = np.any(np.diff(quantized, axis=0) != 0, axis=1)
+                quantized = np.concatenate([quantized[:1], quantized[1:][distinct]])
+                if len(quantized) >= 4:
+                    rings.append(quantized)
+            if rings:
+                features.append((int(index), rings))
+        return encode_tile(features)
+
+    def get_tile(self, level, col, row):
+        """Return the encoded tile, from the disk cache when possible."""
+        if not (0 <= level <= self.maxLevel):
+            raise ValueError("Invalid level")
+        scale = 2 ** (self.maxLevel - level)
+        cols = int(math.ceil(self.width / (TILE_SIZE * scale)))
+        rows = int(math.ceil(self.height / (TILE_SIZE * scale)))
+        if not (0 <= col < cols and 0 <= row < rows):
+            raise ValueError("Invalid address")
+        tileFile = os.path.join(self.tilePath, str(level), "%d_%d.bin" % (col, row))
+        try:
+            with open(tileFile, "rb") as f:
+                return f.read()
+        except OSError:
+            pass
+        data = self._build(level, col, row)
+        os.makedirs(os.path.dirname(tileFile), exist_ok=True)
+        tmpFile = tileFile + ".tmp-" + uuid.uuid4().hex[:8]
+        with open(tmpFile, "wb") as f:
+            f.write(data)
+        os.replace(tmpFile, tileFile)
+        return data
+
+
+class RegionTilesCache(object):
+    """LRU cache of :class:`RegionTiles`, refreshed when files change."""
+
+    def __init__(self, cache_size):
+        self.cache_size = cache_size
+        self._lock = Lock()
+        self._pathLocks = {}
+        self._cache = OrderedDict()
+
+    def get(self, path):
+        with self._lock:
+            regionTiles = self._cache.pop(path, None)
+            if regionTiles is not None and regionTiles.is_current():
+                # Move to end of LRU
+                self._cache[path] = regionTiles
+                return regionTiles
+            pathLock = self._pathLocks.setdefault(path, Lock())
+        # Only one thread parses a file and prepares its tile directory
+        with pathLock:
+            with self._lock:
+                regionTiles = self._cache.get(path)
+                if regionTiles is not None and regionTiles.is_current():
+                    return regionTiles
+            logging.info("Loading regions of %s" % path)
+            regionTiles = RegionTiles(path)
+            with self._lock:
+                self._cache.pop(path, None)
+                while len(self._cache) >= self.cache_size:
+                    self._cache.popitem(last=False)
+                self._cache[path] = regionTiles
+        return regionTiles
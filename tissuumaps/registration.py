@@ -0,0 +1,274 @@
+#
+# Coarse-to-fine affine registration of image layers for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+import logging
+import math
+
+import numpy as np
+from scipy import ndimage
+
+from tissuumaps.affinetiles import AffineSlide, read_region
+
+# Largest side of the levels compared as a whole
+COARSE_SIZE = 512
+# Side of the windows matched at finer levels, and how many per side
+PATCH_SIZE = 256
+PATCH_GRID = 3
+# Patches whose normalized correlation peak is lower are ignored
+MIN_PEAK = 0.03
+
+
+def _grey(region):
+    return region.astype(np.float64).mean(axis=2)
+
+
+def _hann(shape):
+    return np.outer(np.hanning(shape[0]), np.hanning(shape[1]))
+
+
+def phase_correlation(fixed, moving):
+    """Translation ``(dy, dx)`` such that ``fixed(p) ~ moving(p - (dy, dx))``.
+
+    Images have the same shape; returns the shift, with sub-pixel
+    precision, and the height of the normalized correlation peak.
+    """
+    window = _hann(fixed.shape)
+    product = np.fft.fft2((fixed - fixed.mean()) * window) * np.conj(
+        np.fft.fft2((moving - moving.mean()) * window)
+    )
+    correlation = np.fft.ifft2(product / np.maximum(np.abs(product), 1e-12)).real
+    peak = np.unravel_index(np.argmax(correlation), correlation.shape)
+    shift = []
+    for axis, size in enumerate(correlation.shape):
+        # Parabolic interpolation around the peak
+        before, after = list(peak), list(peak)
+        before[axis] = (peak[axis] - 1) % size
+        after[axis] = (peak[axis] + 1) % size
+        c0, c1, c2 = correlation[tuple(before)], correlation[peak], correlation[tuple(after)]
+        denominator = c0 - 2 * c1 + c2
+        offset = 0.5 * (c0 - c2) / denominator if denominator < 0 else 0.0
+        value = peak[axis] + offset
+        shift.append(value - size if value > size / 2 else value)
+    return shift, float(correlation[peak])
+
+
+def _pad(image, size):
+    padded = np.zeros((size, size))
+    padded[: image.shape[0], : image.shape[1]] = image
+    return padded
+
+
+def _log_polar(image):
+    """High-passed Fourier magnitude of a square image, in log-polar coordinates."""
+    size = image.shape[0]
+    magnitude = np.abs(np.fft.fftshift(np.fft.fft2(image * _hann(image.shape))))
+    frequencies = np.fft.fftshift(np.fft.fftfreq(size))
+    fy, fx = np.meshgrid(frequencies, frequencies, indexing="ij")
+    # Emphasize the edges over the low frequencies
+    highPass = 1 - np.cos(np.pi * fx) * np.cos(np.pi * fy)
+    magnitude *= highPass
+    radius = size / 2
+    angles = np.linspace(0, np.pi, size, endpoint=False)
+    logBase = math.log(radius) / size
+    radii = np.exp(np.arange(size) * logBase)
+    y = radius + radii[None, :] * np.sin(angles)[:, None]
+    x = radius + radii[None, :] * np.cos(angles)[:, None]
+    return ndimage.map_coordinates(magnitude, [y, x], order=1), logBase
+
+
+def _similarity(scale, angle, center, target):
+    """Matrix ``[a, b, c, d, e, f]`` scaling and rotating ``center`` onto ``target``."""
+    a, b = scale * math.cos(angle), -scale * math.sin(angle)
+    c, d = scale * math.sin(angle), scale * math.cos(angle)
+    e = target[0] - (a * center[0] + b * center[1])
+    f = target[1] - (c * center[0] + d * center[1])
+    return [a, b, c, d, e, f]
+
+
+def _compose(outer, inner):
+    """Matrix of ``outer`` applied after ``inner``."""
+    A = np.array([outer[:2] + [outer[4]], outer[2:4] + [outer[5]], [0, 0, 1]])
+    B = np.array([inner[:2] + [inner[4]], inner[2:4] + [inner[5]], [0, 0, 1]])
+    C = A @ B
+    return [C[0, 0], C[0, 1], C[1, 0], C[1, 1], C[0, 2], C[1, 2]]
+
+
+def _warp(image, matrix, shape):
+    """Resample ``image`` through ``matrix`` into an array of ``shape``."""
+    linear = np.array([[matrix[0], matrix[1]], [matrix[2], matrix[3]]])
+    inverse = np.linalg.inv(linear)
+    offset = -inverse @ np.array([matrix[4], matrix[5]])
+    # ndimage works in (row, column) order
+    return ndimage.affine_transform(
+        image,
+        inverse[::-1, ::-1],
+        offset=offset[::-1],
+        output_shape=shape,
+        order=1,
+    )
+
+
+class Layer(object):
+    """A slide to register, with the reader of its RGB tiles."""
+
+    def __init__(self, slide, readTile, tileSize, overlap):
+        self.slide = slide
+        self.readTile = readTile
+        self.tileSize = tileSize
+        self.overlap = overlap
+
+    def shrink_for(self, size):
+        """Smallest shrink at which the whole layer fits in ``size`` pixels."""
+        width, height = self.slide.level_dimensions[-1]
+        shrink = max(0, int(math.ceil(math.log2(max(width, height) / size))))
+        return min(shrink, self.slide.level_count - 1)
+
+    def read(self, shrink, x0, y0, x1, y1):
+        level = self.slide.level_count - 1 - shrink
+        width, height = self.slide.level_dimensions[level]
+        region = np.zeros((y1 - y0, x1 - x0, 3), dtype=np.uint8)
+        cx0, cy0 = max(x0, 0), max(y0, 0)
+        cx1, cy1 = min(x1, width), min(y1, height)
+        if cx1 > cx0 and cy1 > cy0:
+            region[cy0 - y0 : cy1 - y0, cx0 - x0 : cx1 - x0] = read_region(
+                self.readTile, self.tileSize, self.overlap, level, cx0, cy0, cx1, cy1
+            )
+        return _grey(region)
+
+    def read_level(self, shrink):
+        width, height = self.slide.level_dimensions[self.slide.level_count - 1 - shrink]
+        return self.read(shrink, 0, 0, width, height)
+
+
+def coarse_matrix(fixed, moving):
+    """Similarity matrix mapping ``moving`` onto ``fixed``, from whole low levels.
+
+    Rotation and scale come from the phase correlation of log-polar
+    Fourier magnitudes (Fourier-Mellin), the translation from the phase
+    correlation of the rotated images. Returns the matrix, in full
+    resolution pixels, and the peak of the translation correlation.
+    """
+    fixedShrink = fixed.shrink_for(COARSE_SIZE)
+    movingShrink = moving.shrink_for(COARSE_SIZE)
+    fixedImage = fixed.read_level(fixedShrink)
+    movingImage = moving.read_level(movingShrink)
+    # Moving image in the pixel size of the fixed one
+    movingImage = ndimage.zoom(movingImage, 2 ** (movingShrink - fixedShrink), order=1)
+    size = 2 ** int(math.ceil(math.log2(max(fixedImage.shape + movingImage.shape))))
+    fixedPadded, movingPadded = _pad(fixedImage, size), _pad(movingImage, size)
+    fixedPolar, logBase = _log_polar(fixedPadded)
+    movingPolar, _ = _log_polar(movingPadded)
+    (angleShift, radiusShift), _ = phase_correlation(fixedPolar, movingPolar)
+    angle = angleShift * np.pi / size
+    scale = math.exp(-radiusShift * logBase)
+    center = [movingImage.shape[1] / 2, movingImage.shape[0] / 2]
+    target = [fixedImage.shape[1] / 2, fixedImage.shape[0] / 2]
+    best = None
+    # Magnitudes do not tell a rotation from the opposite one
+    for candidate in (angle, angle + np.pi):
+        matrix = _similarity(scale, candidate, center, target)
+        warped = _warp(movingPadded, matrix, (size, size))
+        (dy, dx), peak = phase_correlation(fixedPadded, warped)
+        if best is None or peak > best[1]:
+            matrix[4] += dx
+            matrix[5] += dy
+            best = (matrix, peak)
+    matrix, peak = best
+    # Level pixels to full resolution pixels
+    fixedScale = 2**fixedShrink
+    matrix = _compose(
+        [fixedScale, 0, 0, fixedScale, 0, 0],
+        _compose(matrix, [1 / fixedScale, 0, 0, 1 / fixedScale, 0, 0]),
+    )
+    logging.debug(
+        "Coarse registration at shrink %d: scale %.4f, angle %.2f, peak %.3f"
+        % (fixedShrink, scale, math.degrees(angle), peak)
+    )
+    return matrix, peak
+
+
+def refine_matrix(fixed, moving, matrix, shrink):
+    """Correct ``matrix`` at one level, from windows matched by phase correlation.
+
+    ``PATCH_GRID`` x ``PATCH_GRID`` windows of ``PATCH_SIZE`` pixels are read
+    from the fixed layer and from the moving layer transformed by
+    ``matrix``; their shifts, bounded by a quarter window, are fitted by an
+    affine correction, or a translation when fewer than three windows match.
+    """
+    affine = AffineSlide(
+        moving.slide, matrix, moving.tileSize, moving.overlap, moving.readTile
+    )
+    warped = Layer(
+        affine,
+        lambda level, col, row: _tile_array(affine, level, col, row),
+        moving.tileSize,
+        moving.overlap,
+    )
+    scale = 2**shrink
+    fixedWidth, fixedHeight = fixed.slide.level_dimensions[-1]
+    warpedWidth, warpedHeight = warped.slide.level_dimensions[-1]
+    # Overlap of both layers, in level pixels
+    width = min(fixedWidth, warpedWidth) / scale
+    height = min(fixedHeight, warpedHeight) / scale
+    half = PATCH_SIZE // 2
+    sources, targets, weights = [], [], []
+    for fy in np.linspace(0.2, 0.8, PATCH_GRID):
+        for fx in np.linspace(0.2, 0.8, PATCH_GRID):
+            cx = int(min(max(fx * width, half), max(width - half, half)))
+            cy = int(min(max(fy * height, half), max(height - half, half)))
+            box = (cx - half, cy - half, cx + half, cy + half)
+            fixedPatch = fixed.read(shrink, *box)
+            movingPatch = warped.read(
+                min(shrink, warped.slide.level_count - 1), *box
+            )
+            if fixedPatch.std() < 1 or movingPatch.std() < 1:
+                # Background
+                continue
+            (dy, dx), peak = phase_correlation(fixedPatch, movingPatch)
+            if peak < MIN_PEAK or max(abs(dx), abs(dy)) > PATCH_SIZE / 4:
+                continue
+            sources.append([(cx - dx) * scale, (cy - dy) * scale])
+            targets.append([cx * scale, cy * scale])
+            weights.append(peak)
+    if not sources:
+        return matrix, 0
+    sources, targets = np.array(sources), np.array(targets)
+    weights = np.array(weights)
+    if len(sources) >= 3:
+        design = np.hstack([sources, np.ones((len(sources), 1))]) * weights[:, None]
+        solution, _, rank, _ = np.linalg.lstsq(design, targets * weights[:, None], rcond=None)
+        if rank == 3:
+            correction = [
+                solution[0, 0], solution[1, 0], solution[0, 1],
+                solution[1, 1], solution[2, 0], solution[2, 1],
+            ]
+            return _compose(correction, matrix), len(sources)
+    shift = np.median(targets - sources, axis=0)
+    return _compose([1, 0, 0, 1, shift[0], shift[1]], matrix), len(sources)
+
+
+def _tile_array(slide, level, col, row):
+    try:
+        return np.asarray(slide.get_tile(level, (col, row)))
+    except ValueError:
+        return None
+
+
+def register(fixed, moving, finestShrink=0):
+    """Affine matrix ``[a, b, c, d, e, f]`` mapping ``moving`` onto ``fixed``.
+
+    Both are :class:`Layer`. The matrix is estimated on whole low
+    resolution levels, then refined level by level, up to the level
+    shrunk ``2 ** finestShrink`` times, on bounded windows only. Returns
+    the matrix and, for every level, the number of matched windows.
+    """
+    matrix, peak = coarse_matrix(fixed, moving)
+    steps = [{"shrink": fixed.shrink_for(COARSE_SIZE), "peak": peak}]
+    for shrink in range(fixed.shrink_for(COARSE_SIZE) - 1, max(finestShrink, 0) - 1, -1):
+        matrix, matches = refine_matrix(fixed, moving, matrix, shrink)
+        steps.append({"shrink": shrink, "matches": matches})
+    return [float(v) for v in matrix], steps
@@ -0,0 +1,296 @@
+#
+# Spatial indexes over marker coordinates for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+import json
+import math
+import os
+import shutil
+import uuid
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Average number of points per grid cell
+POINTS_PER_CELL = 64
+MAX_GRID_SIZE = 2048
+
+
+class GridIndex(object):
+    """Uniform grid over the marker coordinates.
+
+    Point indices are stored sorted by grid cell with the start offset of
+    every cell, so the points of a bounding box are a few contiguous runs.
+    The index is kept on disk next to the column store it was built from.
+    """
+
+    def __init__(self, indexPath, x, y):
+        with open(os.path.join(indexPath, "grid.json")) as f:
+            meta = json.load(f)
+        self.x = x
+        self.y = y
+        self.bounds = meta["bounds"]
+        self.shape = tuple(meta["shape"])
+        self.cellSize = meta["cellSize"]
+        self.order = np.load(os.path.join(indexPath, "order.npy"), mmap_mode="r")
+        self.offsets = np.load(os.path.join(indexPath, "offsets.npy"))
+
+    @staticmethod
+    def build(indexPath, x, y, signature):
+        tmpPath = indexPath + ".tmp-" + uuid.uuid4().hex[:8]
+        os.makedirs(tmpPath)
+        try:
+            valid = np.isfinite(x) & np.isfinite(y)
+            if valid.any():
+                xmin, xmax = float(x[valid].min()), float(x[valid].max())
+                ymin, ymax = float(y[valid].min()), float(y[valid].max())
+            else:
+                xmin = xmax = ymin = ymax = 0.0
+            count = max(int(valid.sum()), 1)
+            extent = max(xmax - xmin, ymax - ymin, 1e-9)
+            cells = min(max(int(math.sqrt(count / POINTS_PER_CELL)), 1), MAX_GRID_SIZE)
+            cellSize = extent / cells
+            shape = (
+                min(int((ymax - ymin) / cellSize) + 1, MAX_GRID_SIZE),
+                min(int((xmax - xmin) / cellSize) + 1, MAX_GRID_SIZE),
+            )
+            cellIds = _cell_ids(x, y, xmin, ymin, cellSize, shape)
+            # Points without coordinates go to a trailing pseudo-cell
+            cellIds[~valid] = shape[0] * shape[1]
+            order = np.argsort(cellIds, kind="stable").astype(np.int64)
+            counts = np.bincount(cellIds, minlength=shape[0] * shape[1] + 1)
+            offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+            np.save(os.path.join(tmpPath, "order.npy"), order)
+            np.save(os.path.join(tmpPath, "offsets.npy"), offsets)
+            with open(os.path.join(tmpPath, "grid.json"), "w") as f:
+                json.dump(
+                    {
+                        "source": signature,
+                        "bounds": [xmin, ymin, xmax, ymax],
+                        "shape": list(shape),
+                        "cellSize": cellSize,
+                    },
+                    f,
+                )
+            if os.path.isdir(indexPath):
+                shutil.rmtree(indexPath, ignore_errors=True)
+            os.replace(tmpPath, indexPath)
+        except:
+            shutil.rmtree(tmpPath, ignore_errors=True)
+            raise
+
+    @staticmethod
+    def is_current(indexPath, signature):
+        try:
+            with open(os.path.join(indexPath, "grid.json")) as f:
+                return json.load(f).get("source") == signature
+        except (OSError, ValueError):
+            return False
+
+    def query_bbox(self, x0, y0, x1, y1):
+        """Return the indices of the points inside ``[x0, x1] x [y0, y1]``."""
+        xmin, ymin, _, _ = self.bounds
+        rows, cols = self.shape
+        c0 = max(int(math.floor((x0 - xmin) / self.cellSize)), 0)
+        c1 = min(int(math.floor((x1 - xmin) / self.cellSize)), cols - 1)
+        r0 = max(int(math.floor((y0 - ymin) / self.cellSize)), 0)
+        r1 = min(int(math.floor((y1 - ymin) / self.cellSize)), rows - 1)
+        if c0 > c1 or r0 > r1:
+            return np.zeros(0, dtype=np.int64)
+        # Cells of one grid row are contiguous in the sorted order
+        runs = [
+            self.order[self.offsets[r * cols + c0] : self.offsets[r * cols + c1 + 1]]
+            for r in range(r0, r1 + 1)
+        ]
+        candidates = np.concatenate(runs) if runs else np.zeros(0, dtype=np.int64)
+        px = self.x[candidates]
+        py = self.y[candidates]
+        inside = (px >= x0) & (px <= x1) & (py >= y0) & (py <= y1)
+        return np.sort(candidates[inside])
+
+    def cell_ids(self):
+        """Return the grid cell of every point (the last cell for missing ones)."""
+        cellIds = np.empty(len(self.order), dtype=np.int64)
+        cellIds[np.asarray(self.order)] = np.repeat(
+            np.arange(len(self.offsets) - 1), np.diff(self.offsets)
+        )
+        return cellIds
+
+
+class ConcatGridIndex(object):
+    """Grid indexes of several marker files queried as one table.
+
+    ``offsets`` holds the first row of every member in the concatenated
+    table; members without the coordinate columns are None.
+    """
+
+    def __init__(self, indexes, offsets, x, y):
+        self.indexes = indexes
+        self.offsets = offsets
+        self.x = x
+        self.y = y
+        bounds = [index.bounds for index in indexes if index is not None]
+        if bounds:
+            self.bounds = [
+                min(b[0] for b in bounds),
+                min(b[1] for b in bounds),
+                max(b[2] for b in bounds),
+                max(b[3] for b in bounds),
+            ]
+        else:
+            self.bounds = [0.0, 0.0, 0.0, 0.0]
+
+    def query_bbox(self, x0, y0, x1, y1):
+        """Return the indices of the points inside ``[x0, x1] x [y0, y1]``."""
+        found = [
+            index.query_bbox(x0, y0, x1, y1) + offset
+            for index, offset in zip(self.indexes, self.offsets)
+            if index is not None
+        ]
+        return np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+
+    def cell_ids(self):
+        """Return the cell of every point, the cells of each member kept apart."""
+        cellIds = np.empty(len(self.x), dtype=np.int64)
+        firstCell = 0
+        stops = list(self.offsets[1:]) + [len(self.x)]
+        for index, start, stop in zip(self.indexes, self.offsets, stops):
+            if index is None:
+                cellIds[start:stop] = firstCell
+                firstCell += 1
+                continue
+            cellIds[start:stop] = index.cell_ids() + firstCell
+            firstCell += len(index.offsets) - 1
+        return cellIds
+
+
+def _cell_ids(x, y, xmin, ymin, cellSize, shape):
+    with np.errstate(invalid="ignore"):
+        col = np.clip(np.nan_to_num((x - xmin) / cellSize), 0, shape[1] - 1)
+        row = np.clip(np.nan_to_num((y - ymin) / cellSize), 0, shape[0] - 1)
+    return row.astype(np.int64) * shape[1] + col.astype(np.int64)
+
+
+class KDTreeIndex(object):
+    """KD-tree over the marker coordinates for nearest-neighbour queries.
+
+    Points without finite coordinates are left out; ``rows`` maps tree
+    positions back to row indices of the marker table.
+    """
+
+    def __init__(self, x, y):
+        valid = np.isfinite(x) & np.isfinite(y)
+        self.rows = np.flatnonzero(valid)
+        self.points = np.column_stack([x[self.rows], y[self.rows]])
+        self.tree = cKDTree(self.points)
+
+    def nearest(self, x, y, k=1, radius=None):
+        """Return ``(rows, distances)`` of the ``k`` nearest points within ``radius``."""
+        k = min(max(int(k), 1), len(self.rows))
+        if k == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        bound = np.inf if radius is None else float(radius)
+        distances, positions = self.tree.query([x, y], k=k, distance_upper_bound=bound)
+        distances = np.atleast_1d(distances)
+        positions = np.atleast_1d(positions)
+        found = np.isfinite(distances)
+        return self.rows[positions[found]], distances[found]
+
+
+class ConcatKDTreeIndex(object):
+    """KD-trees of several marker files queried as one table."""
+
+    def __init__(self, trees, offsets):
+        self.trees = trees
+        self.offsets = offsets
+
+    def nearest(self, x, y, k=1, radius=None):
+        """Return ``(rows, distances)`` of the ``k`` nearest points within ``radius``."""
+        rows = []
+        distances = []
+        for tree, offset in zip(self.trees, self.offsets):
+            if tree is None or len(tree.rows) == 0:
+                continue
+            treeRows, treeDistances = tree.nearest(x, y, k, radius)
+            rows.append(treeRows + offset)
+            distances.append(treeDistances)
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        rows = np.concatenate(rows)
+        distances = np.concatenate(distances)
+        best = np.argsort(distances, kind="stable")[: max(int(k), 1)]
+        return rows[best], distances[best]
+
+
+class STRTree(object):
+    """Sort-Tile-Recursive packed R-tree over bounding boxes.
+
+    Boxes are ``(xmin, ymin, xmax, ymax)`` rows; queries return the indices
+    of the boxes intersecting a query box.
+    """
+
+    def __init__(self, boxes, nodeCapacity=16):
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        self.nodeCapacity = nodeCapacity
+        self.order = _str_order(boxes, nodeCapacity)
+        # levels[0] are the boxes in packed order, every next level groups
+        # ``nodeCapacity`` consecutive entries of the previous one
+        self.levels = [boxes[self.order]]
+        while len(self.levels[-1]) > nodeCapacity:
+            level = self.levels[-1]
+            starts = np.arange(0, len(level), nodeCapacity)
+            self.levels.append(
+                np.column_stack(
+                    [
+                        np.minimum.reduceat(level[:, 0], starts),
+                        np.minimum.reduceat(level[:, 1], starts),
+                        np.maximum.reduceat(level[:, 2], starts),
+                        np.maximum.reduceat(level[:, 3], starts),
+                    ]
+                )
+            )
+
+    def __len__(self):
+        return len(self.order)
+
+    def query(self, x0, y0, x1, y1):
+        """Return the sorted indices of the boxes intersecting ``[x0, x1] x [y0, y1]``."""
+        candidates = np.arange(len(self.levels[-1]))
+        for depth in range(len(self.levels) - 1, -1, -1):
+            level = self.levels[depth]
+            boxes = level[candidates]
+            hit = (
+                (boxes[:, 0] <= x1)
+                & (boxes[:, 2] >= x0)
+                & (boxes[:, 1] <= y1)
+                & (boxes[:, 3] >= y0)
+            )
+            candidates = candidates[hit]
+            if depth > 0:
+                children = (
+                    candidates[:, None] * self.nodeCapacity
+                    + np.arange(self.nodeCapacity)
+                ).ravel()
+                candidates = children[children < len(self.levels[depth - 1])]
+        return np.sort(self.order[candidates])
+
+
+def _str_order(boxes, nodeCapacity):
+    """Order boxes in vertical slices by x center, then by y center in each slice."""
+    count = len(boxes)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+    cx = (boxes[:, 0] + boxes[:, 2]) / 2
+    cy = (boxes[:, 1] + boxes[:, 3]) / 2
+    slices = int(math.ceil(math.sqrt(math.ceil(count / nodeCapacity))))
+    sliceSize = slices * nodeCapacity
+    byX = np.argsort(cx, kind="stable")
+    return np.concatenate(
+        [
+            byX[s : s + sliceSize][np.argsort(cy[byX[s : s + sliceSize]], kind="stable")]
+            for s in range(0, count, sliceSize)
+        ]
+    ).astype(np.int64)
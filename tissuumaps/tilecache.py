@@ -0,0 +1,51 @@
+#
+# In-memory tile cache for TissUUmaps
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+from collections import OrderedDict
+from threading import Lock
+
+
+class TileCache(object):
+    """LRU cache bounded by the total size of its values.
+
+    ``sizeof`` returns the size of one value; the default suits encoded
+    tiles stored as bytes.
+    """
+
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+        self._lock = Lock()
+        self._cache = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._cache.pop(key, None)
+            if value is not None:
+                # Move to end of LRU
+                self._cache[key] = value
+            return value
+
+    def put(self, key, value):
+        valueSize = self.sizeof(value)
+        if valueSize > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._cache.pop(key, None)
+            if previous is not None:
+                self.size -= self.sizeof(previous)
+            while self._cache and self.size + valueSize > self.max_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+            self._cache[key] = value
+            self.size += valueSize
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.size = 0
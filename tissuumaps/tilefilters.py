@@ -0,0 +1,238 @@
+#
+# Server-side image filters for TissUUmaps tiles
+#
+# This library is free software; you can redistribute it and/or modify it
+# under the terms of version 3.0 of the GNU General Public License
+# as published by the Free Software Foundation.
+#
+import json
+import math
+
+import numpy as np
+from scipy import ndimage
+
+# Filters are NumPy ports of those of filterUtils (CamanJS and the
+# OpenSeadragon filtering plugin), applied in order to RGB uint8 tiles.
+# Noise is left to the client: it is random on every redraw anyway.
+# Values are converted by parse_filters before filters are applied.
+
+# Sizes of the Erosion and Dilation kernels, as in the filterUtils sliders
+MIN_KERNEL_SIZE = 1
+MAX_KERNEL_SIZE = 11
+
+
+def _clip(values):
+    return np.clip(np.round(values), 0, 255).astype(np.uint8)
+
+
+def _color(tile, value):
+    if value is None:
+        return tile
+    percents = [v - 100 for v in value]
+    luts = []
+    for percent in percents:
+        ramp = np.arange(256, dtype=np.float64)
+        if percent > 0:
+            ramp += (255 - ramp) * percent / 100
+        else:
+            ramp -= ramp * abs(percent) / 100
+        luts.append(_clip(ramp))
+    return np.stack([luts[c][tile[:, :, c]] for c in range(3)], axis=2)
+
+
+def _brightness(tile, value):
+    adjust = np.floor(255 * value / 100)
+    return _clip(np.arange(256) + adjust)[tile]
+
+
+def _bezier_lut(points):
+    """Lookup table of the Bezier curve of CamanJS ``curves``."""
+    points = np.array(points, dtype=np.float64)
+    t = np.arange(1000) / 1000
+    curve = np.repeat(points[None], len(t), axis=0)
+    while curve.shape[1] > 1:
+        curve = curve[:, :-1] * (1 - t[:, None, None]) + curve[:, 1:] * t[:, None, None]
+    x = np.round(curve[:, 0, 0])
+    y = np.round(np.clip(curve[:, 0, 1], 0, 255))
+    x, first = np.unique(x[::-1], return_index=True)
+    # Later samples overwrite earlier ones at the same x, as in CamanJS
+    y = y[::-1][first]
+    return _clip(np.interp(np.arange(256), x, y))
+
+
+def _exposure(tile, value):
+    p = abs(value) / 100
+    ctrl1, ctrl2 = [0, 255 * p], [255 - 255 * p, 255]
+    if value < 0:
+        ctrl1, ctrl2 = ctrl1[::-1], ctrl2[::-1]
+    return _bezier_lut([[0, 0], ctrl1, ctrl2, [255, 255]])[tile]
+
+
+def _rgb_to_hsv(rgb):
+    rgb = rgb / 255
+    maximum, minimum = rgb.max(axis=2), rgb.min(axis=2)
+    delta = maximum - minimum
+    with np.errstate(invalid="ignore", divide="ignore"):
+        s = np.where(maximum == 0, 0, delta / maximum)
+        r, g, b = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
+        h = np.where(
+            maximum == r,
+            (g - b) / delta + np.where(g < b, 6, 0),
+            np.where(maximum == g, (b - r) / delta + 2, (r - g) / delta + 4),
+        )
+    h = np.where(delta == 0, 0, h) / 6
+    return h, s, maximum
+
+
+def _hsv_to_rgb(h, s, v):
+    i = np.floor(h * 6)
+    f = h * 6 - i
+    p, q, t = v * (1 - s), v * (1 - f * s), v * (1 - (1 - f) * s)
+    sector = (i % 6).astype(np.int64)[:, :, None]
+    choices = [
+        np.stack(c, axis=2)
+        for c in ((v, t, p), (q, v, p), (p, v, t), (p, q, v), (t, p, v), (v, p, q))
+    ]
+    rgb = np.zeros(h.shape + (3,))
+    for index, choice in enumerate(choices):
+        rgb = np.where(sector == index, choice, rgb)
+    return np.floor(rgb * 255)
+
+
+def _hue(tile, value):
+    h, s, v = _rgb_to_hsv(tile.astype(np.float64))
+    h = ((h * 100 + abs(value)) % 100) / 100
+    return _clip(_hsv_to_rgb(h, s, v))
+
+
+def _contrast(tile, value):
+    return _clip(np.arange(256) * value)[tile]
+
+
+def _towards_max(tile, amount):
+    values = tile.astype(np.float64)
+    maximum = values.max(axis=2, keepdims=True)
+    return _clip(values + (maximum - values) * amount)
+
+
+def _saturation(tile, value):
+    return _towards_max(tile, value * -0.01)
+
+
+def _vibrance(tile, value):
+    values = tile.astype(np.float64)
+    spread = np.abs(values.max(axis=2) - values.mean(axis=2))
+    amount = spread * 2 / 255 * -value / 100
+    return _towards_max(tile, amount[:, :, None])
+
+
+def _gamma(tile, value):
+    return _clip((np.arange(256) / 255) ** value * 255)[tile]
+
+
+def _invert(tile, value):
+    return 255 - tile if value else tile
+
+
+def _greyscale(tile, value):
+    if not value:
+        return tile
+    grey = np.round(tile.astype(np.float64).mean(axis=2)).astype(np.uint8)
+    return np.repeat(grey[:, :, None], 3, axis=2)
+
+
+def _threshold(tile, value):
+    if value >= 256:
+        # Default of the filterUtils slider: no threshold
+        return tile
+    mean = tile.astype(np.float64).mean(axis=2)
+    binary = np.where(mean < value, 0, 255).astype(np.uint8)
+    return np.repeat(binary[:, :, None], 3, axis=2)
+
+
+def _morphology(operation):
+    def apply(tile, size):
+        if size <= 1:
+            return tile
+        return operation(tile, size=(size, size, 1), mode="nearest")
+
+    return apply
+
+
+FILTERS = {
+    "Color": _color,
+    "Brightness": _brightness,
+    "Exposure": _exposure,
+    "Hue": _hue,
+    "Contrast": _contrast,
+    "Vibrance": _vibrance,
+    "Saturation": _saturation,
+    "Gamma": _gamma,
+    "Invert": _invert,
+    "Greyscale": _greyscale,
+    "Threshold": _threshold,
+    "Erosion": _morphology(ndimage.minimum_filter),
+    "Dilation": _morphology(ndimage.maximum_filter),
+}
+
+
+def _number(value):
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError("Filter values must be finite")
+    return value
+
+
+def _flag(value):
+    return value not in (False, None, "false", 0, "0")
+
+
+def _color_value(value):
+    """``None`` for no color change, else the three percents of "r,g,b"."""
+    if value in (0, "0", None):
+        return None
+    percents = [_number(v) for v in str(value).split(",")]
+    if len(percents) != 3:
+        raise ValueError("Color values are three comma separated percents")
+    return percents
+
+
+def _kernel_size(value):
+    return min(max(int(_number(value)), MIN_KERNEL_SIZE), MAX_KERNEL_SIZE)
+
+
+VALUE_PARSERS = {
+    "Color": _color_value,
+    "Invert": _flag,
+    "Greyscale": _flag,
+    "Erosion": _kernel_size,
+    "Dilation": _kernel_size,
+}
+
+
+def parse_filters(value):
+    """Parse filters given as in tmap ``layerFilters``: ``[{"name", "value"}]``.
+
+    Values are converted for :func:`apply_filters`. Raises ``ValueError``
+    for malformed lists or values and unknown filter names.
+    """
+    filters = json.loads(value) if isinstance(value, str) else value
+    if not isinstance(filters, list):
+        raise ValueError("Filters must be a list")
+    parsed = []
+    for item in filters:
+        if not isinstance(item, dict) or item.get("name") not in FILTERS:
+            raise ValueError("Unknown filter: %s" % item)
+        try:
+            filterValue = VALUE_PARSERS.get(item["name"], _number)(item.get("value"))
+        except TypeError:
+            raise ValueError("Invalid value for %s" % item["name"])
+        parsed.append({"name": item["name"], "value": filterValue})
+    return parsed
+
+
+def apply_filters(tile, filters):
+    """Apply ``filters``, as parsed by :func:`parse_filters`, in order to an RGB ``uint8`` tile."""
+    for item in filters:
+        tile = FILTERS[item["name"]](tile, item["value"])
+    return tile
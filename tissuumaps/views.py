@@ -1,21 +1,24 @@
 # Python default library
 from collections import OrderedDict
 from functools import wraps
-import gzip
+import hashlib
 import importlib
 import io
 import base64
 import json
+import math
 import os
 import threading
 from threading import Lock
 import time
+import types
 import logging
 from urllib.parse import urlparse
 from urllib.parse import parse_qs
 
 # External libraries
 import imghdr
+import numpy as np
 import pyvips
 import openslide
 from openslide import (
@@ -23,7 +26,30 @@ from openslide import (
     OpenSlide,
 )
 from openslide.deepzoom import DeepZoomGenerator
-from tissuumaps import app
+from PIL import Image
+from tissuumaps import (
+    affinetiles,
+    app,
+    celljoin,
+    composite,
+    enrichment,
+    graph,
+    labelregions,
+    labeltiles,
+    markerstats,
+    markertiles,
+    ometiff,
+    omezarr,
+    rawtiles,
+    regions,
+    registration,
+    regiontiles,
+    tilefilters,
+)
+from tissuumaps.markers import MARKER_EXTENSIONS, MarkerCache, cache_path
+from tissuumaps.pluginhost import PluginHost
+from tissuumaps.ranges import send_file_range
+from tissuumaps.tilecache import TileCache
 
 # Flask dependencies
 from flask import (
@@ -34,12 +60,18 @@ from flask import (
     request,
     Response,
     send_from_directory,
+    stream_with_context,
     redirect,
     _request_ctx_stack
 )
 
 from tissuumaps.flask_filetree import filetree
 def _fnfilter (filename):
+    if omezarr.is_zarr(filename):
+        # Opened as an image, not browsed as a folder
+        return True
+    if os.path.isdir(filename):
+        return False
     filename = filename.lower()
     if OpenSlide.detect_format(filename):
         return True
@@ -47,6 +79,8 @@ def _fnfilter (filename):
         return True
     elif ".tmap" in filename:
         return True
+    elif os.path.splitext(filename)[1] in (".h5ad", ".parquet", ".markers"):
+        return True
     return False
 
 def _dfilter (filename):
@@ -56,6 +90,12 @@ def _dfilter (filename):
         return False
     return True
 
+# Marker files served through the column store: <file>.<ext>/<endpoint>
+MARKER_ROUTE = "/<path:completePath>.<any(%s):ext>" % ", ".join(MARKER_EXTENSIONS)
+REGION_ROUTE = "/<path:completePath>.<any(json, geojson):ext>"
+# Most rows returned by one /rows request
+MAX_ROWS = 10000
+
 ft = filetree.make_blueprint(app=app, register=False, dfilter=_dfilter, fnfilter=_fnfilter)
 app.register_blueprint(ft, url_prefix='/filetree')
 
@@ -199,9 +239,10 @@ class ImageConverter:
 
 
 class _SlideCache(object):
-    def __init__(self, cache_size, dz_opts):
+    def __init__(self, cache_size, dz_opts, chunkCache=None):
         self.cache_size = cache_size
         self.dz_opts = dz_opts
+        self.chunkCache = chunkCache
         self._lock = Lock()
         self._cache = OrderedDict()
 
@@ -210,8 +251,51 @@ class _SlideCache(object):
             if path in self._cache:
                 # Move to end of LRU
                 slide = self._cache.pop(path)
-                self._cache[path] = slide
-                return slide
+                # Lazily read images are reopened once their files change
+                if getattr(slide, "is_current", lambda: True)():
+                    self._cache[path] = slide
+                    return slide
+
+        layer = affinetiles.split_layer_path(path)
+        if layer is not None:
+            sourcePath, matrix = layer
+
+            def readTile(level, col, row):
+                key = _raw_tile_key(sourcePath, level, col, row)
+                return _raw_tile(key, sourcePath, level, col, row)
+
+            # Through _get_slide, for sources that need a conversion first
+            slide = affinetiles.AffineSlide(
+                _get_slide(sourcePath),
+                matrix,
+                self.dz_opts["tile_size"],
+                self.dz_opts["overlap"],
+                readTile,
+            )
+            return self._put(path, slide)
+        layer = ometiff.split_layer_path(path)
+        if layer is None and ometiff.is_ome(path):
+            # First channel of the first series
+            layer = (path, 0, 0)
+        if layer is not None:
+            # Read lazily from the OME-TIFF, without conversion
+            slide = ometiff.OMEPlaneSlide(
+                *layer, self.dz_opts["tile_size"], self.dz_opts["overlap"]
+            )
+            if originalPath:
+                slide.properties = {"Path": originalPath}
+            return self._put(path, slide)
+        layer = omezarr.split_layer_path(path)
+        if layer is None and omezarr.is_zarr(path):
+            layer = (path, 0, 0)
+        if layer is not None:
+            slide = omezarr.ZarrSlide(
+                *layer,
+                self.dz_opts["tile_size"],
+                self.dz_opts["overlap"],
+                chunkCache=self.chunkCache,
+            )
+            return self._put(path, slide)
 
         osr = OpenSlide(path)
         # try:
@@ -253,6 +337,9 @@ class _SlideCache(object):
         slide.tileLock = Lock()
         if originalPath:
             slide.properties = {"Path":originalPath}
+        return self._put(path, slide)
+
+    def _put(self, path, slide):
         with self._lock:
             if path not in self._cache:
                 while len(self._cache) >= self.cache_size:
@@ -274,7 +361,27 @@ def setup(app):
         "DEEPZOOM_LIMIT_BOUNDS": "limit_bounds",
     }
     opts = dict((v, app.config[k]) for k, v in config_map.items())
-    app.cache = _SlideCache(app.config["SLIDE_CACHE_SIZE"], opts)
+    app.chunkCache = TileCache(
+        app.config["CHUNK_CACHE_BYTES"], sizeof=lambda chunk: chunk.nbytes
+    )
+    app.cache = _SlideCache(app.config["SLIDE_CACHE_SIZE"], opts, app.chunkCache)
+    app.markerCache = MarkerCache(app.config["MARKER_CACHE_SIZE"])
+    app.regionCache = regiontiles.RegionTilesCache(app.config["REGION_CACHE_SIZE"])
+    app.rawPyramidCache = rawtiles.RawPyramidCache(
+        app.config["SLIDE_CACHE_SIZE"],
+        app.config["DEEPZOOM_TILE_SIZE"],
+        app.config["DEEPZOOM_OVERLAP"],
+    )
+    app.tileCache = TileCache(app.config["TILE_CACHE_BYTES"])
+    app.rawTileCache = TileCache(
+        app.config["RAW_TILE_CACHE_BYTES"], sizeof=lambda tile: tile.nbytes
+    )
+    app.pluginHost = PluginHost(
+        app,
+        load_plugin,
+        app.config["PLUGIN_JOB_THREADS"],
+        app.config["PLUGIN_CACHE_BYTES"],
+    )
 
 
 @app.before_first_request
@@ -289,19 +396,44 @@ def page_not_found(e):
     return redirect("/404"), 404, {"Refresh": "1; url=/404"}
 
 
+def _source_path(path):
+    """File or Zarr directory behind a layer path, virtual or not."""
+    return omezarr.source_path(ometiff.source_path(affinetiles.source_path(path)))
+
+
+def _multi_layers(path):
+    """Channels and series of an OME-TIFF or OME-Zarr image, ``None`` for other images."""
+    try:
+        if ometiff.is_ome(path) and os.path.isfile(path):
+            return ometiff.OMETiff(path).layers(), ometiff.layer_path
+        if omezarr.is_zarr(path):
+            return omezarr.OMEZarr(path).layers(), omezarr.layer_path
+    except (ImportError, KeyError, ValueError, pyvips.Error):
+        logging.error("Could not read the layers of %s" % path)
+    return None, None
+
+
 def _get_slide(path, originalPath=None):
     path = os.path.abspath(os.path.join(app.basedir, path))
     if not path.startswith(app.basedir):
         # Directory traversal
         abort(404)
-    if not os.path.exists(path):
+    if not os.path.exists(_source_path(path)):
         abort(404)
     try:
         slide = app.cache.get(path, originalPath)
         slide.filename = os.path.basename(path)
         return slide
     except:
-        if ".tissuumaps" in path:
+        sourcePath = _source_path(path)
+        if (
+            ".tissuumaps" in path
+            or ometiff.is_ome(sourcePath)
+            or omezarr.is_zarr(sourcePath)
+            or affinetiles.split_layer_path(path) is not None
+        ):
+            # Converting would not help for OME-TIFF and OME-Zarr layers, and
+            # affine layers already convert their source
             abort(404)
         try:
             newpath = (
@@ -319,6 +451,52 @@ def _get_slide(path, originalPath=None):
             logging.error(traceback.format_exc())
             abort(404)
 
+def _get_markers(path):
+    path = os.path.abspath(os.path.join(app.basedir, path))
+    if not path.startswith(app.basedir):
+        # Directory traversal
+        abort(404)
+    if not os.path.isfile(path):
+        abort(404)
+    try:
+        markerFile = app.markerCache.get(path, root=app.basedir)
+    except:
+        import traceback
+
+        logging.error(traceback.format_exc())
+        abort(404)
+    for memberPath in getattr(markerFile, "memberPaths", []):
+        if not memberPath.startswith(app.basedir):
+            # Manifest pointing outside of the slide directory
+            abort(404)
+    return markerFile
+
+
+def _get_region_tiles(path):
+    path = os.path.abspath(os.path.join(app.basedir, path))
+    if not path.startswith(app.basedir) or not os.path.isfile(path):
+        abort(404)
+    try:
+        return app.regionCache.get(path)
+    except:
+        import traceback
+
+        logging.error(traceback.format_exc())
+        abort(404)
+
+
+def _get_grouped(markerFile, column):
+    if not column:
+        abort(400)
+    try:
+        return markerFile.grouped(column)
+    except KeyError:
+        abort(404)
+    except ValueError:
+        # Too many keys
+        abort(400)
+
+
 @app.route("/")
 @requires_auth
 def index():
@@ -350,6 +528,19 @@ def slide(filename):
             }
         ]
     }
+    layers, layer_path = _multi_layers(path)
+    if layers:
+        # One layer per channel and series
+        jsonProject["layers"] = [
+            {
+                "name": layer["name"],
+                "tileSource": layer_path(
+                    os.path.basename(path), layer["series"], layer["channel"]
+                )
+                + ".dzi",
+            }
+            for layer in layers
+        ]
     return render_template(
         "tissuumaps.html",
         plugins=app.config["PLUGINS"],
@@ -424,60 +615,497 @@ def tmapFile(filename):
 @requires_auth
 def csvFile(completePath):
     completePath = os.path.join(app.basedir, completePath + ".csv")
-    directory = os.path.dirname(completePath)
-    filename = os.path.basename(completePath)
-    print ("completePath", completePath, directory, filename, os.path.isfile(completePath))
     if os.path.isfile(completePath):
-        return send_from_directory(directory, filename)
-        # Temporary fix for gz files without csv
-        if os.path.isfile(completePath + ".gz"):
-            os.rename(completePath + ".gz", completePath + ".cgz")
-
-        generate_cgz = False
-        if not os.path.isfile(completePath + ".cgz"):
-            generate_cgz = True
-        elif os.path.getmtime(completePath) > os.path.getmtime(completePath + ".cgz"):
-            # In this case, the csv file has been recently modified and the cgz file is
-            # stale, so it must be regenerated.
-            generate_cgz = True
-        if generate_cgz:
-            with open(completePath, "rb") as f_in, gzip.open(
-                completePath + ".cgz", "wb", compresslevel=9
-            ) as f_out:
-                f_out.writelines(f_in)
-
-        response = make_response(send_from_directory(directory, filename + ".cgz"))
-        response.headers["Content-Encoding"] = "gzip"
-        response.headers["Vary"] = "Accept-Encoding"
-        response.headers["Transfer-Encoding"] = "gzip"
-        response.headers["Content-Length"] = os.path.getsize(completePath + ".cgz")
-        response.headers["Content-Type"] = "text/csv; charset=UTF-8"
-        return response
+        return send_file_range(completePath, mimetype="text/csv")
     else:
         abort(404)
 
 
+@app.route("/<path:completePath>.<any(h5ad, parquet, markers):ext>")
+@requires_auth
+def markerColumnsFile(completePath, ext):
+    markerFile = _get_markers(completePath + "." + ext)
+    columns = request.args.getlist("column") or None
+    if columns is not None and not set(columns).issubset(markerFile.table.columns):
+        abort(404)
+    return Response(markerFile.table.to_csv(columns), mimetype="text/csv")
+
+
+@app.route(MARKER_ROUTE + "/counts")
+@requires_auth
+def markerCounts(completePath, ext):
+    markerFile = _get_markers(completePath + "." + ext)
+    layout = _get_grouped(markerFile, request.args.get("gb_col"))
+    return {
+        "gb_col": layout.column,
+        "keys": layout.keys,
+        "counts": layout.counts,
+        "total": len(layout.table),
+    }
+
+
+@app.route(MARKER_ROUTE + "/profile")
+@requires_auth
+def markerProfile(completePath, ext):
+    markerFile = _get_markers(completePath + "." + ext)
+    profile = markerstats.get_profile(markerFile)
+    columns = request.args.getlist("column")
+    if columns:
+        if not set(columns).issubset(markerFile.table.columns):
+            abort(404)
+        profile = dict(
+            profile,
+            columns=[c for c in profile["columns"] if c["name"] in columns],
+        )
+    return profile
+
+
+@app.route(MARKER_ROUTE + "/group", methods=["GET", "POST"])
+@requires_auth
+def markerGroup(completePath, ext):
+    markerFile = _get_markers(completePath + "." + ext)
+    if request.method == "POST":
+        params = request.get_json(silent=False)
+        column, keys = params.get("gb_col"), params.get("keys", [])
+        columns = params.get("columns")
+    else:
+        column, keys = request.args.get("gb_col"), request.args.getlist("key")
+        columns = request.args.getlist("column") or None
+    layout = _get_grouped(markerFile, column)
+    if columns is not None and not set(columns).issubset(layout.table.columns):
+        abort(404)
+    return Response(layout.to_csv(keys, columns), mimetype="text/csv")
+
+
+@app.route(MARKER_ROUTE + "/progressive")
+@requires_auth
+def markerProgressive(completePath, ext):
+    markerFile = _get_markers(completePath + "." + ext)
+    x, y = request.args.get("X", "x"), request.args.get("Y", "y")
+    columns = request.args.getlist("column") or None
+    for column in [x, y] + (columns or []):
+        if column not in markerFile.table.columns:
+            abort(404)
+    try:
+        start = int(request.args.get("start", 0))
+        stop = request.args.get("stop")
+        stop = None if stop is None else int(stop)
+    except ValueError:
+        abort(400)
+    layout = markerFile.progressive(x, y)
+    total = len(layout.table)
+    first, last, _ = slice(start, stop).indices(total)
+    return Response(
+        layout.to_csv(columns, first, last, request.args.get("rowIndex") == "1"),
+        mimetype="text/csv",
+        headers={
+            "X-Total-Count": str(total),
+            "X-Record-Count": str(max(last - first, 0)),
+            "X-Record-Range": "%d-%d" % (first, last),
+        },
+    )
+
+
+@app.route(MARKER_ROUTE + "/rows", methods=["GET", "POST"])
+@requires_auth
+def markerRows(completePath, ext):
+    """Rows by index, or the ``k`` nearest to a point, at most ``MAX_ROWS`` of them."""
+    markerFile = _get_markers(completePath + "." + ext)
+    table = markerFile.table
+    if request.method == "POST":
+        params = request.get_json(silent=False) or {}
+        if not isinstance(params, dict):
+            abort(400)
+    else:
+        params = request.args.to_dict()
+        params["indices"] = request.args.getlist("index")
+        params["columns"] = request.args.getlist("column") or None
+    columns = params.get("columns")
+    for value in [columns, params.get("indices")]:
+        if value is not None and not isinstance(value, list):
+            abort(400)
+    if columns is not None and not all(isinstance(c, str) for c in columns):
+        abort(400)
+    if columns is not None and not set(columns).issubset(table.columns):
+        abort(404)
+    result = {}
+    try:
+        if params.get("indices"):
+            rows = np.asarray(
+                [int(i) for i in params["indices"][:MAX_ROWS]], dtype=np.int64
+            )
+            if len(rows) and (rows.min() < 0 or rows.max() >= len(table)):
+                abort(404)
+        elif "x" in params and "y" in params:
+            xColumn, yColumn = params.get("X", "x"), params.get("Y", "y")
+            if xColumn not in table.columns or yColumn not in table.columns:
+                abort(404)
+            radius = params.get("radius")
+            rows, distances = markerFile.kdtree(xColumn, yColumn).nearest(
+                float(params["x"]),
+                float(params["y"]),
+                min(int(params.get("k", 1)), MAX_ROWS),
+                None if radius is None else float(radius),
+            )
+            result["distances"] = distances.tolist()
+        else:
+            abort(400)
+    except (TypeError, ValueError):
+        abort(400)
+    result["indices"] = rows.tolist()
+    result["rows"] = json.loads(table.frame(columns, rows).to_json(orient="records", double_precision=15))
+    return result
+
+
+def _graph_spec(params):
+    try:
+        return graph.parse_spec(params)
+    except ValueError:
+        abort(400)
+
+
+@app.route(MARKER_ROUTE + "/graph")
+@requires_auth
+def markerGraph(completePath, ext):
+    """Neighbourhood graph as little-endian uint32 row index pairs.
+
+    With ``distances=1`` the float32 length of every edge follows the pairs.
+    """
+    markerFile = _get_markers(completePath + "." + ext)
+    spec = _graph_spec(request.args.to_dict())
+    spec["X"], spec["Y"] = request.args.get("X", "x"), request.args.get("Y", "y")
+    for column in [spec["X"], spec["Y"]]:
+        if column not in markerFile.table.columns:
+            abort(404)
+    edges, distances = graph.get_graph(markerFile, spec)
+    data = np.asarray(edges, dtype="<u4").tobytes()
+    if request.args.get("distances") == "1":
+        data += np.asarray(distances, dtype="<f4").tobytes()
+    resp = make_response(data)
+    resp.mimetype = "application/octet-stream"
+    resp.headers["X-Edge-Count"] = str(len(edges))
+    return resp
+
+
+@app.route(MARKER_ROUTE + "/enrichment", methods=["POST"])
+@requires_auth
+def markerEnrichment(completePath, ext):
+    """Neighbourhood enrichment or co-occurrence, for the whole file or per region."""
+    markerFile = _get_markers(completePath + "." + ext)
+    params = request.get_json(silent=False) or {}
+    x, y, key = params.get("X", "x"), params.get("Y", "y"), params.get("gb_col")
+    for column in [x, y, key]:
+        if column not in markerFile.table.columns:
+            abort(404)
+    analysis = params.get("analysis", "enrichment")
+    if analysis == "enrichment":
+        graphSpec = _graph_spec(params.get("graph", enrichment.DEFAULT_GRAPH))
+        permutations, seed = params.get("permutations", 1000), params.get("seed", 0)
+        if (
+            not isinstance(permutations, int)
+            or isinstance(permutations, bool)
+            or permutations < 1
+            or not isinstance(seed, int)
+        ):
+            abort(400)
+        permutations = min(permutations, enrichment.MAX_PERMUTATIONS)
+
+        def compute(region):
+            return enrichment.neighbourhood_enrichment(
+                markerFile,
+                key,
+                x,
+                y,
+                graphSpec,
+                region,
+                permutations,
+                seed,
+            )
+
+    elif analysis == "cooccurrence":
+        try:
+            distances = enrichment.parse_distances(params.get("distances", [50]))
+        except ValueError:
+            abort(400)
+
+        def compute(region):
+            return enrichment.cooccurrence(markerFile, key, x, y, distances, region)
+
+    else:
+        abort(400)
+    if params.get("regions") is None:
+        return compute(None)
+    results = []
+    for region in regions.load_regions(params["regions"]):
+        result = compute(region)
+        result.update(name=region.name, **{"class": region.regionClass})
+        results.append(result)
+    return {"regions": results}
+
+
+@app.route(MARKER_ROUTE + "/regions", methods=["POST"])
+@requires_auth
+def markerRegions(completePath, ext):
+    markerFile = _get_markers(completePath + "." + ext)
+    params = request.get_json(silent=False)
+    if not params or "regions" not in params:
+        abort(400)
+    x, y = params.get("X", "x"), params.get("Y", "y")
+    key = params.get("gb_col")
+    columns = params.get("columns")
+    for column in [x, y, key] + (columns or []):
+        if column and column not in markerFile.table.columns:
+            abort(404)
+    regionList = regions.load_regions(params["regions"])
+    if params.get("format") == "csv":
+        return Response(
+            regions.points_in_regions_csv(markerFile, regionList, x, y, columns),
+            mimetype="text/csv",
+            headers={"Content-Disposition": "attachment; filename=pointsinregions.csv"},
+        )
+    keys, results = regions.region_counts(markerFile, regionList, x, y, key)
+    return {"gb_col": key, "keys": keys, "regions": results}
+
+
+@app.route(MARKER_ROUTE + "/raster", methods=["POST"])
+@requires_auth
+def markerRaster(completePath, ext):
+    markerFile = _get_markers(completePath + "." + ext)
+    spec = request.get_json(silent=False)
+    try:
+        markertiles.check_spec(spec)
+    except ValueError:
+        abort(400)
+    header = spec["expectedHeader"]
+    for column in [header.get("X", "x"), header.get("Y", "y")]:
+        if column not in markerFile.table.columns:
+            abort(404)
+    if "layer" in spec:
+        slide = _get_slide(spec.pop("layer").replace(".dzi", "").lstrip("/\\"))
+        spec["width"], spec["height"] = slide.level_dimensions[-1]
+    elif "width" not in spec or "height" not in spec:
+        index = markerFile.spatial_index(header.get("X", "x"), header.get("Y", "y"))
+        spec["width"] = int(math.ceil(index.bounds[2])) + 1
+        spec["height"] = int(math.ceil(index.bounds[3])) + 1
+    specId = markertiles.spec_id(spec)
+    try:
+        # Build the raster before saving its spec, which tiles are read from
+        _marker_raster(markerFile, specId, spec)
+    except (TypeError, ValueError):
+        abort(400)
+    markertiles.save_spec(markerFile.path, spec)
+    return {
+        "tileSource": "/" + completePath + "." + ext + "/raster/" + specId + ".dzi"
+    }
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return {"mtime": stat.st_mtime_ns, "size": stat.st_size}
+
+
+@app.route(MARKER_ROUTE + "/cells", methods=["POST"])
+@requires_auth
+def markerCells(completePath, ext):
+    """Assign markers to the cells of a label image or of regions and count them."""
+    markerFile = _get_markers(completePath + "." + ext)
+    spec = request.get_json(silent=False) or {}
+    if not isinstance(spec, dict):
+        abort(400)
+    x, y, key = spec.get("X", "x"), spec.get("Y", "y"), spec.get("gb_col")
+    for column in [x, y, key]:
+        if column not in markerFile.table.columns:
+            abort(404)
+    try:
+        scale = float(spec.get("scale", 1))
+    except (TypeError, ValueError):
+        abort(400)
+    if not math.isfinite(scale) or scale <= 0:
+        abort(400)
+    source = {"markers": markerFile.signature, "spec": spec}
+    cellNames, extra = None, None
+    if spec.get("labels"):
+        labels = spec["labels"].replace(".dzi", "").lstrip("/\\")
+        labelPath = os.path.abspath(os.path.join(app.basedir, labels))
+        slide = _get_slide(labels)
+        source["cells"] = _file_signature(labelPath)
+
+        def assignments():
+            labelImage = celljoin.get_label_image(slide, labelPath)
+            return celljoin.label_assignments(
+                labelImage, markerFile.spatial_index(x, y), scale
+            )
+
+    elif spec.get("regions"):
+        geoJSON = spec["regions"]
+        if isinstance(geoJSON, str):
+            regionPath = os.path.abspath(os.path.join(app.basedir, geoJSON))
+            if not regionPath.startswith(app.basedir) or not os.path.isfile(regionPath):
+                abort(404)
+            source["cells"] = _file_signature(regionPath)
+            with open(regionPath) as f:
+                geoJSON = json.load(f)
+        cellRegions = regions.load_regions(geoJSON)
+        cellNames = [r.name for r in cellRegions]
+        extra = {"class": [r.regionClass for r in cellRegions]}
+
+        def assignments():
+            return celljoin.region_assignments(
+                cellRegions, markerFile.spatial_index(x, y)
+            )
+
+    else:
+        abort(400)
+    outputPath = os.path.join(
+        cache_path(markerFile.path, ".cells"), markertiles.spec_id(spec)
+    )
+    if celljoin.is_current(outputPath, source):
+        with open(outputPath + ".json") as f:
+            summary = json.load(f)
+    else:
+        os.makedirs(os.path.dirname(outputPath), exist_ok=True)
+        counts = celljoin.count_cells(markerFile, key, x, y, assignments())
+        summary = celljoin.write_cell_counts(
+            counts, outputPath, cellNames, extra, source
+        )
+    url = "/" + completePath + "." + ext + "/cells/" + os.path.basename(outputPath)
+    return {
+        "cells": len(summary["cells"]),
+        "keys": summary["keys"],
+        "assigned": summary["assigned"],
+        "unassigned": summary["unassigned"],
+        "path": os.path.relpath(outputPath + ".csv", app.basedir).replace("\\", "/"),
+        "matrix": url + ".mtx",
+        "summary": url + ".json",
+    }
+
+
+@app.route(MARKER_ROUTE + "/cells/<string:cellsId>.<any(csv, mtx, json):kind>")
+@requires_auth
+def markerCellsFile(completePath, ext, cellsId, kind):
+    markerFile = _get_markers(completePath + "." + ext)
+    if not cellsId.isalnum():
+        abort(404)
+    path = os.path.join(cache_path(markerFile.path, ".cells"), cellsId + "." + kind)
+    if not os.path.isfile(path):
+        abort(404)
+    mimetype = {"csv": "text/csv", "json": "application/json"}.get(kind, "text/plain")
+    return send_file_range(path, mimetype=mimetype)
+
+
+def _get_marker_raster(completePath, ext, specId):
+    markerFile = _get_markers(completePath + "." + ext)
+    try:
+        spec = markertiles.load_spec(markerFile.path, specId)
+    except KeyError:
+        abort(404)
+    return _marker_raster(markerFile, specId, spec)
+
+
+def _marker_raster(markerFile, specId, spec):
+    return markerFile.derived(
+        ("raster", specId),
+        lambda: markertiles.MarkerRaster(
+            markerFile,
+            spec,
+            app.config["DEEPZOOM_TILE_SIZE"],
+            app.config["DEEPZOOM_OVERLAP"],
+            "png",
+        ),
+    )
+
+
+@app.route(MARKER_ROUTE + "/raster/<string:specId>.dzi")
+@requires_auth
+def markerRasterDzi(completePath, ext, specId):
+    raster = _get_marker_raster(completePath, ext, specId)
+    resp = make_response(raster.get_dzi())
+    resp.mimetype = "application/xml"
+    return resp
+
+
+@app.route(
+    MARKER_ROUTE
+    + "/raster/<string:specId>_files/<int:level>/<int:col>_<int:row>.<format>"
+)
+@requires_auth
+def markerRasterTile(completePath, ext, specId, level, col, row, format):
+    raster = _get_marker_raster(completePath, ext, specId)
+    cacheKey = (
+        "raster",
+        raster.markerFile.path,
+        # Signatures of .markers manifests describe the manifest and its members
+        hashlib.md5(
+            json.dumps(raster.markerFile.signature, sort_keys=True).encode()
+        ).hexdigest(),
+        specId,
+        level,
+        col,
+        row,
+    )
+    data = app.tileCache.get(cacheKey)
+    if data is None:
+        try:
+            tile = raster.render(level, col, row)
+        except ValueError:
+            # Invalid level or coordinates
+            abort(404)
+        buf = PILBytesIO()
+        Image.fromarray(tile, "RGBA").save(buf, "png")
+        data = buf.getvalue()
+        app.tileCache.put(cacheKey, data)
+    resp = make_response(data)
+    resp.mimetype = "image/png"
+    resp.cache_control.max_age = 1209600
+    resp.cache_control.public = True
+    return resp
+
+
 @app.route("/<path:completePath>.json")
 @requires_auth
 def jsonFile(completePath):
     completePath = os.path.join(app.basedir, completePath + ".json")
-    directory = os.path.dirname(completePath)
-    filename = os.path.basename(completePath)
     if os.path.isfile(completePath):
-        return send_from_directory(directory, filename)
+        return send_file_range(completePath, mimetype="application/json")
     else:
         abort(404)
 
 
+@app.route(REGION_ROUTE + "/vtiles")
+@requires_auth
+def regionTilesInfo(completePath, ext):
+    """Geometry of the vector tile pyramid and the properties of every region."""
+    return _get_region_tiles(completePath + "." + ext).info()
+
+
+@app.route(REGION_ROUTE + "/vtiles/<int:level>/<int:col>_<int:row>.bin")
+@requires_auth
+def regionTile(completePath, ext, level, col, row):
+    """Regions crossing one tile, simplified and clipped (see ``regiontiles.encode_tile``)."""
+    regionTiles = _get_region_tiles(completePath + "." + ext)
+    cacheKey = ("vtiles", regionTiles.path, str(regionTiles.signature), level, col, row)
+    data = app.tileCache.get(cacheKey)
+    if data is None:
+        try:
+            data = regionTiles.get_tile(level, col, row)
+        except ValueError:
+            # Invalid level or coordinates
+            abort(404)
+        app.tileCache.put(cacheKey, data)
+    resp = make_response(data)
+    resp.mimetype = "application/octet-stream"
+    resp.cache_control.max_age = 1209600
+    resp.cache_control.public = True
+    return resp
+
+
 @app.route("/<path:path>.dzi")
 @requires_auth
 def dzi(path):
     completePath = os.path.join(app.basedir, path)
     # Check if a .dzi file exists, else use OpenSlide:
     if os.path.isfile(completePath + ".dzi"):
-        directory = os.path.dirname(completePath)
-        filename = os.path.basename(completePath) + ".dzi"
-        return send_from_directory(directory, filename)
+        return send_file_range(completePath + ".dzi", mimetype="application/xml")
     slide = _get_slide(path)
     format = app.config["DEEPZOOM_FORMAT"]
     resp = make_response(slide.get_dzi(format))
@@ -485,6 +1113,23 @@ def dzi(path):
     return resp
 
 
+@app.route("/<path:path>.dzi/layers")
+@requires_auth
+def dziLayers(path):
+    """Channels and series of an OME-TIFF or OME-Zarr image, each as a tile source."""
+    completePath = os.path.abspath(os.path.join(app.basedir, path))
+    if not completePath.startswith(app.basedir) or not os.path.exists(completePath):
+        abort(404)
+    layers, layer_path = _multi_layers(completePath)
+    if layers is None:
+        return {"layers": [{"name": os.path.basename(path), "tileSource": "/" + path + ".dzi"}]}
+    for layer in layers:
+        layer["tileSource"] = "/%s.dzi" % layer_path(
+            path.replace("\\", "/"), layer["series"], layer["channel"]
+        )
+    return {"layers": layers}
+
+
 @app.route("/<path:path>.dzi/info")
 @requires_auth
 def dzi_asso(path):
@@ -505,27 +1150,362 @@ def dzi_asso(path):
 
 
 
+@app.route("/<path:path>.dzi/regions.geojson")
+@requires_auth
+def dzi_regions(path):
+    """Regions traced from the labels of an image, as GeoJSON."""
+    completePath = os.path.abspath(os.path.join(app.basedir, path))
+    if not completePath.startswith(app.basedir) or not os.path.isfile(completePath):
+        abort(404)
+    try:
+        tolerance = float(request.args.get("tolerance", labelregions.DEFAULT_TOLERANCE))
+    except ValueError:
+        abort(400)
+    try:
+        regionsPath = labelregions.get_label_regions(completePath, tolerance)
+    except:
+        import traceback
+
+        logging.error(traceback.format_exc())
+        abort(404)
+    return send_file_range(regionsPath, mimetype="application/json")
+
+
+def _label_tile(path, level, col, row, format):
+    """Tile of a label mask, coloured by cell through a marker file column.
+
+    Query arguments: ``markers`` (path of the table), ``cell`` (column of
+    the cell labels), ``category`` (column of colours or categories),
+    ``colors`` (JSON ``{category: "#rrggbb"}``) and ``downsample``
+    (``nearest`` or ``mode``). Without ``markers``, labels get random colours.
+    """
+    completePath = os.path.abspath(os.path.join(app.basedir, path))
+    if not os.path.isfile(completePath):
+        abort(404)
+    slide = _get_slide(path)
+    downsample = request.args.get("downsample", "nearest")
+    if downsample not in labeltiles.DOWNSAMPLING:
+        abort(400)
+    colors = None
+    lutVersion = None
+    if request.args.get("markers"):
+        markerFile = _get_markers(request.args["markers"])
+        cell = request.args.get("cell", "cell")
+        category = request.args.get("category", "")
+        try:
+            colorDict = json.loads(request.args.get("colors", "{}"))
+        except ValueError:
+            abort(400)
+        for column in [cell, category]:
+            if column not in markerFile.table.columns:
+                abort(404)
+        lutSpec = {"cell": cell, "category": category, "colors": colorDict}
+        lutVersion = markertiles.spec_id(dict(lutSpec, source=markerFile.signature))
+        colors = markerFile.derived(
+            ("label-colors", markertiles.spec_id(lutSpec)),
+            lambda: labeltiles.LabelColors(markerFile, cell, category, colorDict),
+        )
+    format = format.lower()
+    cacheKey = (
+        "labels", completePath, os.path.getmtime(completePath), lutVersion,
+        downsample, level, col, row, format,
+    )
+    data = app.tileCache.get(cacheKey)
+    if data is None:
+        labelImage = celljoin.get_label_image(slide, completePath)
+        try:
+            labels = labeltiles.read_label_tile(
+                labelImage, slide, level, col, row, downsample
+            )
+        except ValueError:
+            # Invalid level or coordinates
+            abort(404)
+        rgba = colors(labels) if colors is not None else labeltiles.random_colors(labels)
+        tile = Image.fromarray(rgba, "RGBA")
+        if format != "png":
+            tile = tile.convert("RGB")
+        buf = PILBytesIO()
+        tile.save(buf, format, quality=app.config["DEEPZOOM_TILE_QUALITY"])
+        data = buf.getvalue()
+        app.tileCache.put(cacheKey, data)
+    resp = make_response(data)
+    resp.mimetype = "image/%s" % format
+    resp.cache_control.max_age = 1209600
+    resp.cache_control.public = True
+    return resp
+
+
+def _tile_source_path(tileSource):
+    return tileSource.replace(".dzi", "").lstrip("/\\")
+
+
+@app.route("/composite", methods=["POST"])
+@requires_auth
+def compositeLayer():
+    """Register a composite of several layers, served as one tile source."""
+    try:
+        spec = composite.normalize_spec(request.get_json(silent=False) or {})
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+    dimensions = set()
+    for layer in spec["layers"]:
+        slide = _get_slide(_tile_source_path(layer["tileSource"]))
+        dimensions.add(slide.level_dimensions[-1])
+    if len(dimensions) > 1:
+        # Layers must share the same pixel grid
+        abort(400)
+    firstPath = _tile_source_path(spec["layers"][0]["tileSource"])
+    specId = composite.save_spec(os.path.join(app.basedir, firstPath), spec)
+    return {"tileSource": "/" + firstPath + "/composite/" + specId + ".dzi"}
+
+
+def _get_composite(path, specId):
+    try:
+        spec = composite.load_spec(os.path.join(app.basedir, path), specId)
+    except KeyError:
+        abort(404)
+    slides = [_get_slide(_tile_source_path(l["tileSource"])) for l in spec["layers"]]
+    return spec, slides
+
+
+@app.route("/<path:path>/composite/<string:specId>.dzi")
+@requires_auth
+def compositeDzi(path, specId):
+    _, slides = _get_composite(path, specId)
+    resp = make_response(slides[0].get_dzi(app.config["DEEPZOOM_FORMAT"]))
+    resp.mimetype = "application/xml"
+    return resp
+
+
+@app.route(
+    "/<path:path>/composite/<string:specId>_files/<int:level>/<int:col>_<int:row>.<format>"
+)
+def compositeTile(path, specId, level, col, row, format):
+    spec, slides = _get_composite(path, specId)
+    format = format.lower()
+    mtimes = tuple(
+        _source_mtime(_tile_source_path(l["tileSource"])) for l in spec["layers"]
+    )
+    cacheKey = ("composite", path, specId, mtimes, level, col, row, format)
+    data = app.tileCache.get(cacheKey)
+    if data is None:
+
+        def reader(layer):
+            layerPath = _tile_source_path(layer["tileSource"])
+            key = _raw_tile_key(layerPath, level, col, row)
+            return lambda: _raw_tile(key, layerPath, level, col, row)
+
+        tiles = composite.read_tiles([reader(l) for l in spec["layers"]])
+        tile = composite.blend(tiles, spec)
+        if tile is None:
+            # Invalid level or coordinates
+            abort(404)
+        buf = PILBytesIO()
+        Image.fromarray(tile, "RGB").save(
+            buf, format, quality=app.config["DEEPZOOM_TILE_QUALITY"]
+        )
+        data = buf.getvalue()
+        app.tileCache.put(cacheKey, data)
+    resp = make_response(data)
+    resp.mimetype = "image/%s" % format
+    resp.cache_control.max_age = 1209600
+    resp.cache_control.public = True
+    return resp
+
+
+@app.route("/register", methods=["POST"])
+@requires_auth
+def registerLayers():
+    """Affine matrix mapping the ``moving`` layer onto the ``fixed`` one.
+
+    The matrix is estimated on low resolution levels and refined on
+    windows of finer levels, down to the level shrunk ``2 ** finestShrink``
+    times. Returns it with the tile source of the transformed moving layer.
+    """
+    content = request.get_json(silent=False) or {}
+    try:
+        fixedPath = _tile_source_path(content["fixed"])
+        movingPath = _tile_source_path(content["moving"])
+        finestShrink = int(content.get("finestShrink", 0))
+    except (AttributeError, KeyError, TypeError, ValueError):
+        abort(400)
+
+    def layer(path):
+        def readTile(level, col, row):
+            return _raw_tile(_raw_tile_key(path, level, col, row), path, level, col, row)
+
+        return registration.Layer(
+            _get_slide(path),
+            readTile,
+            app.config["DEEPZOOM_TILE_SIZE"],
+            app.config["DEEPZOOM_OVERLAP"],
+        )
+
+    try:
+        matrix, steps = registration.register(
+            layer(fixedPath), layer(movingPath), finestShrink
+        )
+    except (ValueError, np.linalg.LinAlgError):
+        # No usable correlation, or a degenerate matrix
+        abort(422)
+    return {
+        "matrix": matrix,
+        "steps": steps,
+        "tileSource": "/" + affinetiles.layer_path(movingPath, matrix) + ".dzi",
+    }
+
+
+def _source_mtime(path):
+    """Modification time of the file behind a layer, virtual or not."""
+    sourcePath = os.path.join(app.basedir, _source_path(path))
+    if omezarr.is_zarr(sourcePath):
+        # A folder, whose own time does not change with its chunks
+        return _get_slide(affinetiles.source_path(path)).signature
+    return os.path.getmtime(sourcePath)
+
+
+def _raw_tile_key(path, level, col, row, format=None):
+    """Key of a decoded tile: its pre-computed file, or the slide it comes from."""
+    completePath = os.path.join(app.basedir, path)
+    tileFile = f"{completePath}_files/{level}/{col}_{row}.{format}"
+    if format is not None and os.path.isfile(tileFile):
+        return ("file", tileFile, os.path.getmtime(tileFile))
+    _get_slide(path)
+    return ("slide", path, _source_mtime(path), level, col, row)
+
+
+def _raw_tile(key, path, level, col, row):
+    """Decoded RGB tile, kept in the raw tile cache; ``None`` for invalid addresses."""
+    tile = app.rawTileCache.get(key)
+    if tile is None:
+        if key[0] == "file":
+            tile = np.asarray(Image.open(key[1]).convert("RGB"))
+        else:
+            slide = _get_slide(path)
+            try:
+                with slide.tileLock:
+                    tile = np.asarray(slide.get_tile(level, (col, row)).convert("RGB"))
+            except ValueError:
+                return None
+        app.rawTileCache.put(key, tile)
+    return tile
+
+
+def _filtered_tile(path, level, col, row, format):
+    """Tile with filterUtils filters applied, given as ``filters=[{"name", "value"}]``.
+
+    Filters are applied to decoded tiles from the raw tile cache, so
+    changing them does not read the slide again.
+    """
+    try:
+        filters = tilefilters.parse_filters(request.args["filters"])
+    except (AttributeError, TypeError, ValueError):
+        abort(400)
+    format = format.lower()
+    key = _raw_tile_key(path, level, col, row, format)
+    cacheKey = ("filtered", key, format, json.dumps(filters, sort_keys=True))
+    data = app.tileCache.get(cacheKey)
+    if data is None:
+        tile = _raw_tile(key, path, level, col, row)
+        if tile is None:
+            # Invalid level or coordinates
+            abort(404)
+        buf = PILBytesIO()
+        Image.fromarray(tilefilters.apply_filters(tile, filters), "RGB").save(
+            buf, format, quality=app.config["DEEPZOOM_TILE_QUALITY"]
+        )
+        data = buf.getvalue()
+        app.tileCache.put(cacheKey, data)
+    resp = make_response(data)
+    resp.mimetype = "image/%s" % format
+    resp.cache_control.max_age = 1209600
+    resp.cache_control.public = True
+    return resp
+
+
+def _get_raw_pyramid(path):
+    completePath = os.path.abspath(os.path.join(app.basedir, path))
+    if not completePath.startswith(app.basedir) or not os.path.isfile(completePath):
+        abort(404)
+    try:
+        return app.rawPyramidCache.get(completePath)
+    except:
+        import traceback
+
+        logging.error(traceback.format_exc())
+        abort(404)
+
+
+@app.route("/<path:path>.dzi/raw")
+@requires_auth
+def rawInfo(path):
+    """Native pixel type, value range and default window of an image layer."""
+    return _get_raw_pyramid(path).info()
+
+
+@app.route("/<path:path>.dzi/raw/<int:level>/<int:col>_<int:row>.<any(png, zst):format>")
+@requires_auth
+def rawTile(path, level, col, row, format):
+    """Tile with the native bit depth of the image, for windowing on the client.
+
+    ``png`` tiles are 8 or 16-bit PNGs; ``zst`` tiles are zstd-compressed
+    little-endian values, with their shape in ``X-Shape`` and type in ``X-Dtype``.
+    """
+    pyramid = _get_raw_pyramid(path)
+    try:
+        (_, width), (_, height) = pyramid.tile_bounds(level, col, row)
+    except ValueError:
+        # Invalid level or coordinates
+        abort(404)
+    cacheKey = ("raw", pyramid.path, pyramid.signature["mtime"], level, col, row, format)
+    data = app.tileCache.get(cacheKey)
+    if data is None:
+        try:
+            data = rawtiles.encode_tile(pyramid.read_tile(level, col, row), format)
+        except (ImportError, ValueError):
+            abort(400)
+        app.tileCache.put(cacheKey, data)
+    resp = make_response(data)
+    resp.mimetype = "image/png" if format == "png" else "application/zstd"
+    resp.headers["X-Shape"] = "%d,%d,%d" % (height, width, pyramid.meta["bands"])
+    resp.headers["X-Dtype"] = pyramid.meta["dtype"]
+    resp.cache_control.max_age = 1209600
+    resp.cache_control.public = True
+    return resp
+
+
 @app.route("/<path:path>_files/<int:level>/<int:col>_<int:row>.<format>")
 def tile(path, level, col, row, format):
+    if request.args.get("mode") == "labels":
+        return _label_tile(path, level, col, row, format)
+    if request.args.get("filters"):
+        return _filtered_tile(path, level, col, row, format)
     completePath = os.path.join(app.basedir, path)
     if os.path.isfile( f"{completePath}_files/{level}/{col}_{row}.{format}"):
-        directory = os.path.dirname(f"{completePath}_files/{level}/{col}_{row}.{format}")
-        filename = os.path.basename(f"{completePath}_files/{level}/{col}_{row}.{format}")
-        return send_from_directory(directory, filename)
+        return send_file_range(
+            f"{completePath}_files/{level}/{col}_{row}.{format}",
+            precompressed=False,
+            max_age=1209600,
+        )
     slide = _get_slide(path)
     format = format.lower()
     # if format != 'jpeg' and format != 'png':
     #    # Not supported by Deep Zoom
     #    abort(404)
-    try:
-        with slide.tileLock:
-            tile = slide.get_tile(level, (col, row))
-    except ValueError:
-        # Invalid level or coordinates
-        abort(404)
-    buf = PILBytesIO()
-    tile.save(buf, format, quality=app.config["DEEPZOOM_TILE_QUALITY"])
-    resp = make_response(buf.getvalue())
+    cacheKey = (path, _source_mtime(path), level, col, row, format)
+    data = app.tileCache.get(cacheKey)
+    if data is None:
+        try:
+            with slide.tileLock:
+                tile = slide.get_tile(level, (col, row))
+        except ValueError:
+            # Invalid level or coordinates
+            abort(404)
+        buf = PILBytesIO()
+        tile.save(buf, format, quality=app.config["DEEPZOOM_TILE_QUALITY"])
+        data = buf.getvalue()
+        app.tileCache.put(cacheKey, data)
+    resp = make_response(data)
     resp.mimetype = "image/%s" % format
     resp.cache_control.max_age = 1209600
     resp.cache_control.public = True
@@ -575,20 +1555,50 @@ def runPlugin(pluginName):
         abort(404)
 
 
+def _plugin_response(value):
+    """Response of a plugin method; bytes and generators are sent as binary."""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return Response(bytes(value), mimetype="application/octet-stream")
+    if isinstance(value, types.GeneratorType):
+        # Streamed chunk by chunk, as the plugin yields them
+        return Response(stream_with_context(value), mimetype="application/octet-stream")
+    return value
+
+
+@app.route("/plugins/<path:pluginName>/jobs/<jobId>", methods=["GET", "DELETE"])
+def pluginJob(pluginName, jobId):
+    """Progress, and result once done, of a background job of a plugin."""
+    context = app.pluginHost.context(pluginName, create=False)
+    job = context.job(jobId) if context is not None else None
+    if job is None:
+        abort(404)
+    if request.method == "DELETE":
+        job.cancel()
+    return job.status()
+
+
 @app.route("/plugins/<path:pluginName>/<path:method>", methods=["GET", "POST"])
 def pluginJS(pluginName, method):
-    logging.info("runPlugin", pluginName, method)
+    logging.info("runPlugin %s %s" % (pluginName, method))
     logging.debug(request.method)
 
-    pluginModule = load_plugin(pluginName)
-    pluginInstance = pluginModule.Plugin(app)
+    try:
+        pluginInstance = app.pluginHost.get(pluginName)
+    except ImportError:
+        logging.error("Could not load plugin %s" % pluginName)
+        abort(404)
+    if method.startswith("_"):
+        abort(404)
+    # Only methods of the plugin class, not attributes such as host or app
+    if not callable(getattr(type(pluginInstance), method, None)):
+        abort(404)
     pluginMethod = getattr(pluginInstance, method)
     if request.method == "POST":
         content = request.get_json(silent=False)
-        return pluginMethod(content)
+        return _plugin_response(pluginMethod(content))
     else:
         content = request.args
-        return pluginMethod(content)
+        return _plugin_response(pluginMethod(content))
 
 
 @app.route("/favicon.ico")